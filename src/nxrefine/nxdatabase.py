@@ -36,15 +36,22 @@ automatically.
 
 NXDatabase assumes that no identical tasks (i.e., same task, entry, and
 wrapper file) will be queued or running at the same time
+
+The database uses SQLite's write-ahead log, so that processes reading
+the task status do not block processes updating it, and writers wait
+for each other using SQLite's busy timeout. Each update is committed in
+a single transaction, and several tasks can be queued at once with
+queue_tasks().
 """
 
 import datetime
 import os
+from contextlib import contextmanager
 from pathlib import Path
 
-from nexusformat.nexus import NeXusError, NXLock, nxload
-from sqlalchemy import (Column, ForeignKey, Integer, String, create_engine,
-                        inspect, text)
+from nexusformat.nexus import NeXusError, nxload
+from sqlalchemy import (Column, ForeignKey, Index, Integer, String,
+                        create_engine, event, func, inspect, select, text)
 from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
@@ -106,6 +113,10 @@ class Task(Base):
 
     file = relationship('File', back_populates='tasks')
 
+    # Finds the latest task for each task name, entry and subentry
+    __table_args__ = (Index('ix_tasks_latest', 'filename', 'name', 'entry',
+                            'subentry', 'id'),)
+
     def __repr__(self):
         return (f"Task('{self.name}', filename='{self.filename}', "
                 f"entry='{self.entry}', subentry='{self.subentry}', "
@@ -124,9 +135,24 @@ class NXDatabase:
                            'nxtransform', 'nxmasked_transform',
                            'nxcombine', 'nxmasked_combine',
                            'nxpdf', 'nxmasked_pdf')
+    scan_task_names = ('nxcombine', 'nxmasked_combine', 'nxpdf',
+                       'nxmasked_pdf')
+    # Tasks whose results are required by each task
+    task_dependencies = {'nxload': (),
+                         'nxlink': ('nxload',),
+                         'nxmax': ('nxlink',),
+                         'nxfind': ('nxmax',),
+                         'nxrefine': ('nxfind',),
+                         'nxprepare': ('nxlink',),
+                         'nxtransform': ('nxrefine',),
+                         'nxmasked_transform': ('nxrefine', 'nxprepare'),
+                         'nxcombine': ('nxtransform',),
+                         'nxmasked_combine': ('nxmasked_transform',),
+                         'nxpdf': ('nxcombine',),
+                         'nxmasked_pdf': ('nxmasked_combine',)}
     NOT_STARTED, QUEUED, IN_PROGRESS, DONE, FAILED = 0, 1, 2, 3, -1
 
-    def __init__(self, db_file, echo=False):
+    def __init__(self, db_file, echo=False, timeout=60.0):
         """Connect to the database, creating tables if necessary.
 
         Parameters
@@ -135,14 +161,18 @@ class NXDatabase:
             Path to the database file
         echo : bool, optional
             True if SQL statements are echoed to `stdout`, by default False.
+        timeout : float, optional
+            Time in seconds to wait for another process to finish writing
+            to the database, by default 60.
         """
         if Path(db_file).resolve().parent.name != 'tasks':
             raise NeXusError("Database should be in 'tasks' subdirectory")
         db_file = str(db_file)
-        with NXLock(db_file):
-            connection = 'sqlite:///' + db_file
-            self.engine = create_engine(connection, echo=echo)
-            Base.metadata.create_all(self.engine)
+        connection = 'sqlite:///' + db_file
+        self.engine = create_engine(connection, echo=echo,
+                                    connect_args={'timeout': timeout})
+        event.listen(self.engine, 'connect', self.configure_connection)
+        Base.metadata.create_all(self.engine)
         self.database = Path(self.engine.url.database).resolve()
         self.check_tasks()
         self.experiment_directory = self.database.parent.parent
@@ -151,6 +181,7 @@ class NXDatabase:
         except Exception:
             pass
         self._session = None
+        self._transactions = 0
 
     def __repr__(self):
         return f"NXDatabase('{self.database}')"
@@ -161,6 +192,69 @@ class NXDatabase:
             self._session = sessionmaker(bind=self.engine)()
         return self._session
 
+    @staticmethod
+    def configure_connection(connection, connection_record):
+        """Enable the write-ahead log on each new SQLite connection."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """Commit the database changes made within the context.
+
+        The changes are rolled back if an exception is raised, so that
+        the session can continue to be used. Nested transactions are
+        committed or rolled back with the outermost one.
+        """
+        self._transactions += 1
+        try:
+            yield self.session
+            if self._transactions == 1:
+                self.session.commit()
+        except Exception:
+            if self._transactions == 1:
+                self.session.rollback()
+            raise
+        finally:
+            self._transactions -= 1
+
+    def commit(self):
+        """Commit the session, unless it is within a transaction.
+
+        Within a transaction, the changes are only flushed, so that they
+        are committed or rolled back with the rest of the transaction.
+        """
+        if self._transactions:
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    @classmethod
+    def prerequisites(cls, tasks):
+        """Return all the tasks that must precede the specified tasks.
+
+        Parameters
+        ----------
+        tasks : iterable of str
+            Names of the tasks, as listed in `task_names`.
+
+        Returns
+        -------
+        set of str
+            Names of the tasks on which they depend, directly or
+            indirectly.
+        """
+        required = set()
+        unchecked = list(tasks)
+        while unchecked:
+            for task in cls.task_dependencies.get(unchecked.pop(), ()):
+                if task not in required:
+                    required.add(task)
+                    unchecked.append(task)
+        return required
+
     def get_filepath(self, filename):
         """Return the absolute path of the requested filename."""
         if Path(filename).is_absolute():
@@ -194,7 +288,7 @@ class NXDatabase:
             if not filepath.is_file():
                 raise NeXusError(f"'{filepath}' does not exist")
             self.session.add(File(filename=filename))
-            self.session.commit()
+            self.commit()
             f = self.sync_file(filename)
         else:
             if (f.entries is None or f.entries == ''
@@ -230,9 +324,8 @@ class NXDatabase:
         """
         if not self._task_in_group(group, task):
             return False
-        if any(t.name == task and t.entry == entry and
-               (t.subentry or '') == subentry and t.status == DONE
-               for t in f.tasks):
+        if self.find_tasks(f, task, entry, subentry).filter(
+                Task.status == DONE).first() is not None:
             return False
         nxprocess = self._get_nxprocess(group, task)
         t = Task(name=task, entry=entry, subentry=subentry, status=DONE,
@@ -248,7 +341,7 @@ class NXDatabase:
                         pass
             if 'pid' in nxprocess:
                 t.pid = int(nxprocess['pid'])
-        f.tasks.append(t)
+        self.session.add(t)
         return True
 
     def sync_file(self, filename):
@@ -313,7 +406,7 @@ class NXDatabase:
                 else:
                     setattr(f, task, IN_PROGRESS)
             f.set_entries(entries)
-            self.session.commit()
+            self.commit()
             self.sync_subentries(filename, root=root, f=f)
         return f
 
@@ -335,7 +428,7 @@ class NXDatabase:
             scan_dir = self.get_directory(filename)
             entries = f.get_entries()
             data = 0
-            if 'nxload' in [t.name for t in f.tasks]:
+            if self.find_tasks(f, 'nxload', subentry=None).first():
                 self.update_status(f, 'nxload')
             else:
                 for e in entries:
@@ -347,7 +440,7 @@ class NXDatabase:
                     f.nxload = DONE
                 else:
                     f.nxload = IN_PROGRESS
-            self.session.commit()
+            self.commit()
         return f
 
     def sync_subentries(self, filename, root=None, f=None):
@@ -405,7 +498,7 @@ class NXDatabase:
                 if self._append_task_from_group(f, root['entry'], task, 'entry'):
                     changed = True
         if changed:
-            self.session.commit()
+            self.commit()
 
     def get_task(self, f, task, entry, subentry=''):
         """Return the latest database entry for the specified task.
@@ -423,16 +516,74 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        for t in reversed(f.tasks):
-            if (t.name == task and t.entry == entry and
-                    (t.subentry or '') == subentry):
-                break
-        else:
+        t = self.latest_task(f, task, entry, subentry)
+        if t is None:
             # This task was started from command line
-            t = Task(name=task, entry=entry, subentry=subentry)
-            f.tasks.append(t)
+            t = Task(name=task, entry=entry, subentry=subentry,
+                     filename=f.filename)
+            self.session.add(t)
         return t
 
+    def find_tasks(self, f, task=None, entry=None, subentry=''):
+        """Return a query for the tasks recorded for a file.
+
+        Parameters
+        ----------
+        f : File
+            File object.
+        task : str, optional
+            Task name, by default None, which matches all tasks.
+        entry : str, optional
+            Entry name, by default None, which matches all entries.
+        subentry : str, optional
+            Subentry name, by default '' (entry-level tasks). If None,
+            tasks of all subentries are matched.
+
+        Returns
+        -------
+        Query
+            Query of the matching Task objects.
+        """
+        query = self.session.query(Task).filter(Task.filename == f.filename)
+        if task is not None:
+            query = query.filter(Task.name == task)
+        if entry is not None:
+            query = query.filter(Task.entry == entry)
+        if subentry is not None:
+            query = query.filter(func.coalesce(Task.subentry, '') == subentry)
+        return query
+
+    def latest_task(self, f, task, entry, subentry=''):
+        """Return the latest database entry for a task, or None."""
+        return self.find_tasks(f, task, entry, subentry).order_by(
+            Task.id.desc()).first()
+
+    def latest_status(self, f, tasks, subentry=''):
+        """Return the status of the latest entry for each task and entry.
+
+        Parameters
+        ----------
+        f : File
+            File object.
+        tasks : list of str
+            Names of the tasks.
+        subentry : str, optional
+            Subentry name, by default '' (entry-level tasks).
+
+        Returns
+        -------
+        dict
+            Mapping of (task, entry) to status integer for the tasks that
+            have been recorded.
+        """
+        latest = (select(func.max(Task.id))
+                  .where(Task.filename == f.filename, Task.name.in_(tasks),
+                         func.coalesce(Task.subentry, '') == subentry)
+                  .group_by(Task.name, Task.entry))
+        rows = self.session.query(Task.name, Task.entry, Task.status).filter(
+            Task.id.in_(latest))
+        return {(name, entry): status for name, entry, status in rows}
+
     def task_status(self, filename, task, entry=None, subentry=''):
         """Return the status of the task.
 
@@ -447,16 +598,11 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        with NXLock(self.database):
+        with self.transaction():
             f = self.get_file(filename)
             if entry:
-                for t in reversed(f.tasks):
-                    if (t.name == task and t.entry == entry and
-                            (t.subentry or '') == subentry):
-                        status = t.status
-                        break
-                else:
-                    status = NOT_STARTED
+                t = self.latest_task(f, task, entry, subentry)
+                status = NOT_STARTED if t is None else t.status
             else:
                 status = getattr(f, task)
         return status
@@ -478,16 +624,37 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        with NXLock(self.database):
-            f = self.get_file(filename)
-            t = self.get_task(f, task, entry, subentry)
-            t.status = QUEUED
-            if queue_time:
+        self.queue_tasks([(filename, task, entry, subentry)],
+                         queue_time=queue_time)
+
+    def queue_tasks(self, tasks, queue_time=None):
+        """Record that a set of tasks have been queued.
+
+        All the tasks are updated in a single transaction, and each file
+        is only synchronized with the wrapper file once.
+
+        Parameters
+        ----------
+        tasks : list of tuple
+            Each tuple contains the path of the wrapper file, the task,
+            the entry and, optionally, the subentry.
+        queue_time : datetime, optional
+            Time the tasks were queued, by default the current time.
+        """
+        if queue_time is None:
+            queue_time = datetime.datetime.now()
+        with self.transaction():
+            files = {}
+            for filename, task, entry, *subentry in tasks:
+                subentry = subentry[0] if subentry else ''
+                if filename not in files:
+                    files[filename] = self.get_file(filename)
+                f = files[filename]
+                t = self.get_task(f, task, entry, subentry)
+                t.status = QUEUED
                 t.queue_time = queue_time
-            else:
-                t.queue_time = datetime.datetime.now()
-            t.start_time = t.end_time = None
-            self.update_status(f, task, subentry)
+                t.start_time = t.end_time = None
+                self.update_status(f, task, subentry)
 
     def start_task(self, filename, task, entry, start_time=None, subentry=''):
         """Record that a task has begun execution.
@@ -503,7 +670,7 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        with NXLock(self.database):
+        with self.transaction():
             f = self.get_file(filename)
             t = self.get_task(f, task, entry, subentry)
             t.status = IN_PROGRESS
@@ -532,7 +699,7 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        with NXLock(self.database):
+        with self.transaction():
             f = self.get_file(filename)
             t = self.get_task(f, task, entry, subentry)
             t.status = DONE
@@ -556,13 +723,10 @@ class NXDatabase:
         subentry : str, optional
             Subentry name, by default '' (entry-level task).
         """
-        with NXLock(self.database):
+        with self.transaction():
             f = self.get_file(filename)
-            for t in reversed(f.tasks):
-                if (t.name == task and t.entry == entry and
-                        (t.subentry or '') == subentry):
-                    break
-            else:
+            t = self.latest_task(f, task, entry, subentry)
+            if t is None:
                 # No task recorded
                 return
             t.status = FAILED
@@ -575,7 +739,8 @@ class NXDatabase:
         """Update the File object with the status of the specified task.
 
         Subentry tasks are recorded in the Tasks table only; the Files table
-        columns reflect entry-level task status exclusively.
+        columns reflect entry-level task status exclusively. The changes
+        are committed when the enclosing transaction ends.
 
         Parameters
         ----------
@@ -587,21 +752,14 @@ class NXDatabase:
             Subentry name. When non-empty, skips updating the File columns.
         """
         if subentry:
-            self.session.commit()
             return
-        status = {}
         if (task == 'nxcombine' or task == 'nxmasked_combine' or
                 task == 'nxpdf' or task == 'nxmasked_pdf'):
             entries = ['entry']
         else:
             entries = f.get_entries()
-        for e in entries:
-            for t in reversed(f.tasks):
-                if t.name == task and t.entry == e and not (t.subentry or ''):
-                    status[e] = t.status
-                    break
-            else:
-                status[e] = NOT_STARTED
+        latest = self.latest_status(f, [task])
+        status = {e: latest.get((task, e), NOT_STARTED) for e in entries}
         if all(s == DONE for s in status.values()):
             setattr(f, task, DONE)
         elif FAILED in status.values():
@@ -617,7 +775,6 @@ class NXDatabase:
             setattr(f, task, IN_PROGRESS)
         else:
             setattr(f, task, NOT_STARTED)
-        self.session.commit()
 
     def get_subentries(self, filename):
         """Return a sorted list of subentry names recorded for this file.
@@ -630,7 +787,9 @@ class NXDatabase:
         f = self.query(self.get_filename(filename))
         if f is None:
             return []
-        return sorted({t.subentry for t in f.tasks if t.subentry})
+        rows = self.session.query(Task.subentry).filter(
+            Task.filename == f.filename, Task.subentry != '').distinct()
+        return sorted(subentry for subentry, in rows if subentry)
 
     def get_subentry_status(self, filename, subentry):
         """Return aggregated task status for a subentry across all entries.
@@ -647,11 +806,13 @@ class NXDatabase:
         dict
             Mapping of task name (nx-prefixed) to status integer.
         """
-        with NXLock(self.database):
+        with self.transaction():
             f = self.query(self.get_filename(filename))
             if f is None:
                 return {}
             entries = f.get_entries()
+            latest = self.latest_status(f, self.subentry_task_names,
+                                        subentry=subentry)
             result = {}
             for task in self.subentry_task_names:
                 if task in ('nxcombine', 'nxmasked_combine',
@@ -659,15 +820,8 @@ class NXDatabase:
                     check_entries = ['entry']
                 else:
                     check_entries = entries
-                status = {}
-                for e in check_entries:
-                    for t in reversed(f.tasks):
-                        if (t.name == task and t.entry == e and
-                                (t.subentry or '') == subentry):
-                            status[e] = t.status
-                            break
-                    else:
-                        status[e] = NOT_STARTED
+                status = {e: latest.get((task, e), NOT_STARTED)
+                          for e in check_entries}
                 if not status or all(s == NOT_STARTED for s in status.values()):
                     result[task] = NOT_STARTED
                 elif all(s == DONE for s in status.values()):
@@ -688,15 +842,15 @@ class NXDatabase:
     def update_file(self, filename):
         """Update the File object for the specified file.
 
-        This is just a wrapper for 'sync_file' that includes database file
-        locking.
+        This is just a wrapper for 'sync_file' that commits the changes
+        in a single transaction.
 
         Parameters
         ----------
         filename : str
             Path of wrapper file relative to GUP directory.
         """
-        with NXLock(self.database):
+        with self.transaction():
             self.sync_file(filename)
 
     def sync_db(self, sample_dir):
@@ -711,7 +865,7 @@ class NXDatabase:
         wrapper_files = [
             sample_dir / filename for filename in sample_dir.glob('*.nxs')
             if 'scans' not in filename.name and 'mask' not in filename.name]
-        with NXLock(self.database):
+        with self.transaction():
             for wrapper_file in wrapper_files:
                 self.sync_file(self.get_file(wrapper_file))
             tracked_files = list(self.session.query(File).all())
@@ -719,7 +873,6 @@ class NXDatabase:
                 if f.filename not in [
                         self.get_filename(w) for w in wrapper_files]:
                     self.session.delete(f)
-            self.session.commit()
 
     def check_tasks(self):
         """Check that all tasks are present, adding a column if necessary."""
@@ -736,6 +889,8 @@ class NXDatabase:
         task_columns = [col['name'] for col in inspector.get_columns('tasks')]
         if 'subentry' not in task_columns:
             self.add_column('subentry', table_name='tasks', data_type=String)
+        for index in Task.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
 
     def add_column(self, column_name, table_name='files',
                    data_type=Integer, default=None):
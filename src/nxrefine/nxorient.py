@@ -11,7 +11,6 @@ import numpy as np
 from numpy.linalg import inv, norm, det, lstsq
 from dataclasses import dataclass
 from scipy.signal import argrelextrema
-from itertools import combinations
 from .orient.niggli import make_Niggli_UB
 from .orient.orientedlattice import set_UB
 from .orient.scalar_utils import get_cells, remove_high_error_forms
@@ -228,14 +227,15 @@ class UBMatrixFFT:
         idx_factor: float
 
         """
-        proj = np.zeros(self.fft_num, dtype=np.float32)
-        for elem in data*idx_factor:
-            idx = math.floor(abs(elem))
-            if idx < self.fft_num:
-                proj[idx] += 1
-            else: # this should not happen, but trap it in case of rounding errors
-                proj[idx-1] += 1
-        return proj
+        idx = self._projection_indices(data, idx_factor)
+        return np.bincount(idx, minlength=self.fft_num).astype(np.float32)
+
+    def _projection_indices(self, data:np.ndarray, idx_factor:float) -> np.ndarray:
+        """return the histogram bins of the projected values"""
+        idx = np.floor(np.abs(data*idx_factor)).astype(np.intp)
+        # this should not happen, but trap it in case of rounding errors
+        idx[idx >= self.fft_num] -= 1
+        return idx
 
     def _projection_list_cal(self) -> None:
         """project onto all directions"""
@@ -245,8 +245,16 @@ class UBMatrixFFT:
         self._q_max = norm(self.q_vectors, axis=1).max() * 1.1
         idx_factor = self.fft_num / self._q_max
 
-        for i in range(self._p_list.shape[0]):
-            self._fj_list[i] += self._projection(self._p_list[i], idx_factor)
+        # histogram blocks of directions at once, using a single bincount
+        # over the flattened (direction, bin) indices of each block
+        n_dirs, n_peaks = self._p_list.shape
+        block = max(1, 4_000_000 // max(n_peaks, 1))
+        for start in range(0, n_dirs, block):
+            stop = min(start + block, n_dirs)
+            idx = self._projection_indices(self._p_list[start:stop], idx_factor)
+            idx += self.fft_num * np.arange(stop-start)[:, np.newaxis]
+            counts = np.bincount(idx.ravel(), minlength=(stop-start)*self.fft_num)
+            self._fj_list[start:stop] = counts.reshape(stop-start, self.fft_num)
 
     def _max_mag_fft_cal(self) -> None:
         """Geometry/Crystal/IndexingUtils::GetMagFFT"""
@@ -297,25 +305,17 @@ class UBMatrixFFT:
         if norm(dir) == 0:
             return 0
 
-        count = 0
-        for q in self.q_vectors:
-            proj_value = np.dot(dir, q)
-            error = abs(proj_value - round(proj_value))
-            if error <= self.tolerance:
-                count += 1
-        return count
+        proj_values = self.q_vectors @ dir
+        errors = np.abs(proj_values - np.round(proj_values))
+        return int(np.count_nonzero(errors <= self.tolerance))
 
     def _num_indexed_3D(self, a_dir:np.ndarray, b_dir:np.ndarray, c_dir:np.ndarray):
         """Geometry/Crystal/IndexingUtils::NumberIndexed_3D - line 2245 to 2263"""
         if norm(a_dir)==0 or norm(b_dir)==0 or norm(c_dir)==0:
             return 0
 
-        count = 0
-        for q in self.q_vectors:
-            hkl_vec = np.array([a_dir, b_dir, c_dir]) @ q
-            if self._valid_index(hkl_vec):
-                count += 1
-        return count
+        hkl_vecs = self.q_vectors @ np.array([a_dir, b_dir, c_dir]).T
+        return int(np.count_nonzero(self._valid_indices(hkl_vecs)))
 
     def _valid_index(self, hkl:np.ndarray) -> bool:
         """Geometry/Crystal/IndexingUtils::ValidIndex - line 2047 to 2052"""
@@ -323,6 +323,11 @@ class UBMatrixFFT:
             return False
         return (self._within_tol(hkl[0]) and self._within_tol(hkl[1]) and self._within_tol(hkl[2]))
 
+    def _valid_indices(self, hkls:np.ndarray) -> np.ndarray:
+        """vectorized version of _valid_index for the rows of an n x 3 array"""
+        nonzero = np.any(np.round(hkls, 4) != 0, axis=-1)
+        return nonzero & np.all(self._within_tols(hkls), axis=-1)
+
     def _within_tol(self, val:float) -> bool:
         """Geometry/Crystal/IndexingUtils::withinTol - line 2025 to 2032"""
         my_val = abs(val)
@@ -332,51 +337,42 @@ class UBMatrixFFT:
             return True
         return False
 
+    def _within_tols(self, vals:np.ndarray) -> np.ndarray:
+        """vectorized version of _within_tol"""
+        my_vals = np.abs(vals)
+        return (((my_vals - np.floor(my_vals)) < self.tolerance) |
+                ((np.floor(my_vals+1.) - my_vals) < self.tolerance))
+
     def _get_indexed_peaks_1D(self, dir:np.ndarray) -> tuple[int, list[int], list[np.ndarray]]:
         """Geometry/Crystal/IndexingUtils::GetIndexedPeaks_1D - line 2392 to 2420"""
-        num_indexed = 0
-        index_vals = []
-        indexed_qs = []
-
-        fit_error = 0
         if norm(dir) == 0:
             # special case, zero vector will NOT index any peaks, even
             # through dot product with Q vectors is always an integer!
             return 0
 
-        for q in self.q_vectors:
-            proj_value = np.dot(dir, q)
-            nearest_int = round(proj_value)
-            error = abs(proj_value - nearest_int)
-            if error < self.tolerance:
-                fit_error += error * error
-                indexed_qs.append(q)
-                index_vals.append(int(nearest_int))
-                num_indexed += 1
+        proj_values = self.q_vectors @ dir
+        nearest_ints = np.round(proj_values)
+        indexed = np.abs(proj_values - nearest_ints) < self.tolerance
+        index_vals = nearest_ints[indexed].astype(int).tolist()
+        indexed_qs = list(self.q_vectors[indexed])
 
-        return num_indexed, index_vals, indexed_qs
+        return len(index_vals), index_vals, indexed_qs
 
     def get_indexed_peaks(self) -> tuple[int, list[np.ndarray], list[np.ndarray], float]:
         """Geometry/Crystal/IndexingUtils::GetIndexedPeaks - line 2528 to 2568"""
-        num_indexed = 0
-        miller_indices = []
-        indexed_qs = []
-        fit_error = 0
-
         if self.check_UB():
             UB_inverse = inv(self._UB)
         else:
             raise RuntimeError("get_indexed_peaks(): The UB in get_indexed_peaks() is not valid")
 
-        for q in self.q_vectors:
-            hkl = UB_inverse @ q
-            if self._valid_index(hkl):
-                for i in range(3):
-                    error = hkl[i] - round(hkl[i])
-                    fit_error += error * error
-                indexed_qs.append(q)
-                miller_indices.append(np.array([round(hkl[0]), round(hkl[1]), round(hkl[2])]))
-                num_indexed += 1
+        hkls = self.q_vectors @ UB_inverse.T
+        indexed = self._valid_indices(hkls)
+        hkls = hkls[indexed]
+        nearest_ints = np.round(hkls)
+        fit_error = float(np.sum((hkls - nearest_ints)**2))
+        indexed_qs = list(self.q_vectors[indexed])
+        miller_indices = list(nearest_ints.astype(int))
+        num_indexed = len(indexed_qs)
 
         return num_indexed, miller_indices, indexed_qs, fit_error
 
@@ -447,22 +443,26 @@ class UBMatrixFFT:
         """Geometry/Crystal/IndexingUtils::FormUB_From_abc_Vectors line 1803 to 1857"""
         best = None
 
-        for a_temp, b_temp, c_temp in combinations(self._directions, 3):
-            vol = abs(np.dot(np.cross(a_temp, b_temp), c_temp))
-
-            if vol <= min_vol:
-                continue
-
-            num_indexed = self._num_indexed_3D(a_temp, b_temp, c_temp)
+        directions = np.array(self._directions)
+        if len(directions) < 3:
+            return False
+        for triples, num_indexed in self._indexed_triples(directions, min_vol):
             # requiring 20% more indexed with longer edge lengths, favors the smaller unit cells
-            if best is None or num_indexed > 1.2 * best[0]:
-                best = (num_indexed, a_temp, b_temp, c_temp)
+            start = 0
+            while True:
+                threshold = -np.inf if best is None else 1.2 * best[0]
+                better = np.flatnonzero(num_indexed[start:] > threshold)
+                if better.size == 0:
+                    break
+                start += better[0]
+                best = (num_indexed[start], triples[start])
+                start += 1
 
         if not best or best[0] <= 0:
             return False
 
         # force a, b, c to be right handed
-        _, a_dir, b_dir, c_dir = best
+        a_dir, b_dir, c_dir = directions[best[1]]
         if np.dot(np.cross(a_dir, b_dir), c_dir) < 0:
             c_dir = -c_dir
         # now build the UB from a, b, c
@@ -471,6 +471,49 @@ class UBMatrixFFT:
 
         return True
 
+    def _indexed_triples(self, directions:np.ndarray, min_vol:float,
+                         block_size:int=2_000_000):
+        """vectorized version of _num_indexed_3D for all direction triples
+
+        The triples are generated in the order of itertools.combinations,
+        one first direction at a time, and those with a cell volume not
+        greater than min_vol are discarded before the peaks are counted,
+        so only one block of triples is held in memory.
+
+        Parameters
+        ----------
+        directions: np.ndarray
+            m x 3 array of candidate directions
+        min_vol: float
+            minimum volume of the cell formed by a triple
+        block_size: int
+            maximum number of (peak, triple) pairs tested at once
+
+        Yields
+        ------
+        tuple of np.ndarray
+            n x 3 array of indices into the directions and the number
+            of peaks indexed by each triple
+        """
+        m = len(directions)
+        # projections of every peak onto every direction are shared by all triples
+        proj_values = self.q_vectors @ directions.T
+        within = self._within_tols(proj_values)
+        nonzero = np.round(proj_values, 4) != 0
+        step = max(1, block_size // self.q_vectors.shape[0])
+        for i in range(m - 2):
+            j, k = np.triu_indices(m - i - 1, 1)
+            j, k = j + i + 1, k + i + 1
+            vols = np.abs(np.sum(np.cross(directions[i], directions[j]) *
+                                 directions[k], axis=1))
+            j, k = j[vols > min_vol], k[vols > min_vol]
+            for start in range(0, len(j), step):
+                jb, kb = j[start:start+step], k[start:start+step]
+                valid = (within[:, [i]] & within[:, jb] & within[:, kb] &
+                         (nonzero[:, [i]] | nonzero[:, jb] | nonzero[:, kb]))
+                triples = np.column_stack((np.full(len(jb), i), jb, kb))
+                yield triples, np.count_nonzero(valid, axis=0)
+
     def _get_UB(self, a_dir:np.ndarray, b_dir:np.ndarray, c_dir:np.ndarray) -> bool:
         """Geometry/Crystal/OrientedLattice::GetUB line 1803 to 1857"""
         self._UB = np.array([a_dir, b_dir, c_dir])
@@ -17,6 +17,7 @@ from nexusformat.nexus import (NeXusError, NXdata, NXentry, NXfield, NXlink,
                                nxgetconfig, nxopen, nxsetconfig)
 
 from .nxrefine import NXRefine
+from .nxsettings import NXSettings
 from .nxsymmetry import NXSymmetry
 from .nxutils import init_julia, load_julia
 
@@ -43,6 +44,7 @@ class NXPDF:
                 raise NeXusError('Invalid Laue group specified')
         self.radius = radius
         self.qmax = qmax
+        self.server_settings = NXSettings().settings['server']
 
         self._logger = None
         self.julia = None
@@ -66,6 +68,20 @@ class NXPDF:
             self._logger.addHandler(fileHandler)
         return self._logger
 
+    @property
+    def worker_memory(self):
+        """Memory budget of each worker in bytes.
+
+        This is set by the 'memory' parameter in the server settings,
+        in GB. If it is not set, the budget is determined from the
+        available memory.
+        """
+        value = self.server_settings.get('memory')
+        try:
+            return float(value) * 1e9
+        except (TypeError, ValueError):
+            return None
+
     def add_title(self, data):
         title = []
         if 'chemical_formula' in self.entry['sample']:
@@ -135,7 +151,12 @@ class NXPDF:
         if self.symmetrize_data:
             symmetry = NXSymmetry(self.entry['transform'],
                                   laue_group=self.refine.laue_group)
-            symm_root['entry/data/data'] = symmetry.symmetrize(entries=True)
+            symm_root['entry/data/data'] = NXfield(
+                shape=self.entry['transform'].nxsignal.shape,
+                dtype=np.float64)
+            symmetry.symmetrize(entries=True,
+                                output=symm_root['entry/data/data'],
+                                memory=self.worker_memory)
         else:
             symm_root['entry/data/data'] = np.nan_to_num(
                 self.entry['transform'].nxsignal.nxvalue,
@@ -7,6 +7,7 @@
 # -----------------------------------------------------------------------------
 
 import datetime
+import hashlib
 import logging
 import operator
 import os
@@ -14,7 +15,9 @@ import platform
 import shutil
 import subprocess
 import sys
+import time
 import timeit
+from contextlib import contextmanager
 from pathlib import Path
 
 import h5py as h5
@@ -35,11 +38,17 @@ from .nxrefine import NXRefine
 from .nxserver import NXServer
 from .nxsettings import NXSettings
 from .nxsymmetry import NXSymmetry
-from .nxutils import (find_maximum_chunk, init_julia, load_julia,
-                       mask_volume, peak_search)
+from .nxutils import (NXMaskWriter, NXMetrics, chunk_ranges,
+                       copy_file_structure, default_process_count, dense_mask,
+                       find_maximum_chunk, find_maximum_slab, init_julia,
+                       load_julia, mask_volume, open_growing_file, peak_search,
+                       peak_search_slab, plan_chunks, read_frames,
+                       reduce_chunk, sum_chunk, summed_dtype, transform_chunk,
+                       unprocessed_ranges)
 
 QMIN_PIXEL_FRACTION = 0.3
 QMAX_PIXEL_FRACTION = 0.95
+PEAK_CHUNK_SIZE = 50
 
 
 def auto_transmission_q(refine, shape):
@@ -198,7 +207,7 @@ class NXReduce(QtCore.QObject):
             maxcount=False, find=False, refine=False, prepare=False,
             transform=False, combine=False, pdf=False,
             lattice=False, regular=False, mask=False, overwrite=False,
-            monitor_progress=True, gui=False, server=None):
+            resume=False, monitor_progress=True, gui=False, server=None):
 
         super(NXReduce, self).__init__()
 
@@ -258,6 +267,7 @@ class NXReduce(QtCore.QObject):
         self._mask_parameters = mask_parameters
 
         self._maximum = None
+        self._maximum_key = None
         self.summed_data = None
         self.Qh = Qh
         self.Qk = Qk
@@ -278,6 +288,7 @@ class NXReduce(QtCore.QObject):
         if not self.mask:
             self.regular = True
         self.overwrite = overwrite
+        self.resume = resume
         self.monitor_progress = monitor_progress
         self.gui = gui
         self._server = server
@@ -287,6 +298,7 @@ class NXReduce(QtCore.QObject):
         self.timer = {}
         self.start_time = {}
         self.queue_time = {}
+        self.metrics = {}
 
         self.summed_frames = None
         self.partial_frames = None
@@ -294,12 +306,17 @@ class NXReduce(QtCore.QObject):
 
         self._stopped = False
         self._process_count = None
+        self._checkpoint_time = None
+        self.live_peaks = None
+        self._following = False
 
         self._default = None
         self._db = None
         self._logger = None
         self._concurrent = None
         self._cctw = None
+        self._mask_storage = None
+        self._session = None
 
         nxsetconfig(lock=3600, lockexpiry=28800)
 
@@ -313,7 +330,8 @@ class NXReduce(QtCore.QObject):
 
     def __enter__(self):
         self._mode = self.root.nxfilemode
-        self.root.reload()
+        if self._session is None or self.root.is_modified():
+            self.root.reload()
         self.root.unlock()
         return self.root.__enter__()
 
@@ -327,6 +345,65 @@ class NXReduce(QtCore.QObject):
                 except Exception:
                     pass
 
+    @contextmanager
+    def session(self):
+        """Reduce the data with fewer accesses to the wrapper file.
+
+        Within a session, the wrapper file is only reloaded before
+        writing if it has been modified by another process, parameters
+        are cached after they are first read, and the NXprocess groups
+        and reduction parameters written by each task are deferred
+        until the task ends, when they are written together by `flush`.
+        Sessions may be nested, in which case only the outermost one has
+        any effect.
+        """
+        if self._session is not None:
+            yield self
+            return
+        self._session = {'parameters': {}, 'settings': {}, 'writes': []}
+        try:
+            yield self
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._session = None
+
+    def defer(self, write, *args):
+        """Write to the wrapper file now or, in a session, at the task end.
+
+        Parameters
+        ----------
+        write : callable
+            Function that writes to the wrapper file, which is open for
+            writing when it is called.
+        args
+            Arguments passed to the function.
+        """
+        if self._session is None:
+            with self:
+                write(*args)
+        else:
+            self._session['writes'].append((write, args))
+
+    def flush(self):
+        """Write the parameters and NXprocess groups deferred by a session.
+
+        The parent settings are written in one operation, followed by
+        the deferred writes to the wrapper file, within a single opening
+        of the file.
+        """
+        if self._session is None:
+            return
+        settings, self._session['settings'] = self._session['settings'], {}
+        writes, self._session['writes'] = self._session['writes'], []
+        if settings:
+            self.parent.write_settings(**settings)
+        if writes:
+            with self:
+                for write, args in writes:
+                    write(*args)
+
     @property
     def task_directory(self):
         """Directory containing log files and the reduction database."""
@@ -731,9 +808,12 @@ class NXReduce(QtCore.QObject):
         int, float, or str
             Value of the requested parameter.
         """
-        parameter = self.default.get(name)
         if field_name is None:
             field_name = name
+        if (self._session is not None
+                and field_name in self._session['parameters']):
+            return self._session['parameters'][field_name]
+        parameter = self.default.get(name)
         if self.parent:
             # Parent is canonical when present; do not fall back to the
             # wrapper's /entry/nxreduce (stale legacy state from before
@@ -747,6 +827,8 @@ class NXReduce(QtCore.QObject):
                 parameter = field.nxvalue
         elif f'entry/nxreduce/{field_name}' in self.root:
             parameter = self.root[f'entry/nxreduce/{field_name}'].nxvalue
+        if self._session is not None:
+            self._session['parameters'][field_name] = parameter
         return parameter
 
     def write_parameters(self, threshold=None, first=None, last=None,
@@ -807,23 +889,31 @@ class NXReduce(QtCore.QObject):
         if mask_h2 is not None:
             self.mask_parameters['mask_h2'] = int(mask_h2)
             params['mask_h2'] = self.mask_parameters['mask_h2']
+        if self._session is not None:
+            self._session['parameters'].update(params)
         if self.parent:
-            self.parent.write_settings(**params)
+            if self._session is not None:
+                self._session['settings'].update(params)
+            else:
+                self.parent.write_settings(**params)
         elif params:
-            with self:
-                if 'nxreduce' not in self.root['entry']:
-                    self.root['entry/nxreduce'] = NXparameters()
-                for key, value in params.items():
-                    self.root['entry/nxreduce'][key] = value
+            self.defer(self._write_parameters, params)
+
+    def _write_parameters(self, params):
+        if 'nxreduce' not in self.root['entry']:
+            self.root['entry/nxreduce'] = NXparameters()
+        for key, value in params.items():
+            self.root['entry/nxreduce'][key] = value
 
     def clear_parameters(self, parameters):
         """Remove legacy records of parameters in the 'peaks' group."""
-        with self:
-            target = self._get_reduce_target()
-            parameters.append('width')
-            for p in parameters:
-                if 'peaks' in target and p in target['peaks'].attrs:
-                    del target['peaks'].attrs[p]
+        self.defer(self._clear_parameters, parameters + ['width'])
+
+    def _clear_parameters(self, parameters):
+        target = self._get_reduce_target()
+        for p in parameters:
+            if 'peaks' in target and p in target['peaks'].attrs:
+                del target['peaks'].attrs[p]
 
     def consolidate(self, groups):
         """Build virtual datasets in the parent for NXdata groups.
@@ -1100,7 +1190,9 @@ class NXReduce(QtCore.QObject):
         """Return the command for the CCTW transform.
 
         The command is retrieved from the server settings if specified;
-        otherwise, a default value of 'cctw' is used.
+        otherwise, a default value of 'cctw' is used. If it is set to
+        'internal', the transforms are performed in-process by NumPy
+        without launching CCTW.
         """
 
         if self._cctw is None:
@@ -1111,6 +1203,29 @@ class NXReduce(QtCore.QObject):
                 self._cctw = 'cctw'
         return self._cctw
 
+    @property
+    def mask_storage(self):
+        """Return the storage format of the 3D mask.
+
+        This is set by the 'mask_storage' parameter in the server
+        settings. If it is 'compressed', the int8 mask is compressed
+        with gzip, which CCTW can still read. If it is 'packed', the
+        mask is also packed into bits along the last axis, so masked
+        transforms are performed in-process. Otherwise, the mask is
+        stored as an uncompressed int8 array.
+        """
+        if self._mask_storage is None:
+            value = self.server_settings.get('mask_storage')
+            if value in ['compressed', 'packed']:
+                self._mask_storage = value
+            else:
+                self._mask_storage = 'dense'
+        return self._mask_storage
+
+    @mask_storage.setter
+    def mask_storage(self, value):
+        self._mask_storage = value
+
     def complete(self, task):
         """True if the task for this entry in the wrapper file is done."""
         target = self.scan_entry
@@ -1174,10 +1289,14 @@ class NXReduce(QtCore.QObject):
             self._value = int(start)
             self.start.emit((0, 100))
         self.stopped = False
+        for metrics in self.metrics.values():
+            metrics.mark()
         return timeit.default_timer()
 
     def update_progress(self, i):
         """Update the progress counter."""
+        for metrics in self.metrics.values():
+            metrics.update()
         if self.gui:
             _value = int(i/self._step)
             if _value > self._value:
@@ -1214,15 +1333,134 @@ class NXReduce(QtCore.QObject):
 
     @property
     def process_count(self):
-        """Number of CPUs to be used in concurrent tasks."""
+        """Number of CPUs to be used in concurrent tasks.
+
+        If the task was started by the server, this is the number of
+        cores that the server granted it, which is passed in the
+        'NX_CORES' environment variable.
+        """
         if self._process_count is None:
-            pc = os.cpu_count()
-            if pc > 8:
-                self._process_count = pc // 2
-            else:
-                self._process_count = 4
+            try:
+                self._process_count = max(int(os.environ['NX_CORES']), 1)
+            except (KeyError, ValueError):
+                self._process_count = default_process_count()
         return self._process_count
 
+    @property
+    def worker_memory(self):
+        """Memory budget of each worker in bytes.
+
+        This is set by the 'memory' parameter in the server settings,
+        in GB. If it is not set, the budget is determined from the
+        available memory when chunks are planned.
+        """
+        value = self.server_settings.get('memory')
+        try:
+            return float(value) * 1e9
+        except (TypeError, ValueError):
+            return None
+
+    def plan_chunks(self, task, field=None, concurrent=None, minimum=1,
+                    maximum=None, overlap=0, copies=8, multiple=None):
+        """Return the number of frames to be processed in each chunk.
+
+        Parameters
+        ----------
+        task : str
+            Name of the task, used in the log
+        field : NXfield or h5py.Dataset, optional
+            3D data to be processed, by default the raw data
+        concurrent : bool, optional
+            True if the chunks are processed by concurrent workers, by
+            default the value of `self.concurrent`
+        minimum : int, optional
+            Minimum number of frames in a chunk, by default 1
+        maximum : int, optional
+            Maximum number of frames in a chunk, by default None
+        overlap : int, optional
+            Number of extra frames read on either side of each chunk, by
+            default 0
+        copies : float, optional
+            Size of the working arrays required for each frame in units
+            of the stored frame size, by default 8
+        multiple : int, optional
+            Number of frames that each chunk must be a multiple of, by
+            default None
+
+        Returns
+        -------
+        int
+            Number of frames in each chunk.
+        """
+        if field is None:
+            field = self.field
+        if concurrent is None:
+            concurrent = self.concurrent
+        workers = self.process_count if concurrent else 1
+        chunk_size = plan_chunks(field.shape, field.dtype,
+                                 chunks=field.chunks,
+                                 memory=self.worker_memory, workers=workers,
+                                 minimum=minimum, maximum=maximum,
+                                 overlap=overlap, copies=copies,
+                                 multiple=multiple)
+        frame_size = np.dtype(field.dtype).itemsize * np.prod(field.shape[1:])
+        slab_size = (chunk_size + 2 * overlap) * frame_size * copies / 1e6
+        self.log(f"{task}: {chunk_size} frames per chunk "
+                 f"(HDF5 chunks {field.chunks}, {workers} worker(s), "
+                 f"{slab_size:.0f} MB per worker)")
+        return chunk_size
+
+    def frame_ranges(self, first, last, size):
+        """Return the limits of chunks on a grid starting at `self.first`.
+
+        This is equivalent to `chunk_ranges`, except that the chunk
+        boundaries are offset by the first frame of the reduction rather
+        than being multiples of the chunk size.
+
+        Parameters
+        ----------
+        first : int
+            Index of the first frame
+        last : int
+            Index of the last frame (exclusive)
+        size : int
+            Number of frames in each chunk
+
+        Returns
+        -------
+        list of tuple of int
+            First and last (exclusive) frames of each chunk.
+        """
+        return [(i + self.first, j + self.first) for i, j
+                in chunk_ranges(first - self.first, last - self.first, size)]
+
+    def peak_ranges(self, first, last):
+        """Return the frame limits of each peak search.
+
+        Peaks are searched in chunks of `PEAK_CHUNK_SIZE` frames,
+        starting at `self.first`, so the peaks do not depend on the
+        memory or number of workers available. Each chunk is read with a
+        five-frame overlap on either side, and peaks at or beyond the
+        last frame are discarded.
+
+        Parameters
+        ----------
+        first : int
+            First frame to be searched
+        last : int
+            Last frame to be searched (exclusive)
+
+        Returns
+        -------
+        list of tuple of int
+            First and last frames read for each search, followed by the
+            limits of the frames of the peaks that are retained.
+        """
+        return [(i - min(5, i), min(stop+5, self.last+5, self.nframes),
+                 i, min(stop, self.last))
+                for i, stop in self.frame_ranges(first, last,
+                                                 PEAK_CHUNK_SIZE)]
+
     def record(self, task, **kwargs):
         """Record the completion of a task in the current entry.
 
@@ -1243,35 +1481,63 @@ class NXReduce(QtCore.QObject):
         note = NXnote(process, (f"Current machine: {platform.node()}\n" +
                                 f"Current directory: {self.directory}\n" +
                                 parameters))
-        with self:
-            target = self._get_reduce_target()
-            if 'nxworkflow' not in target:
-                target['nxworkflow'] = NXcollection()
-                workflow = target['nxworkflow']
-                existing = [name for name, item in target.entries.items()
-                            if isinstance(item, NXprocess)
-                            and 'program' in item]
-                for name in existing:
-                    target.move(name, workflow)
-            else:
-                workflow = target['nxworkflow']
-            if process in workflow:
-                del workflow[process]
-            workflow[process] = NXprocess(
-                program=f'{process}',
-                sequence_index=len(workflow.NXprocess) + 1,
-                version='nxrefine v' + __version__, note=note)
-            if task in self.queue_time:
-                workflow[process]['queue_time'] = (
-                    self.queue_time[task].isoformat())
-            if task in self.start_time:
-                workflow[process]['start_time'] = (
-                    self.start_time[task].isoformat())
-            workflow[process]['end_time'] = datetime.datetime.now().isoformat()
-            workflow[process]['pid'] = os.getpid()
-            workflow[process]['parameters'] = NXparameters()
-            for key in [k for k in kwargs if k in self.default]:
-                workflow[process]['parameters'][key] = kwargs[key]
+        times = {}
+        if task in self.queue_time:
+            times['queue_time'] = self.queue_time[task].isoformat()
+        if task in self.start_time:
+            times['start_time'] = self.start_time[task].isoformat()
+        times['end_time'] = datetime.datetime.now().isoformat()
+        parameters = {k: kwargs[k] for k in kwargs if k in self.default}
+        if task in self.metrics:
+            metrics = self.metrics[task].summary(workers=self.process_count)
+        else:
+            metrics = {}
+        self.defer(self._write_process, process, note, times, parameters,
+                   metrics)
+
+    def _write_process(self, process, note, times, parameters, metrics):
+        target = self._get_reduce_target()
+        if 'nxworkflow' not in target:
+            target['nxworkflow'] = NXcollection()
+            workflow = target['nxworkflow']
+            existing = [name for name, item in target.entries.items()
+                        if isinstance(item, NXprocess)
+                        and 'program' in item]
+            for name in existing:
+                target.move(name, workflow)
+        else:
+            workflow = target['nxworkflow']
+        if process in workflow:
+            del workflow[process]
+        workflow[process] = NXprocess(
+            program=f'{process}',
+            sequence_index=len(workflow.NXprocess) + 1,
+            version='nxrefine v' + __version__, note=note)
+        for key, value in times.items():
+            workflow[process][key] = value
+        workflow[process]['pid'] = os.getpid()
+        workflow[process]['parameters'] = NXparameters()
+        for key, value in parameters.items():
+            workflow[process]['parameters'][key] = value
+        if metrics:
+            workflow[process]['metrics'] = NXcollection()
+            for key, (value, units) in metrics.items():
+                workflow[process]['metrics'][key] = NXfield(value,
+                                                            units=units)
+
+    def record_chunk(self, elapsed):
+        """Add the time taken to process a chunk to the task metrics.
+
+        This is the timer passed to NXExecutor, so it is called from the
+        executor's management thread.
+
+        Parameters
+        ----------
+        elapsed : float
+            Time taken by a worker to process the chunk in seconds.
+        """
+        for metrics in list(self.metrics.values()):
+            metrics.add_chunk_time(elapsed)
 
     def record_start(self, task):
         """Record that a task has started in the database """
@@ -1281,12 +1547,15 @@ class NXReduce(QtCore.QObject):
                                subentry=self.subentry_name)
             self.start_time[task] = datetime.datetime.now()
             self.timer[task] = timeit.default_timer()
+            self.metrics[task] = NXMetrics()
             self.log(f"{self.name}: '{task}' started")
         except Exception as error:
             self.log(str(error))
 
     def record_end(self, task):
         """Record that a task has ended in the database """
+        self.stop_metrics(task)
+        self.flush()
         try:
             self.db.end_task(self.wrapper_file, task, self.entry_name,
                              subentry=self.subentry_name)
@@ -1298,6 +1567,11 @@ class NXReduce(QtCore.QObject):
 
     def record_fail(self, task):
         """Record that a task has failed in the database """
+        self.stop_metrics(task)
+        try:
+            self.flush()
+        except Exception as error:
+            self.log(str(error))
         try:
             self.db.fail_task(self.wrapper_file, task, self.entry_name,
                               subentry=self.subentry_name)
@@ -1306,6 +1580,11 @@ class NXReduce(QtCore.QObject):
         except Exception as error:
             self.log(str(error))
 
+    def stop_metrics(self, task):
+        """Stop measuring the resources used by a task."""
+        if task in self.metrics:
+            self.metrics.pop(task).stop()
+
     def nxload(self):
         """Perform nxload operation in the workflow.
 
@@ -1418,8 +1697,19 @@ class NXReduce(QtCore.QObject):
             self.log("No raw data loaded")
 
     def nxmax(self):
-        """Find the maximum counts in the data."""
-        if self.not_processed('nxmax') and self.maxcount:
+        """Find the maximum counts in the data.
+
+        If `resume` is True, frames that were processed by a previous
+        run that failed or was interrupted, as recorded in the checkpoint
+        file, are not processed again. The checkpoint is also written
+        while following a scan, so the frame sums are extended to the
+        frames added since the last poll. If nxmax has already been
+        completed, the stored sums are only extended to frames beyond
+        the previous last frame, and nothing is done if there are none.
+        """
+        resume = (self.resume
+                  and self.maximum_frames() != (self.first, self.last))
+        if (self.not_processed('nxmax') or resume) and self.maxcount:
             if not self.raw_data_exists():
                 self.log("Data file not available")
                 return
@@ -1438,6 +1728,7 @@ class NXReduce(QtCore.QObject):
                                 first_frame=self.first, last_frame=self.last,
                                 qmin=self.qmin)
                     self.record_end('nxmax')
+                    self.remove_maximum_checkpoint()
             except Exception as error:
                 self.log(str(error))
                 self.record_fail('nxmax')
@@ -1445,27 +1736,16 @@ class NXReduce(QtCore.QObject):
         elif self.maxcount:
             self.log("Maximum counts already found")
 
-    def find_maximum(self):
-        """
-        Find the maximum counts in the data.
+    def prepare_maximum(self):
+        """Return the masks and indices used to find the maximum counts.
 
-        This method reads the data file in chunks of a specified size
-        (default is 50 frames) and finds the maximum counts in each
-        chunk. The chunk with the maximum counts is kept and the process
-        is repeated until the maximum counts are found or the end of the
-        file is reached. The maximum counts are then written to the
-        'maximum' field of the 'data' group in the entry.
-
-        If the gui flag is set, the result is emitted as a signal.
+        Constantly-firing pixels, identified from the first ten frames,
+        are added to the pixel mask.
 
-        A message is logged to indicate that the maximum counts have been
-        found.
+        Returns
+        -------
+        tuple of (pixel_mask, transmission_mask, sub_idx, n_keep, scale)
         """
-        self.log("Finding maximum counts")
-
-        chunk_size = self.field.chunks[0]
-        if chunk_size < 20:
-            chunk_size = 50
         pixel_mask = self.pixel_mask
         with self.field.nxfile:
             data = self.field.nxfile[self.raw_path]
@@ -1500,68 +1780,116 @@ class NXReduce(QtCore.QObject):
         peak_fraction = 0.1
         n_keep = max(1, int((1.0 - peak_fraction) * n_sub))
         scale = n_annulus / n_keep
+        return pixel_mask, transmission_mask, sub_idx, n_keep, scale
 
-        fsum = np.zeros(self.nframes, dtype=np.float64)
-        psum = np.zeros(self.nframes, dtype=np.float64)
-        maximum = 0.0
-        vsum = None
+    def find_maximum(self):
+        """
+        Find the maximum counts in the data.
+
+        This method reads the data file in chunks, whose size is chosen
+        by `plan_chunks`, and finds the maximum counts in each chunk. The
+        chunk with the maximum counts is kept and the process is repeated
+        until the maximum counts are found or the end of the file is
+        reached. The maximum counts are then written to the
+        'maximum' field of the 'data' group in the entry.
+
+        The running sums are saved to a checkpoint file at chunk
+        boundaries. If `resume` is True, the sums are restored from the
+        checkpoint and only the remaining frames are processed. The
+        checkpoint is removed once nxmax has been recorded, so it is
+        only kept if the task fails or is interrupted.
+
+        If the gui flag is set, the result is emitted as a signal.
+
+        A message is logged to indicate that the maximum counts have been
+        found.
+        """
+        self.log("Finding maximum counts")
+
+        chunk_size = self.plan_chunks('nxmax', minimum=20, copies=4)
+        (pixel_mask, transmission_mask,
+         sub_idx, n_keep, scale) = self.prepare_maximum()
+        key = self.maximum_key(pixel_mask, transmission_mask, sub_idx,
+                               n_keep)
+
+        self._maximum_key = key
+
+        state = None
+        if self.resume or self._following:
+            state = self.read_maximum_checkpoint(key)
+            if state is None:
+                state = self.read_maximum_results(key)
+        if state is None:
+            state = {'vsum': None, 'maximum': 0.0,
+                     'fsum': np.zeros(self.nframes, dtype=np.float64),
+                     'psum': np.zeros(self.nframes, dtype=np.float64),
+                     'done': np.zeros(self.nframes, dtype=bool)}
+        fsum, psum, done = state['fsum'], state['psum'], state['done']
+        ranges = unprocessed_ranges(done, self.first, self.last, chunk_size)
         tic = self.start_progress(self.first, self.last)
 
         if self.concurrent:
             # --- Concurrent branch ---
             from nxrefine.nxutils import NXExecutor, as_completed
-            # Use a larger chunk for workers to amortise IPC overhead,
-            # especially when the stored HDF5 chunk size is 1 frame.
-            worker_chunk_size = max(chunk_size, 100)
+            shared = {'pixel_mask': pixel_mask,
+                      'transmission_mask': transmission_mask,
+                      'sub_idx': sub_idx, 'n_keep': n_keep, 'scale': scale}
             with NXExecutor(max_workers=self.process_count,
-                            mp_context=self.concurrent) as executor:
+                            mp_context=self.concurrent,
+                            timer=self.record_chunk,
+                            data_file=self.field.nxfilename,
+                            data_path=self.field.nxfilepath,
+                            shared=shared) as executor:
                 futures = []
-                for i in range(self.first, self.last, worker_chunk_size):
-                    k = min(i + worker_chunk_size, self.last)
+                for i, k in ranges:
                     futures.append(executor.submit(
                         find_maximum_chunk,
                         self.field.nxfilename, self.field.nxfilepath,
-                        i, i, k,
-                        pixel_mask, transmission_mask,
-                        sub_idx, n_keep, scale))
+                        i, i, k))
                 for future in as_completed(futures):
                     chunk_i, lv, lf, lp, lmax = future.result()
-                    vsum = lv if vsum is None else vsum + lv
+                    state['vsum'] = (lv if state['vsum'] is None
+                                     else state['vsum'] + lv)
                     n = lf.shape[0]
                     fsum[chunk_i:chunk_i + n] = lf
                     psum[chunk_i:chunk_i + n] = lp
-                    if lmax > maximum:
-                        maximum = lmax
+                    if lmax > state['maximum']:
+                        state['maximum'] = lmax
+                    done[chunk_i:chunk_i + n] = True
+                    self.write_maximum_checkpoint(state, key)
                     self.update_progress(chunk_i)
                     futures.remove(future)
         else:
             # --- Sequential branch ---
             with self.field.nxfile:
                 data = self.field.nxfile[self.raw_path]
-                for i in range(self.first, self.last, chunk_size):
+                for i, k in ranges:
                     if self.stopped:
+                        self.write_maximum_checkpoint(state, key, force=True)
                         return None
                     self.update_progress(i)
-                    try:
-                        v_raw = data[i:i+chunk_size, :, :]
-                    except IndexError:
-                        pass
-                    vsum = (v_raw.sum(0, dtype=np.float64) if vsum is None
-                            else vsum + v_raw.sum(0))
+                    v_raw = data[i:k, :, :]
+                    state['vsum'] = (v_raw.sum(0, dtype=np.float64)
+                                     if state['vsum'] is None
+                                     else state['vsum'] + v_raw.sum(0))
                     vflat = v_raw.reshape(v_raw.shape[0], -1)
                     sub_vals = vflat[:, sub_idx]
                     trimmed = np.partition(sub_vals, n_keep, axis=1)[:,:n_keep]
-                    psum[i:i+chunk_size] = trimmed.sum(axis=1) * scale
+                    psum[i:k] = trimmed.sum(axis=1) * scale
                     v = np.ma.masked_array(v_raw)
                     v.mask = pixel_mask
-                    fsum[i:i+chunk_size] = v.sum((1, 2))
+                    fsum[i:k] = v.sum((1, 2))
                     v.mask = pixel_mask | transmission_mask
-                    if maximum < v.max():
-                        maximum = v.max()
+                    if state['maximum'] < v.max():
+                        state['maximum'] = v.max()
+                    done[i:k] = True
+                    self.write_maximum_checkpoint(state, key)
                     del v, v_raw, vflat, sub_vals, trimmed
+        self.write_maximum_checkpoint(state, key, force=True)
 
+        maximum = state['maximum']
         self.pixel_mask = pixel_mask
-        vsum = np.ma.masked_array(vsum, mask=pixel_mask)
+        vsum = np.ma.masked_array(state['vsum'], mask=pixel_mask)
         self.maximum = maximum
         self.summed_data = NXfield(vsum, name='summed_data')
         self.summed_frames = NXfield(fsum, name='summed_frames')
@@ -1572,6 +1900,184 @@ class NXReduce(QtCore.QObject):
                             self.summed_data, self.summed_frames,
                             self.partial_frames)
 
+    @property
+    def maximum_checkpoint(self):
+        """Path to the file containing the running sums of nxmax."""
+        return self.scan_directory.joinpath(
+            self.entry_name+'_maximum_checkpoint.npz')
+
+    def maximum_key(self, pixel_mask, transmission_mask, sub_idx, n_keep):
+        """Return a key identifying the masks used to find the maximum.
+
+        A checkpoint is only used if it was saved with the same key, so
+        that sums computed with different masks are not combined.
+        """
+        digest = hashlib.sha1()
+        digest.update(str((self.shape[1:], n_keep)).encode())
+        for array in (pixel_mask, transmission_mask, sub_idx):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def read_maximum_checkpoint(self, key):
+        """Read the running sums saved by a previous nxmax run.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `maximum_key` for the current masks
+
+        Returns
+        -------
+        dict or None
+            The sums, maximum and processed frames, or None if there is
+            no valid checkpoint. The frame arrays are extended if frames
+            have been added to the raw data.
+        """
+        if not self.maximum_checkpoint.exists():
+            return None
+        try:
+            with np.load(self.maximum_checkpoint) as checkpoint:
+                if str(checkpoint['key']) != key:
+                    self.log(f"'{self.maximum_checkpoint.name}' was saved "
+                             "with different masks and is ignored")
+                    return None
+                state = {name: checkpoint[name] for name in
+                         ('vsum', 'fsum', 'psum', 'done')}
+                state['maximum'] = checkpoint['maximum'].item()
+        except Exception as error:
+            self.log(f"Unable to read '{self.maximum_checkpoint.name}': "
+                     f"{error}")
+            return None
+        if not state['done'].any():
+            state['vsum'] = None
+        self.log(f"Resuming from {state['done'].sum()} processed frames "
+                 f"in '{self.maximum_checkpoint.name}'")
+        return self.resize_maximum_state(state)
+
+    def maximum_frames(self):
+        """Return the frame range used by a completed nxmax run.
+
+        Returns
+        -------
+        tuple of int or None
+            The first and last frames stored with the maximum counts, or
+            None if they have not been stored.
+        """
+        try:
+            return (int(self.data.attrs['first']),
+                    int(self.data.attrs['last']))
+        except (AttributeError, KeyError, TypeError):
+            return None
+
+    def read_maximum_results(self, key):
+        """Read the sums stored by a completed nxmax run.
+
+        The checkpoint is removed when nxmax is recorded, so the stored
+        results are used to resume a completed run, e.g., when frames
+        have been added to the raw data.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `maximum_key` for the current masks
+
+        Returns
+        -------
+        dict or None
+            The sums, maximum and processed frames, or None if there are
+            no stored results that were saved with the same masks and
+            start at the current first frame, and end at or before the
+            current last frame.
+        """
+        frames = self.maximum_frames()
+        target = self.scan_entry
+        if frames is None or target is None or 'frame_sums' not in target:
+            return None
+        frame_sums = target['frame_sums']
+        if 'maximum_key' not in frame_sums.attrs:
+            return None
+        elif frame_sums.attrs['maximum_key'] != key:
+            self.log("Stored maximum counts were found with different "
+                     "masks and are recomputed")
+            return None
+        first, last = frames
+        if first != self.first or last > self.last:
+            self.log(f"Stored maximum counts used frames {first} to "
+                     f"{last} and are recomputed")
+            return None
+        state = {'maximum': self.data.attrs['maximum'],
+                 'done': np.zeros(last, dtype=bool)}
+        for name, path in (('vsum', 'summed_data/summed_data'),
+                           ('fsum', 'summed_frames/summed_frames'),
+                           ('psum', 'summed_frames/partial_frames')):
+            state[name] = np.ma.getdata(
+                frame_sums[path].nxvalue).astype(np.float64)
+        state['done'][first:last] = True
+        self.log(f"Resuming from {last - first} processed frames in the "
+                 "stored maximum counts")
+        return self.resize_maximum_state(state)
+
+    def resize_maximum_state(self, state):
+        """Resize the frame arrays of the nxmax sums to the raw data.
+
+        Frames that have been added to the raw data are marked as not
+        processed.
+
+        Parameters
+        ----------
+        state : dict
+            The sums, maximum and processed frames
+
+        Returns
+        -------
+        dict
+            The sums with frame arrays of length `nframes`.
+        """
+        for name in ('fsum', 'psum', 'done'):
+            array = np.zeros(self.nframes, dtype=state[name].dtype)
+            n = min(self.nframes, state[name].size)
+            array[:n] = state[name][:n]
+            state[name] = array
+        return state
+
+    def write_maximum_checkpoint(self, state, key, force=False):
+        """Save the running sums of nxmax to the checkpoint file.
+
+        The file is written at most every 30 seconds, unless `force` is
+        True, and replaced atomically, so that an interrupted write
+        leaves the previous checkpoint intact.
+
+        Parameters
+        ----------
+        state : dict
+            The sums, maximum and processed frames
+        key : str
+            Key returned by `maximum_key` for the current masks
+        force : bool, optional
+            True if the file is to be written immediately
+        """
+        now = timeit.default_timer()
+        if self._checkpoint_time is None:
+            self._checkpoint_time = now
+        if state['vsum'] is None or not (
+                force or now - self._checkpoint_time > 30):
+            return
+        checkpoint = self.maximum_checkpoint
+        temporary = checkpoint.with_name(checkpoint.stem + '_tmp.npz')
+        np.savez(temporary, key=key, vsum=state['vsum'], fsum=state['fsum'],
+                 psum=state['psum'], done=state['done'],
+                 maximum=state['maximum'])
+        os.replace(temporary, checkpoint)
+        self._checkpoint_time = now
+
+    def remove_maximum_checkpoint(self):
+        """Remove the nxmax checkpoint after the task is recorded."""
+        try:
+            self.maximum_checkpoint.unlink(missing_ok=True)
+        except OSError as error:
+            self.log(f"Unable to remove '{self.maximum_checkpoint.name}': "
+                     f"{error}")
+
     def write_maximum(self):
         """
         Write the maximum counts and the summed data to the file.
@@ -1601,6 +2107,8 @@ class NXReduce(QtCore.QObject):
             frame_sums['summed_frames'] = NXdata(self.summed_frames,
                                                  self.data.nxaxes[0])
             frame_sums['summed_frames/partial_frames'] = self.partial_frames
+            if self._maximum_key is not None:
+                frame_sums.attrs['maximum_key'] = self._maximum_key
             self.calculate_radial_sums()
             frame_sums['transmission'] = transmission
             for legacy in ('summed_data', 'summed_frames', 'radial_sum'):
@@ -1891,9 +2399,11 @@ class NXReduce(QtCore.QObject):
         """
         Find peaks in the data.
 
-        This function reads the data file in chunks of 50 frames at a
-        time and finds peaks in each chunk. The peaks are stored in a
-        list, sorted by frame number.
+        This function reads the data file in the chunks defined by
+        `peak_ranges` and finds peaks in each chunk. The peaks are stored
+        in a list, sorted by frame number. Frames whose peaks were
+        already found by `follow` are not searched again, apart from the
+        chunk containing the last frame.
 
         If the gui flag is set, the function emits a result signal with
         the list of peaks.
@@ -1904,35 +2414,49 @@ class NXReduce(QtCore.QObject):
             A list of peaks, sorted by frame number.
         """
         self.log("Finding peaks")
-        tic = self.start_progress(self.first, self.last)
         self.blobs = []
+        start = self.first
+        if self.live_peaks is not None:
+            live_blobs, start = self.live_peaks
+            last_chunk = self.frame_ranges(self.last, self.last+1,
+                                           PEAK_CHUNK_SIZE)[0][0]
+            start = max(min(start, last_chunk), self.first)
+            self.blobs = [b for b in live_blobs if b.z >= self.first
+                          and b.z < start]
+        ranges = self.peak_ranges(start, self.last+1)
+        tic = self.start_progress(self.first, self.last)
         if self.concurrent:
             from nxrefine.nxutils import NXExecutor, as_completed
+            shared = {'pixel_mask': self.pixel_mask,
+                      'threshold': self.threshold,
+                      'min_pixels': self.min_pixels}
             with NXExecutor(max_workers=self.process_count,
-                            mp_context=self.concurrent) as executor:
+                            mp_context=self.concurrent,
+                            timer=self.record_chunk,
+                            data_file=self.field.nxfilename,
+                            data_path=self.field.nxfilepath,
+                            shared=shared) as executor:
                 futures = []
-                for i in range(self.first, self.last+1, 50):
-                    j, k = i - min(5, i), min(i+55, self.last+5, self.nframes)
+                stops = {}
+                for j, k, i, stop in ranges:
+                    stops[i] = stop
                     futures.append(executor.submit(
                         peak_search,
                         self.field.nxfilename, self.field.nxfilepath,
-                        i, j, k, self.threshold, mask=self.pixel_mask,
-                        min_pixels=self.min_pixels))
+                        i, j, k))
                 for future in as_completed(futures):
                     z, blobs = future.result()
                     self.blobs += [b for b in blobs if b.z >= z
-                                   and b.z < min(z+50, self.last)]
+                                   and b.z < stops[z]]
                     self.update_progress(z)
                     futures.remove(future)
         else:
-            for i in range(self.first, self.last+1, 50):
-                j, k = i - min(5, i), min(i+55, self.last+5, self.nframes)
+            for j, k, i, stop in ranges:
                 z, blobs = peak_search(
                     self.field.nxfilename, self.field.nxfilepath,
                     i, j, k, self.threshold, mask=self.pixel_mask,
                     min_pixels=self.min_pixels)
-                self.blobs += [b for b in blobs if b.z >= z
-                               and b.z < min(z+50, self.last)]
+                self.blobs += [b for b in blobs if b.z >= z and b.z < stop]
                 self.update_progress(z)
 
         peaks = sorted([b for b in self.blobs], key=operator.attrgetter('z'))
@@ -1964,15 +2488,12 @@ class NXReduce(QtCore.QObject):
         - Finally, it clears the 'threshold', 'first', and 'last'
           parameters from the instance.
         """
+        names = ['intensity', 'x', 'y', 'z', 'sigx', 'sigy', 'sigz']
+        table = np.array([[getattr(peak, name) for name in names]
+                          for peak in peaks], dtype=float).reshape(-1, 7)
         group = NXreflections()
-        group['intensity'] = NXfield([peak.intensity for peak in peaks],
-                                     dtype=float)
-        group['x'] = NXfield([peak.x for peak in peaks], dtype=float)
-        group['y'] = NXfield([peak.y for peak in peaks], dtype=float)
-        group['z'] = NXfield([peak.z for peak in peaks], dtype=float)
-        group['sigx'] = NXfield([peak.sigx for peak in peaks], dtype=float)
-        group['sigy'] = NXfield([peak.sigy for peak in peaks], dtype=float)
-        group['sigz'] = NXfield([peak.sigz for peak in peaks], dtype=float)
+        for i, name in enumerate(names):
+            group[name] = NXfield(table[:, i])
         group.attrs['first'] = self.first
         group.attrs['last'] = self.last
         group.attrs['threshold'] = self.threshold
@@ -2207,49 +2728,92 @@ class NXReduce(QtCore.QObject):
         elif self.prepare:
             self.log("3D Mask already prepared")
 
+    def create_mask(self):
+        """Create a temporary file to contain the 3D mask.
+
+        The mask is stored according to `mask_storage`, except in the
+        GUI, where it is always dense so that it can be plotted.
+        """
+        mask_root = nxopen(self.mask_file.with_suffix('.h5'), 'w')
+        mask_root['entry'] = NXentry()
+        storage = 'dense' if self.gui else self.mask_storage
+        shape, dtype, chunks = self.shape, np.int8, self.field.chunks
+        if storage == 'packed':
+            shape = shape[:-1] + ((shape[-1] + 7) // 8,)
+            dtype = np.uint8
+            if chunks:
+                chunks = chunks[:-1] + (shape[-1],)
+        if storage == 'dense':
+            compression = None
+        else:
+            compression, chunks = 'gzip', chunks or True
+        mask_root['entry/mask'] = NXfield(shape=shape, dtype=dtype,
+                                          chunks=chunks,
+                                          compression=compression,
+                                          fillvalue=0)
+        if storage == 'packed':
+            mask_root['entry/mask'].attrs['packing'] = 'bits'
+            mask_root['entry/mask'].attrs['width'] = self.shape[-1]
+        return mask_root
+
     def prepare_mask(self):
-        """Prepare 3D mask"""
+        """Prepare 3D mask.
+
+        The raw data are divided into slabs, aligned with the HDF5
+        chunks, which do not overlap. The interior of each slab is
+        masked by the workers, while the frames at the slab boundaries
+        are completed by a single NXMaskWriter in this process, which
+        is the only one to write to the mask file.
+        """
         tic = self.start_progress(self.first, self.last)
         t1 = self.mask_parameters['mask_t1']
         h1 = self.mask_parameters['mask_h1']
         t2 = self.mask_parameters['mask_t2']
         h2 = self.mask_parameters['mask_h2']
 
-        mask_root = nxopen(self.mask_file.with_suffix('.h5'), 'w')
-        mask_root['entry'] = NXentry()
-        mask_root['entry/mask'] = NXfield(shape=self.shape,
-                                          dtype=np.int8,
-                                          chunks=self.field.chunks,
-                                          fillvalue=0)
-
-        if self.concurrent:
-            from nxrefine.nxutils import NXExecutor, as_completed
-            with NXExecutor(max_workers=self.process_count,
-                            mp_context=self.concurrent) as executor:
-                futures = []
-                for i in range(self.first, self.last+1, 10):
-                    j, k = i - min(1, i), min(i+11, self.last+1, self.nframes)
-                    futures.append(executor.submit(
-                        mask_volume,
-                        self.field.nxfilename, self.field.nxfilepath,
-                        mask_root.nxfilename, 'entry/mask', i, j, k,
-                        self.pixel_mask, t1, h1, t2, h2))
-                for future in as_completed(futures):
-                    k = future.result()
-                    self.update_progress(k)
-                    futures.remove(future)
-        else:
-            for i in range(self.first, self.last+1, 10):
-                j, k = i - min(1, i), min(i+11, self.last+1, self.nframes)
-                k = mask_volume(self.field.nxfilename, self.field.nxfilepath,
-                                mask_root.nxfilename, 'entry/mask', i, j, k,
-                                self.pixel_mask, t1, h1, t2, h2)
-                self.update_progress(k)
+        mask_root = self.create_mask()
+        chunk_size = self.plan_chunks('nxprepare', copies=4)
+        ranges = chunk_ranges(self.first, self.last+1, chunk_size)
 
-        frame_mask = np.ones(shape=self.shape[1:], dtype=np.int8)
         with mask_root.nxfile:
-            mask_root['entry/mask'][:self.first] = frame_mask
-            mask_root['entry/mask'][self.last+1:] = frame_mask
+            mask = dense_mask(mask_root['entry/mask'])
+            writer = NXMaskWriter(mask, self.pixel_mask,
+                                  self.mask_parameters)
+            if self.first > 0:
+                writer.add_frame(self.first-1, read_frames(
+                    self.field.nxfilename, self.field.nxfilepath,
+                    self.first-1, self.first)[0])
+            if self.concurrent:
+                from nxrefine.nxutils import NXExecutor, as_completed
+                with NXExecutor(max_workers=self.process_count,
+                                mp_context=self.concurrent,
+                                timer=self.record_chunk,
+                                data_file=self.field.nxfilename,
+                                data_path=self.field.nxfilepath,
+                                shared={'pixel_mask': self.pixel_mask}
+                                ) as executor:
+                    futures = []
+                    for i, j in ranges:
+                        futures.append(executor.submit(
+                            mask_volume,
+                            self.field.nxfilename, self.field.nxfilepath,
+                            i, j, None, t1, h1, t2, h2))
+                    for future in as_completed(futures):
+                        i, j, mask_slab, edges = future.result()
+                        writer.add(i, j, mask_slab, edges)
+                        self.update_progress(i)
+                        futures.remove(future)
+            else:
+                for i, j in ranges:
+                    i, j, mask_slab, edges = mask_volume(
+                        self.field.nxfilename, self.field.nxfilepath, i, j,
+                        self.pixel_mask, t1, h1, t2, h2)
+                    writer.add(i, j, mask_slab, edges)
+                    self.update_progress(i)
+
+            frame_mask = np.ones(shape=self.shape[1:], dtype=np.int8)
+            mask[:self.first] = frame_mask
+            mask[self.last+1:] = frame_mask
 
         toc = self.stop_progress()
 
@@ -2272,6 +2836,187 @@ class NXReduce(QtCore.QObject):
                 target_data['data_mask'] = NXlink('entry/mask', self.mask_file)
         self.log(f"3D Mask written to '{self.mask_file}'")
 
+    @property
+    def fused(self):
+        """True if nxmax, nxfind and nxprepare can be run in one pass."""
+        return (self.maxcount and self.find and self.prepare
+                and not self.gui and not self.resume
+                and not self._following
+                and self.not_processed('nxmax')
+                and self.not_processed('nxfind')
+                and self.not_processed('nxprepare_mask'))
+
+    def nxfused(self):
+        """Find the maximum counts, peaks and 3D mask in a single pass.
+
+        This is equivalent to running nxmax, nxfind and nxprepare in
+        turn, but each frame of the raw data is only read once. The
+        tasks are recorded separately, so that subsequent tasks are
+        unaware that they were run together.
+        """
+        if not self.raw_data_exists():
+            self.log("Data file not available")
+            return
+        tasks = ['nxmax', 'nxfind', 'nxprepare']
+        for task in tasks:
+            self.record_start(task)
+        try:
+            self.ensure_transmission_q()
+            self.mask_file = self.scan_directory.joinpath(
+                self.entry_name+'_mask.nxs')
+            peaks, mask = self.reduce_frames()
+            self.write_maximum()
+            self.write_parameters(first=self.first, last=self.last)
+            self.record('nxmax', maximum=self.maximum,
+                        first_frame=self.first, last_frame=self.last,
+                        qmin=self.qmin)
+            self.record_end(tasks.pop(0))
+            self.remove_maximum_checkpoint()
+            if peaks:
+                self.write_peaks(peaks)
+                self.write_parameters(threshold=self.threshold,
+                                      first=self.first, last=self.last)
+                self.record('nxfind', threshold=self.threshold,
+                            first=self.first, last=self.last,
+                            peak_number=len(peaks))
+                self.record_end(tasks.pop(0))
+            else:
+                self.record_fail(tasks.pop(0))
+            self.write_mask(mask)
+            self.write_parameters(
+                first=self.first, last=self.last,
+                mask_t1=self.mask_parameters['mask_t1'],
+                mask_h1=self.mask_parameters['mask_h1'],
+                mask_t2=self.mask_parameters['mask_t2'],
+                mask_h2=self.mask_parameters['mask_h2'])
+            self.record(
+                'nxprepare', masked_file=self.mask_file,
+                first=self.first, last=self.last,
+                mask_t1=self.mask_parameters['mask_t1'],
+                mask_h1=self.mask_parameters['mask_h1'],
+                mask_t2=self.mask_parameters['mask_t2'],
+                mask_h2=self.mask_parameters['mask_h2'],
+                process='nxprepare_mask')
+            self.record_end(tasks.pop(0))
+        except Exception as error:
+            self.log(str(error))
+            for task in tasks:
+                self.record_fail(task)
+            raise
+
+    def reduce_frames(self):
+        """Find the maximum counts, peaks and 3D mask in a single pass.
+
+        The raw data are read in chunks, whose size is chosen by
+        `plan_chunks`, with a five-frame overlap on either side, and each
+        chunk is passed to the find_maximum, find_peaks and prepare_mask
+        algorithms. The chunks are multiples of `PEAK_CHUNK_SIZE`, starting
+        at the first frame, so each one contains whole chunks of
+        `peak_ranges`, and the results are identical to running each of
+        them separately.
+
+        Returns
+        -------
+        tuple of (list, NXfield)
+            A list of peaks, sorted by frame number, and the 3D mask.
+        """
+        self.log("Finding maximum counts, peaks and 3D mask")
+        (pixel_mask, transmission_mask,
+         sub_idx, n_keep, scale) = self.prepare_maximum()
+        mask_root = self.create_mask()
+        mask = dense_mask(mask_root['entry/mask'])
+        chunk_size = self.plan_chunks('nxreduce', overlap=5, copies=16,
+                                      multiple=PEAK_CHUNK_SIZE)
+        mask_size = self.plan_chunks('nxprepare', concurrent=False,
+                                     maximum=chunk_size, overlap=1,
+                                     copies=16)
+        ranges = self.frame_ranges(self.first, self.last+1, chunk_size)
+        tic = self.start_progress(self.first, self.last)
+
+        chunks = []
+        for i, stop in ranges:
+            j, k = i - min(5, i), min(stop+5, self.last+5, self.nframes)
+            if i < self.last:
+                max_range = (i, min(stop, self.last))
+            else:
+                max_range = None
+            mask_ranges = [(m - min(1, m), min(n+1, self.last+1,
+                                               self.nframes))
+                           for m, n in chunk_ranges(i, stop, mask_size)]
+            chunks.append((self.field.nxfilename, self.field.nxfilepath,
+                           i, j, k, max_range, self.peak_ranges(i, stop),
+                           mask_ranges))
+        shared = {'pixel_mask': pixel_mask,
+                  'transmission_mask': transmission_mask,
+                  'sub_idx': sub_idx, 'n_keep': n_keep, 'scale': scale,
+                  'threshold': self.threshold, 'min_pixels': self.min_pixels,
+                  'mask_parameters': self.mask_parameters}
+
+        results = {}
+        if self.concurrent:
+            from nxrefine.nxutils import NXExecutor, as_completed
+            with NXExecutor(max_workers=self.process_count,
+                            mp_context=self.concurrent,
+                            timer=self.record_chunk,
+                            data_file=self.field.nxfilename,
+                            data_path=self.field.nxfilepath,
+                            shared=shared) as executor:
+                futures = [executor.submit(reduce_chunk, *chunk)
+                           for chunk in chunks]
+                for future in as_completed(futures):
+                    i, maximum_result, blobs, mask_slabs = future.result()
+                    with mask_root.nxfile:
+                        for mj, mk, mask_slab in mask_slabs:
+                            mask[mj:mk] = mask_slab
+                    results[i] = (maximum_result, blobs)
+                    self.update_progress(i)
+                    futures.remove(future)
+        else:
+            for chunk in chunks:
+                i, maximum_result, blobs, mask_slabs = reduce_chunk(
+                    *chunk, **shared)
+                with mask_root.nxfile:
+                    for mj, mk, mask_slab in mask_slabs:
+                        mask[mj:mk] = mask_slab
+                results[i] = (maximum_result, blobs)
+                self.update_progress(i)
+
+        fsum = np.zeros(self.nframes, dtype=np.float64)
+        psum = np.zeros(self.nframes, dtype=np.float64)
+        maximum = 0.0
+        vsum = None
+        self.blobs = []
+        for i in sorted(results):
+            maximum_result, blobs = results[i]
+            if maximum_result is not None:
+                lv, lf, lp, lmax = maximum_result
+                vsum = lv if vsum is None else vsum + lv
+                n = lf.shape[0]
+                fsum[i:i + n] = lf
+                psum[i:i + n] = lp
+                if lmax > maximum:
+                    maximum = lmax
+            self.blobs += blobs
+
+        frame_mask = np.ones(shape=self.shape[1:], dtype=np.int8)
+        with mask_root.nxfile:
+            mask[:self.first] = frame_mask
+            mask[self.last+1:] = frame_mask
+
+        self.pixel_mask = pixel_mask
+        vsum = np.ma.masked_array(vsum, mask=pixel_mask)
+        self.maximum = maximum
+        self.summed_data = NXfield(vsum, name='summed_data')
+        self.summed_frames = NXfield(fsum, name='summed_frames')
+        self.partial_frames = NXfield(psum, name='partial_frames')
+        peaks = sorted([b for b in self.blobs], key=operator.attrgetter('z'))
+
+        toc = self.stop_progress()
+        self.log(f"Maximum counts: {maximum}")
+        self.log(f"{len(peaks)} peaks found")
+        self.log(f"3D Mask prepared in {toc-tic:g} seconds")
+        return peaks, mask_root['entry/mask']
+
     def nxtransform(self, mask=False):
         if mask:
             task = 'nxmasked_transform'
@@ -2290,6 +3035,27 @@ class NXReduce(QtCore.QObject):
                 return
             self.warn_missing_normalization()
             self.record_start(task)
+            if self.internal_transform or (mask and self.packed_mask):
+                try:
+                    self.log(f"{task_name} launched")
+                    tic = timeit.default_timer()
+                    if self.transform_data(mask=mask):
+                        toc = timeit.default_timer()
+                        self.log(
+                            f"{task_name} completed ({toc - tic:g} seconds)")
+                        self.write_parameters(monitor=self.monitor,
+                                              norm=self.norm)
+                        self.record(task, monitor=self.monitor, norm=self.norm,
+                                    command='internal')
+                        self.record_end(task)
+                        self.clear_parameters(['monitor', 'norm'])
+                    else:
+                        self.record_fail(task)
+                except Exception as error:
+                    self.log(str(error))
+                    self.record_fail(task)
+                    raise
+                return
             try:
                 cctw_command, settings_file = self.prepare_transform(mask=mask)
                 if cctw_command:
@@ -2427,6 +3193,182 @@ class NXReduce(QtCore.QObject):
             self.log("Invalid HKL grid")
             return None, None
 
+    def pixel_geometry(self, refine=None):
+        """Return the cached reciprocal-space geometry of the detector.
+
+        The cache is stored next to the parent file, or the wrapper file
+        if there is no parent, so that it is shared by all the scans
+        with the same detector calibration.
+
+        Parameters
+        ----------
+        refine : NXRefine, optional
+            Refinement object defining the geometry, by default the
+            refinement object of this entry.
+
+        Returns
+        -------
+        np.memmap
+            Pixel geometry returned by NXRefine.pixel_geometry.
+        """
+        if refine is None:
+            refine = self.refine
+        if self.parent:
+            cache_file = self.parent.filename
+        else:
+            cache_file = Path(self.wrapper_file)
+        return refine.pixel_geometry(cache_file.parent,
+                                     prefix=cache_file.stem)
+
+    @property
+    def internal_transform(self):
+        """True if transforms are to be performed without CCTW.
+
+        This is the case if the CCTW server setting is 'internal' or
+        if the CCTW command cannot be found.
+        """
+        if self.cctw == 'internal':
+            return True
+        elif shutil.which(self.cctw.split()[0]) is None:
+            self.log(f"'{self.cctw}' not found: using internal transform")
+            return True
+        else:
+            return False
+
+    @property
+    def packed_mask(self):
+        """True if the 3D mask linked to the data is bit-packed.
+
+        CCTW cannot read packed masks, so masked transforms are then
+        performed in-process.
+        """
+        with self:
+            reduce_target = self._get_reduce_target()
+            data_entry = (reduce_target if 'data' in reduce_target
+                          else self.entry)
+            try:
+                data_mask = data_entry['data/data_mask']
+                return data_mask.attrs.get('packing') == 'bits'
+            except Exception:
+                return False
+
+    def transform_data(self, mask=False):
+        """Transform the raw data to the HKL grid without using CCTW.
+
+        The frames are transformed in chunks, which are distributed over
+        multiple processes if concurrent processing is enabled. The
+        summed counts and weights are written to '/entry/data/v' and
+        '/entry/data/n' in the transform file, using the same layout as
+        the CCTW output.
+
+        Parameters
+        ----------
+        mask : bool, optional
+            True if the 3D mask is to be applied, by default False.
+
+        Returns
+        -------
+        bool
+            True if the transform was successful.
+        """
+        self.get_transform_grid(mask=mask)
+        if self.Qh is None or self.Qk is None or self.Ql is None:
+            self.log("Invalid HKL grid")
+            return False
+        if self.norm:
+            self.get_normalization()
+        with self:
+            reduce_target = self._get_reduce_target()
+        data_entry = (reduce_target if 'data' in reduce_target
+                      else self.entry)
+        refine = self.refine
+        refine.read_parameters()
+        refine.Qh, refine.Qk, refine.Ql = self.Qh, self.Qk, self.Ql
+        refine.define_grid()
+        if self.transform_file.exists():
+            with NXLock(self.transform_file):
+                self.transform_file.unlink()
+        refine.prepare_transform(self.transform_file, mask=mask,
+                                 output_entry=reduce_target,
+                                 data_entry=data_entry)
+        with self:
+            detector = self.entry['instrument/detector']
+            if 'pixel_mask' in detector:
+                pixel_mask = detector['pixel_mask'].nxvalue
+            else:
+                pixel_mask = None
+            if 'polarization' in detector:
+                polarization = detector['polarization'].nxvalue
+            else:
+                polarization = None
+            if 'monitor_weight' in self.entry['data']:
+                monitor_weight = self.entry['data/monitor_weight'].nxvalue
+            else:
+                monitor_weight = np.ones(self.nframes, dtype=np.float32)
+            if mask and 'data_mask' in data_entry['data']:
+                mask_file = data_entry['data/data_mask'].nxfilename
+                mask_path = data_entry['data/data_mask'].nxfilepath
+            else:
+                mask_file = mask_path = None
+        geometry = refine.transform_geometry(0, self.nframes)
+        geometry['pixel_file'] = self.pixel_geometry(refine).filename
+
+        nh, nk, nl = refine.grid_shape
+        v = np.zeros(nl * nk * nh, dtype=np.float32)
+        n = np.zeros(nl * nk * nh, dtype=np.float32)
+        chunk_size = self.plan_chunks('nxtransform', minimum=10,
+                                      copies=16)
+        frames = np.flatnonzero(monitor_weight)
+        if frames.size == 0:
+            self.log("No frames with non-zero monitor weights")
+            return False
+        first, last = frames[0], frames[-1] + 1
+        chunks = []
+        for i, j in chunk_ranges(first, last, chunk_size):
+            chunk_geometry = dict(geometry, dvecs=geometry['dvecs'][i:j],
+                                  matrices=geometry['matrices'][i:j])
+            chunks.append((self.field.nxfilename, self.field.nxfilepath,
+                           i, j, chunk_geometry, monitor_weight[i:j]))
+        shared = {'pixel_mask': pixel_mask, 'polarization': polarization}
+
+        tic = self.start_progress(first, last)
+        if self.concurrent:
+            from nxrefine.nxutils import NXExecutor, as_completed
+            with NXExecutor(max_workers=self.process_count,
+                            mp_context=self.concurrent,
+                            timer=self.record_chunk,
+                            data_file=self.field.nxfilename,
+                            data_path=self.field.nxfilepath,
+                            shared=shared) as executor:
+                futures = [executor.submit(transform_chunk, *chunk,
+                                           mask_file=mask_file,
+                                           mask_path=mask_path)
+                           for chunk in chunks]
+                for future in as_completed(futures):
+                    i, indices, chunk_v, chunk_n = future.result()
+                    v[indices] += chunk_v
+                    n[indices] += chunk_n
+                    self.update_progress(i)
+                    futures.remove(future)
+        else:
+            for chunk in chunks:
+                i, indices, chunk_v, chunk_n = transform_chunk(
+                    *chunk, mask_file=mask_file, mask_path=mask_path,
+                    **shared)
+                v[indices] += chunk_v
+                n[indices] += chunk_n
+                self.update_progress(i)
+        toc = self.stop_progress()
+        self.log(f"{len(chunks)} chunks transformed ({toc - tic:g} seconds)")
+
+        chunks = tuple(min(50, size) for size in (nl, nk, nh))
+        root = nxopen(self.transform_file, 'w')
+        root['entry'] = NXentry()
+        root['entry/data'] = NXdata()
+        root['entry/data/v'] = NXfield(v.reshape(nl, nk, nh), chunks=chunks)
+        root['entry/data/n'] = NXfield(n.reshape(nl, nk, nh), chunks=chunks)
+        return True
+
     def nxsum(self, scan_list, update=False):
         if self.raw_file.exists() and not (self.overwrite or update):
             self.log("Data already summed")
@@ -2437,14 +3379,12 @@ class NXReduce(QtCore.QObject):
             try:
                 self.log("Sum files launched")
                 tic = timeit.default_timer()
-                if not self.check_files(scan_list):
+                if not self.check_sum_files(scan_list):
                     self.record_fail('nxsum')
                 else:
                     self.log(
                         "All files and metadata have been checked")
-                    if not update:
-                        self.sum_files(scan_list)
-                    self.sum_monitors(scan_list)
+                    self.sum_files(scan_list, update=update)
                     toc = timeit.default_timer()
                     self.log(f"Sum completed ({toc - tic:g} seconds)")
                     self.record('nxsum', scans=','.join(scan_list))
@@ -2456,6 +3396,7 @@ class NXReduce(QtCore.QObject):
 
     def check_sum_files(self, scan_list):
         status = True
+        frame_shape = None
         for scan in scan_list:
             reduce = NXReduce(self.entry_name,
                               self.base_directory.joinpath(scan))
@@ -2466,104 +3407,343 @@ class NXReduce(QtCore.QObject):
                 self.log(
                     f"Monitor not present in {reduce.wrapper_file}")
                 status = False
+            elif frame_shape is None:
+                frame_shape = reduce.shape[1:]
+            elif reduce.shape[1:] != frame_shape:
+                self.log(f"Frame shape of '{reduce.raw_file}' is "
+                         f"{reduce.shape[1:]}, not {frame_shape}")
+                status = False
         return status
 
-    def sum_files(self, scan_list):
+    def sum_files(self, scan_list, update=False):
+        """Sum the raw data and monitors of a list of scans.
 
-        nframes = 3650
-        chunk_size = 500
-        for i, scan in enumerate(scan_list):
-            reduce = NXReduce(self.entry_name,
-                              self.base_directory.joinpath(scan))
-            self.log(
-                f"Summing {self.entry_name} in '{reduce.raw_file}'")
-            if i == 0:
-                shutil.copyfile(reduce.raw_file, self.raw_file)
-                new_file = h5.File(self.raw_file, 'r+')
-                new_field = new_file[self.raw_path]
-            else:
-                scan_file = h5.File(reduce.raw_file, 'r')
-                scan_field = scan_file[reduce.raw_path]
-                for i in range(0, nframes, chunk_size):
-                    new_slab = new_field[i:i+chunk_size, :, :]
-                    scan_slab = scan_field[i:i+chunk_size, :, :]
-                    new_field[i:i+chunk_size, :, :] = new_slab + scan_slab
-        self.log("Raw data files summed")
+        The monitors and monitor weights of each scan are added as the
+        scans are checked. The raw data are then summed in a single pass
+        over the output file, in which each chunk of frames is read from
+        every scan, summed, and written once. The chunks are distributed
+        over multiple processes if concurrent processing is enabled.
 
-    def sum_monitors(self, scan_list):
-
-        for i, scan in enumerate(scan_list):
+        Parameters
+        ----------
+        scan_list : list of str
+            Names of the scan directories to be summed
+        update : bool, optional
+            True if only the monitors are to be summed, by default False
+        """
+        data_files, data_paths = [], []
+        monitors = monitor_weight = None
+        for scan in scan_list:
             reduce = NXReduce(self.entry_name,
                               self.base_directory.joinpath(scan))
             self.log(
-                f"Adding {self.entry_name} monitors in "
-                f"'{reduce.wrapper_file}'")
-            monitors = []
-            if i == 0:
-                for monitor in reduce.entry.NXmonitor:
-                    monitors.append(monitor.nxsignal.nxvalue)
-                if 'monitor_weight' not in reduce.entry['data']:
-                    reduce.get_normalization()
-                monitor_weight = reduce.entry['data/monitor_weight'].nxvalue
+                f"Adding {self.entry_name} in '{reduce.wrapper_file}'")
+            data_files.append(str(reduce.raw_file))
+            data_paths.append(reduce.raw_path)
+            scan_monitors = [np.array(monitor.nxsignal.nxvalue,
+                                      dtype=np.float64)
+                             for monitor in reduce.entry.NXmonitor]
+            if 'monitor_weight' not in reduce.entry['data']:
+                reduce.get_normalization()
+            scan_weight = np.array(reduce.entry['data/monitor_weight'].nxvalue,
+                                   dtype=np.float64)
+            if monitors is None:
+                monitors, monitor_weight = scan_monitors, scan_weight
                 if reduce.mask_file.exists():
                     shutil.copyfile(str(reduce.mask_file), str(self.mask_file))
             else:
-                for i, monitor in enumerate(reduce.entry.NXmonitor):
-                    monitors[i] += monitor.nxsignal.nxvalue
-                if 'monitor_weight' not in reduce.entry['data']:
-                    reduce.get_normalization()
-                monitor_weight += reduce.entry['data/monitor_weight'].nxvalue
+                for monitor, scan_monitor in zip(monitors, scan_monitors):
+                    n = min(monitor.size, scan_monitor.size)
+                    monitor[:n] += scan_monitor[:n]
+                n = min(monitor_weight.size, scan_weight.size)
+                monitor_weight[:n] += scan_weight[:n]
+        if not update:
+            self.sum_data(data_files, data_paths)
         with self:
             for i, monitor in enumerate(self.entry.NXmonitor):
                 self.entry[monitor.nxname].nxsignal = monitors[i]
             self.entry['data/monitor_weight'] = monitor_weight
+        self.log("Monitors summed")
 
-    def nxreduce(self):
-        if self.load:
-            self.nxload()
-        if self.link:
-            self.nxlink()
-        if self.maxcount:
-            self.nxmax()
-        if self.find:
-            self.nxfind()
-        if self.refine_lattice:
-            if self.complete('nxfind'):
-                self.nxrefine()
+    def sum_data(self, data_files, data_paths):
+        """Sum the raw data files into the summed raw data file.
+
+        The summed file is a copy of the first raw data file, with the
+        raw data replaced by the sum of the frames in every file. The
+        number of frames is taken from the first file. Integer data are
+        accumulated in 64-bit integers to prevent overflow.
+
+        Parameters
+        ----------
+        data_files : list of str
+            File paths to the raw data files
+        data_paths : list of str
+            Internal paths to the raw data in each file
+        """
+        with h5.File(data_files[0], 'r') as data_root:
+            field = data_root[data_paths[0]]
+            nframes = field.shape[0]
+            dtype = summed_dtype(field.dtype)
+            chunk_size = self.plan_chunks('nxsum', field=field,
+                                          copies=2*len(data_files)+2)
+        for data_file, data_path in zip(data_files[1:], data_paths[1:]):
+            with h5.File(data_file, 'r') as data_root:
+                if data_root[data_path].shape[0] != nframes:
+                    self.log(f"'{data_file}' contains "
+                             f"{data_root[data_path].shape[0]} frames, "
+                             f"not {nframes}")
+        copy_file_structure(data_files[0], self.raw_file, data_paths[0],
+                            dtype)
+
+        ranges = chunk_ranges(0, nframes, chunk_size)
+        tic = self.start_progress(0, nframes)
+        with h5.File(self.raw_file, 'r+') as sum_root:
+            sum_field = sum_root[data_paths[0]]
+            if self.concurrent:
+                from nxrefine.nxutils import NXExecutor, as_completed
+                with NXExecutor(max_workers=self.process_count,
+                                mp_context=self.concurrent,
+                                timer=self.record_chunk) as executor:
+                    futures = [executor.submit(sum_chunk, data_files,
+                                               data_paths, i, j, dtype)
+                               for i, j in ranges]
+                    for future in as_completed(futures):
+                        i, slab = future.result()
+                        sum_field[i:i+slab.shape[0]] = slab
+                        self.update_progress(i)
+                        futures.remove(future)
             else:
-                self.log("Cannot refine orientation matrix")
-                self.record_fail('nxrefine')
-        if self.prepare:
-            self.nxprepare()
-        if self.transform:
-            if self.oriented:
-                if self.regular:
-                    self.nxtransform()
-                if self.mask:
-                    self.nxtransform(mask=True)
+                for i, j in ranges:
+                    i, slab = sum_chunk(data_files, data_paths, i, j, dtype)
+                    sum_field[i:j] = slab
+                    self.update_progress(i)
+        toc = self.stop_progress()
+        self.log(f"Raw data files summed ({toc - tic:g} seconds)")
+
+    def nxreduce(self):
+        with self.session():
+            if self.load:
+                self.nxload()
+            if self.link:
+                self.nxlink()
+            fused = self.fused
+            if fused:
+                self.nxfused()
             else:
-                self.log("Cannot transform without orientation matrix")
-                if self.regular:
-                    self.record_fail('nxtransform')
-                if self.mask:
-                    self.record_fail('nxmasked_transform')
-        if self.combine or self.pdf:
-            reduce = NXMultiReduce(directory=self.directory,
-                                   entries=self.entries,
-                                   subentry=self.subentry_name,
-                                   combine=self.combine, pdf=self.pdf,
-                                   regular=self.regular, mask=self.mask,
-                                   overwrite=self.overwrite)
-            if self.combine:
-                if self.regular and self.all_complete('nxtransform'):
-                    reduce.nxcombine()
-                if self.mask and self.all_complete('nxmasked_transform'):
-                    reduce.nxcombine(mask=True)
-            if self.pdf:
-                if self.regular and self.complete('nxcombine'):
-                    reduce.nxpdf()
-                if self.mask and self.complete('nxmasked_combine'):
-                    reduce.nxpdf(mask=True)
+                if self.maxcount:
+                    self.nxmax()
+                if self.find:
+                    self.nxfind()
+            if self.refine_lattice:
+                if self.complete('nxfind'):
+                    self.nxrefine()
+                else:
+                    self.log("Cannot refine orientation matrix")
+                    self.record_fail('nxrefine')
+            if self.prepare and not fused:
+                self.nxprepare()
+            if self.transform:
+                if self.oriented:
+                    if self.regular:
+                        self.nxtransform()
+                    if self.mask:
+                        self.nxtransform(mask=True)
+                else:
+                    self.log("Cannot transform without orientation matrix")
+                    if self.regular:
+                        self.record_fail('nxtransform')
+                    if self.mask:
+                        self.record_fail('nxmasked_transform')
+            if self.combine or self.pdf:
+                reduce = NXMultiReduce(directory=self.directory,
+                                       entries=self.entries,
+                                       subentry=self.subentry_name,
+                                       combine=self.combine, pdf=self.pdf,
+                                       regular=self.regular, mask=self.mask,
+                                       overwrite=self.overwrite)
+                if self.combine:
+                    if self.regular and self.all_complete('nxtransform'):
+                        reduce.nxcombine()
+                    if self.mask and self.all_complete('nxmasked_transform'):
+                        reduce.nxcombine(mask=True)
+                if self.pdf:
+                    if self.regular and self.complete('nxcombine'):
+                        reduce.nxpdf()
+                    if self.mask and self.complete('nxmasked_combine'):
+                        reduce.nxpdf(mask=True)
+
+    @property
+    def expected_frames(self):
+        """Number of frames in the scan, if known before it completes.
+
+        This is the length of the frame number axis in the wrapper file,
+        which is defined when the scan is configured.
+        """
+        try:
+            return self.entry['data/frame_number'].shape[0]
+        except NeXusError:
+            return None
+
+    def follow(self, interval=10.0, timeout=300.0, chunk_size=50):
+        """Reduce the raw data while they are being collected.
+
+        The raw data file is polled for new frames, which are processed
+        by the nxmax and nxfind kernels as soon as they are written. The
+        running sums are saved to the nxmax checkpoint and the peaks are
+        kept in `live_peaks`. The scan is assumed to have finished when
+        the expected number of frames have been written, or when no new
+        frames have been written within the timeout. The remaining
+        frames are then processed by `nxreduce`, which resumes nxmax and
+        nxfind from the frames already processed. Stages that have
+        already been processed are neither followed nor repeated. If no
+        frames can be read within the timeout, an error is logged and
+        the reduction is not run.
+
+        Frames within ten frames of the end of the current data are not
+        processed until the scan ends, since they may be outside the
+        final frame range, and peak searches need five frames beyond the
+        end of each chunk. Peaks are only found in complete chunks of
+        `peak_ranges`, so that they are identical to those found after
+        the scan.
+
+        Parameters
+        ----------
+        interval : float, optional
+            Time between polls of the raw data in seconds, by default 10
+        timeout : float, optional
+            Time without new frames after which the scan is assumed to
+            have finished, or to have failed to start, in seconds, by
+            default 300
+        chunk_size : int, optional
+            Number of frames processed in each nxmax chunk, by default 50
+        """
+        self.log(f"Following '{self.raw_file}'")
+        last = self._last
+        expected = self.expected_frames
+        follow_max = self.maxcount and self.not_processed('nxmax')
+        follow_find = self.find and self.not_processed('nxfind')
+        if follow_max:
+            self.ensure_transmission_q()
+        masks = key = state = None
+        mask = None if follow_max else self.pixel_mask
+        peaks, peak_end = [], self.first
+        nframes, tic = 0, timeit.default_timer()
+        while True:
+            if follow_max and masks is None and nframes > 10:
+                masks = self.prepare_maximum()
+                mask = masks[0]
+                key = self.maximum_key(*masks[:4])
+                state = self.read_maximum_checkpoint(key)
+                if state is None:
+                    state = {'vsum': None, 'maximum': 0.0,
+                             'fsum': np.zeros(0), 'psum': np.zeros(0),
+                             'done': np.zeros(0, dtype=bool)}
+            try:
+                with open_growing_file(self.raw_file) as raw_root:
+                    data = raw_root[self.raw_path]
+                    if data.shape[0] > nframes:
+                        nframes = data.shape[0]
+                        tic = timeit.default_timer()
+                    self._shape, self._last = data.shape, last
+                    limit = max(min(nframes - 10, self.last), self.first)
+                    if state is not None:
+                        self.follow_maximum(data, limit, masks, key, state,
+                                            chunk_size)
+                    if follow_find and mask is not None and limit > peak_end:
+                        blobs, peak_end = self.follow_peaks(data, peak_end,
+                                                            limit, mask)
+                        peaks += blobs
+            except (OSError, KeyError):
+                pass
+            if expected is not None and nframes >= expected:
+                break
+            elif timeit.default_timer() - tic > timeout:
+                break
+            time.sleep(interval)
+        self._field = self._shape = None
+        self._last = last
+        if nframes == 0:
+            self.log(f"No readable data in '{self.raw_file}' after "
+                     f"{timeout} seconds")
+            return
+        if state is not None:
+            self.write_maximum_checkpoint(state, key, force=True)
+        if follow_find:
+            self.live_peaks = (peaks, peak_end)
+        self.log(f"{nframes} frames collected")
+        self._following = True
+        try:
+            self.nxreduce()
+        finally:
+            self._following = False
+
+    def follow_maximum(self, data, limit, masks, key, state, chunk_size):
+        """Update the nxmax sums with frames written since the last poll.
+
+        Parameters
+        ----------
+        data : h5py.Dataset
+            Raw data being collected
+        limit : int
+            Frames before this index are processed
+        masks : tuple
+            Masks and indices returned by `prepare_maximum`
+        key : str
+            Key returned by `maximum_key` for the current masks
+        state : dict
+            The sums, maximum and processed frames
+        chunk_size : int
+            Number of frames processed in each chunk
+        """
+        for name in ('fsum', 'psum', 'done'):
+            if state[name].size < data.shape[0]:
+                array = np.zeros(data.shape[0], dtype=state[name].dtype)
+                array[:state[name].size] = state[name]
+                state[name] = array
+        for i, k in unprocessed_ranges(state['done'], self.first, limit,
+                                       chunk_size):
+            lv, lf, lp, lmax = find_maximum_slab(data[i:k], *masks)
+            state['vsum'] = lv if state['vsum'] is None else state['vsum'] + lv
+            state['fsum'][i:k] = lf
+            state['psum'][i:k] = lp
+            state['maximum'] = max(state['maximum'], lmax)
+            state['done'][i:k] = True
+            self.write_maximum_checkpoint(state, key)
+
+    def follow_peaks(self, data, start, limit, mask):
+        """Find peaks in frames written since the last poll.
+
+        Only the chunks of `peak_ranges` that end before the limit are
+        searched, since the others would be cut at the limit.
+
+        Parameters
+        ----------
+        data : h5py.Dataset
+            Raw data being collected
+        start : int
+            First frame to be searched
+        limit : int
+            Frames before this index may be searched
+        mask : ndarray
+            Pixel mask used in the peak search
+
+        Returns
+        -------
+        tuple of (list of NXBlob, int)
+            Peaks in the searched chunks and the end of the last chunk.
+        """
+        peaks = []
+        for i, stop in self.frame_ranges(start, limit, PEAK_CHUNK_SIZE):
+            if (stop - self.first) % PEAK_CHUNK_SIZE != 0:
+                break
+            j, k = i - min(5, i), stop + 5
+            blobs = peak_search_slab(data[j:k], self.threshold,
+                                     mask=mask, min_pixels=self.min_pixels)
+            for blob in blobs:
+                blob.z += j
+            peaks += [b for b in blobs if b.z >= i and b.z < stop]
+            start = stop
+        return peaks, start
 
     def queue(self, command, args=None, entries=None):
         """Insert DB rows for this entry's tasks and submit a command."""
@@ -2577,46 +3757,53 @@ class NXReduce(QtCore.QObject):
     def queue_db_rows(self):
         """Insert DB rows for enabled tasks; return the task-flag list."""
         tasks = []
+        queued = []
         if self.load:
             tasks.append('load')
-            self.queue_task('nxload')
+            queued.append(('nxload', None))
         if self.link:
             tasks.append('link')
-            self.queue_task('nxlink')
+            queued.append(('nxlink', None))
         if self.maxcount:
             tasks.append('max')
-            self.queue_task('nxmax')
+            queued.append(('nxmax', None))
         if self.find:
             tasks.append('find')
-            self.queue_task('nxfind')
+            queued.append(('nxfind', None))
         if self.refine_lattice:
             tasks.append('refine')
-            self.queue_task('nxrefine')
+            queued.append(('nxrefine', None))
         if self.prepare:
             tasks.append('prepare')
-            self.queue_task('nxprepare')
+            queued.append(('nxprepare', None))
         if self.transform:
             tasks.append('transform')
             if self.regular:
-                self.queue_task('nxtransform')
+                queued.append(('nxtransform', None))
             if self.mask:
-                self.queue_task('nxmasked_transform')
+                queued.append(('nxmasked_transform', None))
         if self.combine:
             tasks.append('combine')
             if self.regular:
-                self.queue_task('nxcombine', entry='entry')
+                queued.append(('nxcombine', 'entry'))
             if self.mask:
-                self.queue_task('nxmasked_combine', entry='entry')
+                queued.append(('nxmasked_combine', 'entry'))
         if self.pdf:
             tasks.append('pdf')
             if self.regular:
-                self.queue_task('nxpdf', entry='entry')
+                queued.append(('nxpdf', 'entry'))
             if self.mask:
-                self.queue_task('nxmasked_pdf', entry='entry')
+                queued.append(('nxmasked_pdf', 'entry'))
+        self.queue_tasks(queued)
         return tasks
 
     def submit_command(self, command, tasks, args=None, entries=None):
-        """Build and send a single multi-task command via the server.
+        """Build and send commands for the queued tasks via the server.
+
+        An `nxreduce` command is split by `stage_commands` into a
+        separate command for each stage, so that the server can schedule
+        each stage as soon as the stages it depends on have finished.
+        Other commands are sent as a single command.
 
         ``entries``, when supplied, becomes the value of ``--entries``;
         otherwise ``self.entry_name`` is used.
@@ -2629,35 +3816,102 @@ class NXReduce(QtCore.QObject):
         if self.overwrite:
             tasks.append('overwrite')
 
-        entries_arg = ' '.join(entries) if entries else self.entry_name
-
-        def switches(args):
-            d = vars(args)
-            s = [f"--{k} {d[k]}" if d[k] is not True else f"--{k}"
-                 for k in d if d[k] and k != 'entries' and k != 'queue']
-            s.insert(1, f"--entries {entries_arg}")
-            return ' '.join(s)
+        if not entries:
+            entries = [self.entry_name]
 
         if args:
             if 'directory' in args:
                 args.directory = str(Path(args.directory).resolve())
-            self.server.add_task(f"{command} {switches(args)}")
+            d = vars(args)
+            switches = [f"--{k} {d[k]}" if d[k] is not True else f"--{k}"
+                        for k in d if d[k] and k != 'entries' and k != 'queue']
         else:
-            subentry_arg = (f" --subentry {self.subentry_name}"
-                            if self.subentry_name else "")
-            self.server.add_task(
-                f"{command} --directory {self.directory} "
-                f"--entries {entries_arg}{subentry_arg} "
-                f"--{' --'.join(tasks)}")
+            switches = [f"--directory {self.directory}"]
+            if self.subentry_name:
+                switches.append(f"--subentry {self.subentry_name}")
+            switches += [f"--{task}" for task in tasks]
+
+        if command == 'nxreduce':
+            for stage_command in self.stage_commands(switches, entries):
+                self.server.add_task(stage_command)
+        else:
+            switches.insert(1, f"--entries {' '.join(entries)}")
+            self.server.add_task(f"{command} {' '.join(switches)}")
+
+    def stage_commands(self, switches, entries):
+        """Split the switches of an `nxreduce` command into stages.
+
+        Each stage of each entry is run by a separate command, except
+        that nxmax, nxfind and nxprepare are kept together, so that they
+        can still be run in a single pass over the raw data. The combine
+        and PDF stages are run once for all the entries, so the commands
+        are identical for every entry, and duplicates are ignored by the
+        server. The options used to follow a scan during its collection
+        are only passed to the nxmax, nxfind and nxprepare stage.
+
+        Parameters
+        ----------
+        switches : list of str
+            Command-line switches, starting with the scan directory
+        entries : list of str
+            Entries to be processed
+
+        Returns
+        -------
+        list of str
+            Commands in the order of the stages.
+        """
+        entry_stages = [['--load'], ['--link'],
+                        ['--max', '--find', '--prepare'], ['--refine'],
+                        ['--transform']]
+        scan_stages = [['--combine'], ['--pdf']]
+        follow_options = ['--follow', '--interval', '--timeout']
+        stages = [s for stage in entry_stages + scan_stages for s in stage]
+        options = [s for s in switches if s not in stages]
+        follow = [s for s in options if s.split()[0] in follow_options]
+        options = [s for s in options if s not in follow]
+        commands = []
+        for stage in entry_stages:
+            stage_options = options
+            if '--max' in stage:
+                stage_options = options + follow
+            stage = [s for s in stage if s in switches]
+            if stage:
+                for entry in entries:
+                    commands.append(' '.join(
+                        ['nxreduce', options[0], f"--entries {entry}"] +
+                        stage_options[1:] + stage))
+        for stage in scan_stages:
+            if stage[0] in switches:
+                commands.append(' '.join(['nxreduce'] + options + stage))
+        return commands
 
     def queue_task(self, task, entry=None):
-        if entry is None:
-            entry = self.entry_name
-        if self.not_processed(task):
-            self.queue_time[task] = datetime.datetime.now()
-            self.db.queue_task(self.wrapper_file, task, entry,
-                               queue_time=self.queue_time[task],
-                               subentry=self.subentry_name)
+        self.queue_tasks([(task, entry)])
+
+    def queue_tasks(self, tasks):
+        """Record queued tasks in the database in a single transaction.
+
+        Tasks that have already been processed are skipped, unless
+        `overwrite` is set to True.
+
+        Parameters
+        ----------
+        tasks : list of tuple
+            Each tuple contains the task name and the entry, which is
+            this entry if None.
+        """
+        queue_time = datetime.datetime.now()
+        rows = []
+        for task, entry in tasks:
+            if entry is None:
+                entry = self.entry_name
+            if self.not_processed(task):
+                self.queue_time[task] = queue_time
+                rows.append((self.wrapper_file, task, entry,
+                             self.subentry_name))
+        if rows:
+            self.db.queue_tasks(rows, queue_time=queue_time)
 
 
 class NXMultiReduce(NXReduce):
@@ -2931,7 +4185,11 @@ class NXMultiReduce(NXReduce):
         transform = self.find_group(self.transform_path)
         symmetry = NXSymmetry(transform,
                               laue_group=self.refine.laue_group)
-        symm_root['entry/data/data'] = symmetry.symmetrize(entries=True)
+        symm_root['entry/data/data'] = NXfield(
+            shape=transform.nxsignal.shape, dtype=np.float64)
+        symmetry.symmetrize(entries=True,
+                            output=symm_root['entry/data/data'],
+                            memory=self.worker_memory)
         symm_root['entry/data'].nxsignal = symm_root['entry/data/data']
         symm_root['entry/data'].nxweights = 1.0 / self.taper
         symm_root['entry/data'].nxaxes = transform.nxaxes
@@ -3297,41 +4555,44 @@ class NXMultiReduce(NXReduce):
         self.db.update_file(self.wrapper_file)
 
     def nxreduce(self):
-        if self.combine:
-            if self.regular:
-                self.nxcombine()
-            if self.mask:
-                self.nxcombine(mask=True)
-        if self.pdf:
-            if self.regular:
-                if self.complete('nxcombine'):
-                    self.nxpdf()
-                else:
-                    self.log("Skipping nxpdf: nxcombine has not completed")
-            if self.mask:
-                if self.complete('nxmasked_combine'):
-                    self.nxpdf(mask=True)
-                else:
-                    self.log(
-                        "Skipping nxmasked_pdf: nxmasked_combine has not "
-                        "completed")
+        with self.session():
+            if self.combine:
+                if self.regular:
+                    self.nxcombine()
+                if self.mask:
+                    self.nxcombine(mask=True)
+            if self.pdf:
+                if self.regular:
+                    if self.complete('nxcombine'):
+                        self.nxpdf()
+                    else:
+                        self.log("Skipping nxpdf: nxcombine has not completed")
+                if self.mask:
+                    if self.complete('nxmasked_combine'):
+                        self.nxpdf(mask=True)
+                    else:
+                        self.log(
+                            "Skipping nxmasked_pdf: nxmasked_combine has not "
+                            "completed")
 
     def queue(self, command, args=None):
         """ Add tasks to the server's fifo, and log this in the database """
 
         tasks = []
+        queued = []
         if self.combine:
             tasks.append('combine')
             if self.regular:
-                self.queue_task('nxcombine')
+                queued.append(('nxcombine', None))
             if self.mask:
-                self.queue_task('nxmasked_combine')
+                queued.append(('nxmasked_combine', None))
         if self.pdf:
             tasks.append('pdf')
             if self.regular:
-                self.queue_task('nxpdf')
+                queued.append(('nxpdf', None))
             if self.mask:
-                self.queue_task('nxmasked_pdf')
+                queued.append(('nxmasked_pdf', None))
+        self.queue_tasks(queued)
 
         if not tasks:
             return
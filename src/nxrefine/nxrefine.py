@@ -59,6 +59,34 @@ def rotmat(axis, angle):
     return np.matrix(mat)
 
 
+def drotmat(axis, angle):
+    """Return the derivative of a rotation matrix with respect to its angle.
+
+    Parameters
+    ----------
+    axis : {1, 2, 3}
+        Index of the rotation axis.
+    angle : float
+        Angle of rotation in degrees.
+
+    Returns
+    -------
+    np.ndarray
+        The 3x3 derivative of the `rotmat` matrix per degree.
+    """
+    if angle is None:
+        angle = 0.0
+    cang = np.cos(angle*radians)
+    sang = np.sin(angle*radians)
+    if axis == 1:
+        mat = np.array(((0, 0, 0), (0, -sang, -cang), (0, cang, -sang)))
+    elif axis == 2:
+        mat = np.array(((-sang, 0, cang), (0, 0, 0), (-cang, 0, -sang)))
+    else:
+        mat = np.array(((-sang, -cang, 0), (cang, -sang, 0), (0, 0, 0)))
+    return mat * radians
+
+
 def vec(x, y=0.0, z=0.0):
     """Return a 1x3 column vector."""
     return np.matrix((x, y, z)).T
@@ -1068,6 +1096,45 @@ class NXRefine:
         command.append('--normalization 0')
         return ' '.join(command)
 
+    def transform_geometry(self, first, last):
+        """Return the parameters needed to transform frames to HKL.
+
+        This contains the same transformations as `Gvec`, but split
+        into a matrix that converts detector pixels into lab coordinates
+        and the matrices that convert scattering vectors to HKL for each
+        frame, so that they can be applied to whole frames at once.
+
+        Parameters
+        ----------
+        first : int
+            Index of the first frame.
+        last : int
+            Index of the last frame (exclusive).
+
+        Returns
+        -------
+        dict
+            Transform geometry for use by `nxutils.transform_chunk`.
+        """
+        frames = np.arange(first, last)
+        UBimat = inv(self.UBmat)
+        dvecs = np.zeros((frames.size, 3))
+        matrices = np.zeros((frames.size, 3, 3))
+        for i, z in enumerate(frames):
+            phi = self.phi + self.phi_step * z
+            dvecs[i] = np.array(self.Dvec(phi)).ravel()
+            matrices[i] = UBimat * inv(self.Gmat(phi))
+        return {'pixel_matrix': np.array(
+                    self.pixel_size * inv(self.Dmat) * inv(self.Omat)),
+                'center': (self.xc, self.yc),
+                'distance': self.distance,
+                'wavelength': self.wavelength,
+                'dvecs': dvecs,
+                'matrices': matrices,
+                'grid_origin': self.grid_origin,
+                'grid_step': self.grid_step,
+                'grid_shape': self.grid_shape}
+
     def set_symmetry(self):
         """Use the crystal symmetry to constrain unit cell parameters."""
         if self.symmetry == 'cubic':
@@ -1492,6 +1559,55 @@ class NXRefine:
         """Return the B matrix defined by the unit cell."""
         return inv(self.Bimat)
 
+    def Bimat_derivatives(self):
+        """Return the derivatives of the inverse B matrix.
+
+        Returns
+        -------
+        dict
+            The 3x3 derivatives with respect to each of the six lattice
+            parameters, with angles in degrees.
+        """
+        a, b, c, alpha, beta, gamma = self.lattice_parameters
+        ca, sa = np.cos(alpha*radians), np.sin(alpha*radians)
+        cb, sb = np.cos(beta*radians), np.sin(beta*radians)
+        cg, sg = np.cos(gamma*radians), np.sin(gamma*radians)
+        B23 = c * (ca - cb*cg) / sg
+        B33 = np.sqrt(c**2 - (c*cb)**2 - B23**2)
+        dB23 = {'alpha': -c * sa / sg, 'beta': c * sb * cg / sg,
+                'gamma': c * (cb - ca*cg) / sg**2}
+        dB33 = {'alpha': -B23 * dB23['alpha'] / B33,
+                'beta': (c**2 * cb * sb - B23 * dB23['beta']) / B33,
+                'gamma': -B23 * dB23['gamma'] / B33}
+        derivatives = {
+            'a': np.array(((1, 0, 0), (0, 0, 0), (0, 0, 0))),
+            'b': np.array(((0, cg, 0), (0, sg, 0), (0, 0, 0))),
+            'c': np.array(((0, 0, cb), (0, 0, B23/c), (0, 0, B33/c))),
+            'alpha': np.array(((0, 0, 0), (0, 0, dB23['alpha']),
+                               (0, 0, dB33['alpha']))) * radians,
+            'beta': np.array(((0, 0, -c*sb), (0, 0, dB23['beta']),
+                              (0, 0, dB33['beta']))) * radians,
+            'gamma': np.array(((0, -b*sg, 0), (0, b*cg, dB23['gamma']),
+                               (0, 0, dB33['gamma']))) * radians}
+        return {p: derivatives[p].astype(float) for p in derivatives}
+
+    @property
+    def symmetry_constraints(self):
+        """Lattice parameters that are tied to each independent parameter.
+
+        Parameters that are fixed by the crystal symmetry are omitted.
+        """
+        if self.symmetry == 'cubic':
+            return {'a': ('a', 'b', 'c')}
+        elif self.symmetry == 'tetragonal' or self.symmetry == 'hexagonal':
+            return {'a': ('a', 'b'), 'c': ('c',)}
+        elif self.symmetry == 'orthorhombic':
+            return {'a': ('a',), 'b': ('b',), 'c': ('c',)}
+        elif self.symmetry == 'monoclinic':
+            return {'a': ('a',), 'b': ('b',), 'c': ('c',), 'beta': ('beta',)}
+        else:
+            return {p: (p,) for p in ('a', 'b', 'c', 'alpha', 'beta', 'gamma')}
+
     @property
     def Omat(self):
         """Return the matrix that rotates detector axes into lab axes.
@@ -1546,6 +1662,39 @@ class NXRefine:
         return (inv(self.Gmat(phi)) *
                 ((norm_vec(v3) / self.wavelength) - self.Evec))
 
+    def Gvec_array(self, x, y, z):
+        """Return the scattering vectors of the specified pixels.
+
+        This is a vectorized version of `Gvec`, in which the matrix
+        inverses are calculated once for all the pixels.
+
+        Parameters
+        ----------
+        x, y, z : array_like
+            Pixel coordinates
+
+        Returns
+        -------
+        ndarray
+            Array of shape (3, n) containing the scattering vectors.
+        """
+        x, y, z = [np.atleast_1d(np.asarray(v, dtype=float))
+                   for v in (x, y, z)]
+        phi = (self.phi + self.phi_step * z) * radians
+        cphi, sphi = np.cos(phi), np.sin(phi)
+        zeros, ones = np.zeros(phi.shape), np.ones(phi.shape)
+        Rmats = np.stack([np.stack([cphi, -sphi, zeros], axis=-1),
+                          np.stack([sphi, cphi, zeros], axis=-1),
+                          np.stack([zeros, zeros, ones], axis=-1)], axis=1)
+        Gmats = np.asarray(self._Gmat_cache) @ Rmats
+        Mat = self.pixel_size * np.asarray(inv(self.Dmat) * inv(self.Omat))
+        v3 = Mat @ np.stack([x - self.xc, y - self.yc, zeros])
+        v3 -= (Gmats @ np.asarray(self.Svec).ravel()).T
+        v3[0] += self.distance
+        v4 = v3 / (np.sqrt((v3**2).sum(0)) * self.wavelength)
+        v4[0] -= 1.0 / self.wavelength
+        return np.einsum('nji,jn->in', Gmats, v4)
+
     def get_Gvecs(self):
         idx = self.idx
         self.Gvecs = [self.Gvec(x, y, z) for x, y, z
@@ -1554,18 +1703,106 @@ class NXRefine:
 
     def calculate_angles(self, x, y):
         """Return the polar and azimuthal angles of the specified pixels."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        polar_angles = []
-        azimuthal_angles = []
-        for i in range(len(x)):
-            peak = Oimat * (vec(x[i], y[i]) - self.Cvec)
-            v = norm(Mat * peak)
-            polar_angle = np.arctan(v / self.distance)
-            polar_angles.append(polar_angle)
-            azimuthal_angles.append(np.arctan2(-peak[1, 0], peak[2, 0]))
-        return (np.array(polar_angles) * degrees,
-                np.array(azimuthal_angles) * degrees)
+        Oimat = np.asarray(inv(self.Omat))
+        Mat = self.pixel_size * np.asarray(inv(self.Dmat)) @ Oimat
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        peaks = Oimat @ np.stack([x.ravel() - self.xc, y.ravel() - self.yc,
+                                  np.zeros(x.size)])
+        v = np.sqrt(((Mat @ peaks)**2).sum(0))
+        polar_angles = np.arctan(v / self.distance)
+        azimuthal_angles = np.arctan2(-peaks[1], peaks[2])
+        return ((polar_angles * degrees).reshape(x.shape),
+                (azimuthal_angles * degrees).reshape(x.shape))
+
+    @property
+    def calibration_hash(self):
+        """Hash of the parameters that define the detector geometry."""
+        import hashlib
+        parameters = [list(self.shape), self.pixel_size, self.distance,
+                      self.xc, self.yc, self.yaw, self.pitch, self.roll,
+                      np.asarray(self.Omat).tolist()]
+        return hashlib.sha1(repr([float(p) if np.isscalar(p) else p
+                                  for p in parameters]).encode()
+                            ).hexdigest()[:16]
+
+    def pixel_geometry(self, directory, prefix='detector', expiry=86400.0):
+        """Return the cached reciprocal-space geometry of every pixel.
+
+        The geometry is stored in a NumPy file named after the
+        calibration hash, so it is only recomputed when the detector
+        calibration changes. It is returned as a memory-mapped array
+        with the following planes:
+
+            0-2: unit scattering directions in lab coordinates, for a
+                 sample at the center of the goniometer
+            3:   polar angles in degrees, as in `calculate_angles`
+            4:   azimuthal angles in degrees, as in `calculate_angles`
+            5:   solid angles relative to a pixel normal to the beam
+
+        The polarization correction is not included, because it also
+        depends on the beam polarization, and transforms use the
+        correction already stored in the detector group of each entry.
+
+        Each use of a geometry file updates its modification time. When
+        a new file is written, other geometry files with the same prefix
+        that have not been used within the expiry time are removed, so
+        that files from superseded calibrations do not accumulate.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Directory in which to store the geometry file.
+        prefix : str, optional
+            Prefix of the geometry file name, by default 'detector'.
+        expiry : float, optional
+            Time in seconds after which unused geometry files are
+            removed, by default one day.
+
+        Returns
+        -------
+        np.memmap
+            Array of shape (6, ny, nx).
+        """
+        import os
+        import tempfile
+        import time
+        geometry_file = Path(directory).joinpath(
+            f'{prefix}_geometry_{self.calibration_hash}.npy')
+        if geometry_file.exists():
+            try:
+                os.utime(geometry_file)
+            except OSError:
+                pass
+        else:
+            ny, nx = [int(i) for i in self.shape]
+            y, x = np.mgrid[0:ny, 0:nx]
+            Mat = self.pixel_size * np.asarray(inv(self.Dmat) *
+                                               inv(self.Omat))
+            pixels = Mat @ np.stack([x.ravel() - self.xc,
+                                     y.ravel() - self.yc,
+                                     np.zeros(x.size)])
+            pixels[0] += self.distance
+            distances = np.sqrt((pixels**2).sum(0))
+            normal = Mat[:, 2] / norm(Mat[:, 2])
+            geometry = np.empty((6, ny, nx))
+            geometry[0:3] = (pixels / distances).reshape(3, ny, nx)
+            geometry[3:5] = self.calculate_angles(x, y)
+            geometry[5] = (np.abs(normal @ pixels) * self.distance**2
+                           / distances**3).reshape(ny, nx)
+            fd, temp_file = tempfile.mkstemp(suffix='.npy',
+                                             dir=geometry_file.parent)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, geometry)
+            os.replace(temp_file, geometry_file)
+            for stale_file in geometry_file.parent.glob(
+                    f'{prefix}_geometry_*.npy'):
+                try:
+                    if (stale_file != geometry_file and
+                            time.time() - stale_file.stat().st_mtime > expiry):
+                        stale_file.unlink()
+                except OSError:
+                    pass
+        return np.load(geometry_file, mmap_mode='r')
 
     def angle_peaks(self, i, j):
         """Return the angle between two peaks in degrees.
@@ -1669,7 +1906,27 @@ class NXRefine:
 
     def get_hkls(self):
         """Return the set of hkls for all the  Bragg peaks as three columns."""
-        return zip(*[self.hkl(i) for i in range(self.npks)])
+        return tuple(self.hkls_array(np.arange(self.npks)).T)
+
+    def hkls_array(self, idx=None):
+        """Return the calculated HKL indices of the specified peaks.
+
+        Parameters
+        ----------
+        idx : array_like, optional
+            Peak indices, by default the peaks defined by `idx`.
+
+        Returns
+        -------
+        ndarray
+            Array of shape (n, 3) containing the HKL indices.
+        """
+        if idx is None:
+            idx = self.idx
+        if self.Umat is None:
+            return np.zeros((len(idx), 3))
+        Gvecs = self.Gvec_array(self.xp[idx], self.yp[idx], self.zp[idx])
+        return (np.asarray(inv(self.UBmat)) @ Gvecs).T
 
     @property
     def hkls(self):
@@ -1770,11 +2027,7 @@ class NXRefine:
 
     def polar(self, i):
         """Return the polar angle in degrees for the specified Bragg peak."""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        peak = Oimat * (vec(self.xp[i], self.yp[i]) - self.Cvec)
-        v = norm(Mat * peak)
-        return np.degrees(np.arctan(v / self.distance))
+        return float(self.calculate_angles(self.xp[i], self.yp[i])[0])
 
     def score(self):
         """Return the goodness of fit of the calculated peak positions."""
@@ -1800,8 +2053,8 @@ class NXRefine:
             self._idx[self.polar_angle>self.polar_max] = ma.masked
             if hkl_tolerance is not None:
                 self._hkl_tolerance = hkl_tolerance
-            mask = [i for i in self._idx.compressed()
-                    if self.diff(i) > self.hkl_tolerance]
+            idx = self._idx.compressed()
+            mask = idx[self.diffs_array(idx) > self.hkl_tolerance]
             self._idx[mask] = ma.masked
 
     @property
@@ -1811,7 +2064,153 @@ class NXRefine:
 
     def diffs(self):
         """Return all the deviations from the calculated peak positions."""
-        return np.array([self.diff(i) for i in self.idx])
+        return self.diffs_array()
+
+    def diffs_array(self, idx=None):
+        """Return the deviations from the calculated peak positions.
+
+        This is a vectorized version of `diff`.
+
+        Parameters
+        ----------
+        idx : array_like, optional
+            Peak indices, by default the peaks defined by `idx`.
+
+        Returns
+        -------
+        ndarray
+            Deviations in reciprocal Å.
+        """
+        hkls = self.hkls_array(idx)
+        return np.sqrt(((np.asarray(self.Bmat) @ (hkls - np.rint(hkls)).T)**2
+                        ).sum(0))
+
+    @property
+    def jacobian_parameters(self):
+        """Parameters with analytic derivatives in `diffs_jacobian`."""
+        return set(['a', 'b', 'c', 'alpha', 'beta', 'gamma', 'wavelength',
+                    'distance', 'xc', 'yc', 'yaw', 'pitch', 'roll',
+                    'chi', 'omega', 'theta', 'phi', 'phi_step',
+                    'xs', 'ys', 'zs'] +
+                   ['U%d%d' % (i, j) for i in range(3) for j in range(3)])
+
+    def diffs_jacobian(self, names, idx=None):
+        """Return the derivatives of the deviations from the HKL positions.
+
+        Each deviation is the length of e = U⁻¹G - Bh₀, where G is the
+        scattering vector and h₀ the nearest integer HKL, which is
+        constant within each derivative. The derivatives are calculated
+        analytically, so that least-squares refinements do not need a
+        separate evaluation of `diffs_array` for each parameter.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the parameters, which must be in `jacobian_parameters`.
+            Lattice parameters are constrained by the crystal symmetry.
+        idx : array_like, optional
+            Peak indices, by default the peaks defined by `idx`.
+
+        Returns
+        -------
+        ndarray
+            Array of shape (n, len(names)) containing the derivatives.
+        """
+        unknown = [p for p in names if p not in self.jacobian_parameters]
+        if unknown:
+            raise NeXusError(
+                f"No analytic derivatives for {', '.join(unknown)}")
+        if idx is None:
+            idx = self.idx
+        x, y, z = self.xp[idx], self.yp[idx], self.zp[idx]
+        phi = (self.phi + self.phi_step * z) * radians
+        cphi, sphi = np.cos(phi), np.sin(phi)
+        zeros, ones = np.zeros(phi.shape), np.ones(phi.shape)
+        Rmats = np.stack([np.stack([cphi, -sphi, zeros], axis=-1),
+                          np.stack([sphi, cphi, zeros], axis=-1),
+                          np.stack([zeros, zeros, ones], axis=-1)], axis=1)
+        dRmats = np.stack([np.stack([-sphi, -cphi, zeros], axis=-1),
+                           np.stack([cphi, -sphi, zeros], axis=-1),
+                           np.stack([zeros, zeros, zeros], axis=-1)],
+                          axis=1) * radians
+        G0 = np.asarray(self._Gmat_cache)
+        Gmats = G0 @ Rmats
+        Oimat = np.asarray(inv(self.Omat))
+        Dimat = np.asarray(inv(self.Dmat))
+        Svec = np.asarray(self.Svec).ravel()
+        pixels = np.stack([x - self.xc, y - self.yc, zeros])
+        v3 = self.pixel_size * Dimat @ Oimat @ pixels
+        v3 -= (Gmats @ Svec).T
+        v3[0] += self.distance
+        r3 = np.sqrt((v3**2).sum(0))
+        u = v3 / r3
+        v4 = u / self.wavelength
+        v4[0] -= 1.0 / self.wavelength
+        Gvecs = np.einsum('nji,jn->in', Gmats, v4)
+        Uimat = np.asarray(inv(self.Umat))
+        Bmat = np.asarray(self.Bmat)
+        UGvecs = Uimat @ Gvecs
+        hkls = np.rint(np.asarray(self.Bimat) @ UGvecs)
+        e = UGvecs - Bmat @ hkls
+        r = np.sqrt((e**2).sum(0))
+        scale = np.divide(1.0, r, out=np.zeros(r.shape), where=r > 0)
+        # Gradients of the residuals with respect to G and to v3
+        dG = Uimat.T @ (e * scale)
+        dv3 = np.einsum('nij,jn->in', Gmats, dG) / self.wavelength
+        dv3 = (dv3 - u * (u * dv3).sum(0)) / r3
+
+        def dgoniometer(dG0, Rmats):
+            RdG = np.einsum('nij,jn->in', Rmats, dG)
+            RSvecs = (Rmats @ Svec).T
+            return ((v4 * (dG0 @ RdG)).sum(0) -
+                    (dv3 * (dG0 @ RSvecs)).sum(0))
+
+        def derivative(p):
+            if p == 'wavelength':
+                return -(dG * Gvecs).sum(0) / self.wavelength
+            elif p == 'distance':
+                return dv3[0]
+            elif p in ('xc', 'yc'):
+                axis = 0 if p == 'xc' else 1
+                return -self.pixel_size * (Dimat @ Oimat)[:, axis] @ dv3
+            elif p in ('roll', 'pitch', 'yaw'):
+                mats = [np.asarray(rotmat(1, self.roll)),
+                        np.asarray(rotmat(2, self.pitch)),
+                        np.asarray(rotmat(3, self.yaw))]
+                axis = ('roll', 'pitch', 'yaw').index(p)
+                mats[axis] = drotmat(axis+1, getattr(self, p))
+                dDimat = mats[0] @ mats[1] @ mats[2]
+                return (dv3 * (self.pixel_size * dDimat @ Oimat @ pixels)
+                        ).sum(0)
+            elif p in ('xs', 'ys', 'zs'):
+                axis = ('xs', 'ys', 'zs').index(p)
+                return -(dv3 * Gmats[:, :, axis].T).sum(0)
+            elif p in ('theta', 'omega', 'chi'):
+                mats = [np.asarray(rotmat(2, self.theta)),
+                        np.asarray(rotmat(3, self.omega)),
+                        np.asarray(rotmat(1, self.chi))]
+                axis = ('theta', 'omega', 'chi').index(p)
+                mats[axis] = drotmat((2, 3, 1)[axis], getattr(self, p))
+                return dgoniometer(mats[0] @ mats[1] @ mats[2], Rmats)
+            elif p == 'phi':
+                return dgoniometer(G0, dRmats)
+            elif p == 'phi_step':
+                return dgoniometer(G0, dRmats) * z
+
+        Bh = Bmat @ hkls
+        constraints = self.symmetry_constraints
+        derivatives = self.Bimat_derivatives()
+        jacobian = np.zeros((len(idx), len(names)))
+        for i, p in enumerate(names):
+            if p in derivatives:
+                if p in constraints:
+                    dBimat = sum(derivatives[q] for q in constraints[p])
+                    jacobian[:, i] = (e * (Bmat @ dBimat @ Bh)).sum(0) * scale
+            elif p.startswith('U'):
+                jacobian[:, i] = -dG[int(p[1])] * UGvecs[int(p[2])]
+            else:
+                jacobian[:, i] = derivative(p)
+        return jacobian
 
     def diff(self, i):
         """Return the deviation from the calculated peak position.
@@ -1836,7 +2235,33 @@ class NXRefine:
 
     def angle_diffs(self):
         """Return the set of polar angle differences for all the peaks"""
-        return np.array([self.angle_diff(i) for i in self.idx])
+        return self.angle_diffs_array()
+
+    def angle_diffs_array(self, idx=None):
+        """Return the polar angle deviations of the specified peaks.
+
+        This is a vectorized version of `angle_diff`.
+
+        Parameters
+        ----------
+        idx : array_like, optional
+            Peak indices, by default the peaks defined by `idx`.
+
+        Returns
+        -------
+        ndarray
+            Differences in degrees.
+        """
+        if idx is None:
+            idx = self.idx
+        hkls = np.rint(self.hkls_array(idx))
+        Bimat = np.asarray(self.Bimat)
+        Gstar = inv(Bimat.T @ Bimat)
+        with np.errstate(divide='ignore'):
+            d = 1.0 / np.sqrt(np.einsum('ni,ij,nj->n', hkls, Gstar, hkls))
+        polar0 = 2 * np.degrees(np.arcsin(self.wavelength / (2 * d)))
+        polar = self.calculate_angles(self.xp[idx], self.yp[idx])[0]
+        return np.abs(polar - polar0)
 
     def angle_diff(self, i):
         """Return the deviation from the calculated peak position in degrees.
@@ -1873,7 +2298,7 @@ class NXRefine:
             H = np.array(H)[peaks]
             K = np.array(K)[peaks]
             L = np.array(L)[peaks]
-            diffs = np.array([self.diff(i) for i in peaks])
+            diffs = self.diffs_array(peaks)
         else:
             H = K = L = diffs = np.zeros(peaks.shape, dtype=float)
         return list(zip(peaks, x, y, z, polar, azi, intensity, H, K, L, diffs))
@@ -1962,7 +2387,12 @@ class NXRefine:
         p0 = self.define_parameters(**opts)
         if len(p0) == 0:
             raise NeXusError('No parameters selected for refinement')
-        self.result = minimize(self.hkl_residuals, p0, method=method)
+        varying = [p for p in p0 if p0[p].vary]
+        if method == 'leastsq' and set(varying) <= self.jacobian_parameters:
+            self.result = minimize(self.hkl_residuals, p0, method=method,
+                                   Dfun=self.hkl_jacobian)
+        else:
+            self.result = minimize(self.hkl_residuals, p0, method=method)
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_parameters(self.result.params)
@@ -1981,7 +2411,25 @@ class NXRefine:
             An array of differences between calculated and nominal HKL values.
         """
         self.get_parameters(parameters)
-        return self.diffs()
+        return self.diffs_array()
+
+    def hkl_jacobian(self, parameters):
+        """Return the derivatives of the HKL residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        array_like
+            An array of derivatives with respect to the varying parameters,
+            with one row for each residual.
+        """
+        self.get_parameters(parameters)
+        return self.diffs_jacobian([p for p in parameters
+                                    if parameters[p].vary])
 
     def refine_angles(self, method='nelder', **opts):
         """Refine parameters based on the calculated polar angles.
@@ -2013,7 +2461,7 @@ class NXRefine:
             angles.
         """
         self.get_parameters(parameters)
-        return self.angle_diffs()
+        return self.angle_diffs_array()
 
     def define_orientation_matrix(self):
         """Return the elements of the orientation matrix as LMFIT parameters.
@@ -2060,7 +2508,11 @@ class NXRefine:
         """
         from lmfit import fit_report, minimize
         p0 = self.define_orientation_matrix()
-        self.result = minimize(self.orient_residuals, p0, method=method)
+        if method == 'leastsq':
+            self.result = minimize(self.orient_residuals, p0, method=method,
+                                   Dfun=self.orient_jacobian)
+        else:
+            self.result = minimize(self.orient_residuals, p0, method=method)
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_orientation_matrix(self.result.params)
@@ -2083,7 +2535,24 @@ class NXRefine:
             An array of differences between calculated and nominal HKL values.
         """
         self.get_orientation_matrix(p)
-        return self.diffs()
+        return self.diffs_array()
+
+    def orient_jacobian(self, p):
+        """Return the derivatives of the HKL residuals.
+
+        Parameters
+        ----------
+        parameters : lmfit.Parameters
+            The set of parameters to be optimized by LMFIT.
+
+        Returns
+        -------
+        array_like
+            An array of derivatives with respect to the orientation matrix
+            elements, with one row for each residual.
+        """
+        self.get_orientation_matrix(p)
+        return self.diffs_jacobian([name for name in p if p[name].vary])
 
     def get_polarization(self, beam_polarization=0.99):
         """Return the synchrotron x-ray polarization across the detector.
@@ -6,7 +6,12 @@
 # The full license is in the file LICENSE.pdf, distributed with this software.
 # -----------------------------------------------------------------------------
 
+import ctypes
+import ctypes.util
 import os
+import select
+import shlex
+import struct
 import subprocess
 import tempfile
 import time
@@ -14,7 +19,7 @@ from configparser import ConfigParser
 from datetime import datetime
 from pathlib import Path
 from queue import Queue
-from threading import Thread
+from threading import Condition, Thread
 
 import psutil
 from nexusformat.nexus import NeXusError, NXLock
@@ -23,7 +28,9 @@ from persistqueue.exceptions import Empty as FileEmpty
 from persistqueue.serializers import json
 
 from .nxdaemon import NXDaemon
+from .nxdatabase import NXDatabase
 from .nxsettings import NXSettings
+from .nxutils import default_process_count
 
 
 def get_servers():
@@ -37,6 +44,39 @@ def get_servers():
     return ['direct', 'multicore', 'multinode']
 
 
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_IGNORED = 0x00008000
+
+
+def inotify_watch(directory):
+    """Return an inotify file descriptor watching a directory.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Path to the directory to be watched.
+
+    Returns
+    -------
+    int
+        File descriptor for reading events when files in the directory
+        are written or moved into it, or None if inotify is unavailable.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (AttributeError, OSError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory),
+                              IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
 class NXFileQueue(FileQueue):
     """A file-based queue with locked access"""
 
@@ -57,6 +97,8 @@ class NXFileQueue(FileQueue):
         tempdir = self.directory / 'tempdir'
         tempdir.mkdir(mode=0o777, exist_ok=True)
         self.lock = NXLock(self.directory / 'filequeue')
+        self._watch = None
+        self._info_time = None
         with self.lock:
             super().__init__(directory, serializer=json, autosave=autosave,
                              tempdir=tempdir)
@@ -92,6 +134,75 @@ class NXFileQueue(FileQueue):
                 items.append(super().get(timeout=0))
         return items
 
+    def wait(self, timeout=None):
+        """Wait until the queue is saved by any process.
+
+        On Linux, inotify is used to return as soon as the queue
+        information is replaced, which happens after every put or get.
+        Otherwise, the modification time of the queue information is
+        polled every half second. Since inotify does not report changes
+        made on other hosts of a network file system, the timeout should
+        be used to bound the wait when the queue is shared between nodes.
+
+        The first call returns immediately, since items added before the
+        watch started would otherwise be missed.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds, by default None
+
+        Returns
+        -------
+        bool
+            True if the queue may have changed, False if the wait timed
+            out.
+        """
+        if self._watch is None:
+            self._watch = inotify_watch(self.directory)
+            if self._watch is None:
+                self._watch = False
+            self._info_time = self.info_time()
+            return True
+        if timeout is not None:
+            end = time.monotonic() + timeout
+        while True:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(end - time.monotonic(), 0.0)
+            if self._watch is False:
+                info_time = self.info_time()
+                if info_time != self._info_time:
+                    self._info_time = info_time
+                    return True
+                elif remaining is not None and remaining <= 0.0:
+                    return False
+                time.sleep(0.5 if remaining is None else min(0.5, remaining))
+                continue
+            ready, _, _ = select.select([self._watch], [], [], remaining)
+            if not ready:
+                return False
+            events = os.read(self._watch, 4096)
+            offset = 0
+            while offset < len(events):
+                _, mask, _, size = struct.unpack_from('iIII', events, offset)
+                name = events[offset+16:offset+16+size].rstrip(b'\0')
+                offset += 16 + size
+                if mask & IN_IGNORED:
+                    os.close(self._watch)
+                    self._watch = None
+                    return True
+                elif name == b'info':
+                    return True
+
+    def info_time(self):
+        """Return the modification time of the queue information."""
+        try:
+            return os.stat(self._infopath()).st_mtime_ns
+        except OSError:
+            return None
+
     def fix_access(self):
         """Ensure that the file queue pointer is readable."""
         for f in [f for f in self.directory.iterdir() if f.is_file()]:
@@ -115,6 +226,9 @@ class NXController(Thread):
         self.server = server
         self.server_log = self.server.server_log
         self.cpu_file = self.server_log.parent.joinpath('last_cpu')
+        self.scheduler = NXScheduler(self.submit_task,
+                                     cores=len(self.server.cpus),
+                                     memory=self.server.node_memory)
 
     def __repr__(self):
         return f"NXController(pid={os.getpid()})"
@@ -122,14 +236,14 @@ class NXController(Thread):
     def run(self):
         self.log(f"Starting controller on pid={os.getpid()}")
         while True:
-            time.sleep(10)
             next_task = self.controller_queue.get()
             if next_task is None or next_task == 'stop':
+                self.scheduler.join()
                 self.log(f"Stopping controller on pid={os.getpid()}")
                 self.controller_queue.task_done()
                 break
             else:
-                self.submit_task(next_task)
+                self.scheduler.add(NXTask(next_task, self.server))
             self.controller_queue.task_done()
         return
 
@@ -140,9 +254,10 @@ class NXController(Thread):
         """Run the task directly in the shell."""
         cpu = self.get_cpu()
         worker_queue = Queue()
-        worker = NXWorker(cpu, worker_queue, self.server_log)
+        worker = NXWorker(cpu, worker_queue, self.server_log,
+                          scheduler=self.scheduler)
         worker.start()
-        worker_queue.put(NXTask(task, self.server))
+        worker_queue.put(task)
         worker_queue.put(None)
 
     def get_cpu(self):
@@ -174,11 +289,12 @@ class NXController(Thread):
 class NXWorker(Thread):
     """Class for processing tasks on a specific cpu."""
 
-    def __init__(self, cpu, worker_queue, server_log):
+    def __init__(self, cpu, worker_queue, server_log, scheduler=None):
         super().__init__()
         self.cpu = cpu
         self.worker_queue = worker_queue
         self.server_log = server_log
+        self.scheduler = scheduler
         cpu_log = self.cpu + '.log'
         self.cpu_log = self.server_log.parent / cpu_log
 
@@ -188,7 +304,6 @@ class NXWorker(Thread):
     def run(self):
         self.log(f"Starting worker on {self.cpu}")
         while True:
-            time.sleep(5)
             next_task = self.worker_queue.get()
             if next_task is None:
                 self.log(f"Stopping worker on {self.cpu}")
@@ -196,8 +311,12 @@ class NXWorker(Thread):
                 break
             else:
                 self.log(f"{self.cpu}: Executing '{next_task.command}'")
-                with NXLock(self.cpu_log, timeout=3600, expiry=3600):
-                    next_task.execute(self.cpu, self.cpu_log)
+                try:
+                    with NXLock(self.cpu_log, timeout=3600, expiry=3600):
+                        next_task.execute(self.cpu, self.cpu_log)
+                finally:
+                    if self.scheduler is not None:
+                        self.scheduler.finish(next_task)
             self.worker_queue.task_done()
             self.log(f"{self.cpu}: Finished '{next_task.command}'")
         return
@@ -212,14 +331,136 @@ class NXWorker(Thread):
 class NXTask:
     """Class for submitting tasks to different cpus."""
 
+    stages = {'load': 'nxload', 'link': 'nxlink', 'max': 'nxmax',
+              'find': 'nxfind', 'refine': 'nxrefine', 'prepare': 'nxprepare',
+              'transform': 'nxtransform', 'combine': 'nxcombine',
+              'pdf': 'nxpdf'}
+    # Tasks that run in a single process; others use concurrent workers
+    serial_tasks = ('nxload', 'nxlink', 'nxrefine')
+
     def __init__(self, command, server):
         self.command = command
         self.name = command.split()[0]
         self.server = server
+        self.directory, self.entries, self.tasks = self.parse_command()
+        self.prerequisites = NXDatabase.prerequisites(self.tasks)
+        self.cores, self.memory = self.requirements()
+        self.granted = None
 
     def __repr__(self):
         return f"NXTask('{self.name}')"
 
+    def parse_command(self):
+        """Return the scan directory, entries and tasks of the command.
+
+        Returns
+        -------
+        tuple of (str, set of str, set of str)
+            The scan directory, the entries, which are None if the
+            command applies to all entries, and the database names of
+            the tasks that the command performs. No tasks are returned
+            for commands that are not part of the reduction workflow.
+        """
+        try:
+            words = shlex.split(self.command)
+        except ValueError:
+            words = self.command.split()
+        options = {}
+        key = None
+        for word in words[1:]:
+            if word.startswith('-'):
+                key = {'-d': 'directory', '-e': 'entries'}.get(
+                    word, word.lstrip('-'))
+                options[key] = []
+            elif key:
+                options[key].append(word)
+        name = Path(words[0]).name if words else ''
+        if name == 'nxreduce':
+            stages = [s for s in self.stages if s in options]
+        elif name[2:] in self.stages:
+            stages = [name[2:]]
+        else:
+            stages = []
+        tasks = set()
+        for stage in stages:
+            if stage in ('transform', 'combine', 'pdf'):
+                if 'mask' in options:
+                    tasks.add(f"nxmasked_{stage}")
+                if 'regular' in options or 'mask' not in options:
+                    tasks.add(self.stages[stage])
+            else:
+                tasks.add(self.stages[stage])
+        if 'directory' in options and options['directory']:
+            directory = os.path.normpath(options['directory'][0])
+        else:
+            directory = None
+        if (tasks and tasks <= set(NXDatabase.scan_task_names)
+                or not options.get('entries')):
+            entries = None
+        else:
+            entries = set(options['entries'])
+        return directory, entries, tasks
+
+    def requirements(self):
+        """Return the cores and memory required by the command.
+
+        Tasks in the reduction workflow that use concurrent workers
+        request the default number of processes used by NXReduce, and
+        other commands request a single core. If the server settings
+        define the memory of each worker in GB, each core also requires
+        that memory.
+
+        Returns
+        -------
+        tuple of (int, float)
+            Number of cores and memory in GB, which is zero if the
+            memory is not limited.
+        """
+        if self.tasks and not self.tasks <= set(self.serial_tasks):
+            cores = default_process_count()
+        else:
+            cores = 1
+        memory = getattr(self.server, 'memory', None)
+        if memory:
+            return cores, cores * memory
+        else:
+            return cores, 0.0
+
+    @property
+    def scan_task(self):
+        """True if the command only performs tasks on the whole scan."""
+        return (bool(self.tasks) and
+                self.tasks <= set(NXDatabase.scan_task_names))
+
+    def depends_on(self, task, earlier=True):
+        """True if this task must wait until another task has finished.
+
+        A task waits for an earlier task on the same scan and entries
+        that performs one of its prerequisites or one of the same tasks.
+        Tasks on the whole scan, such as nxcombine, also wait for later
+        tasks that perform their prerequisites, so that they are only
+        run after the tasks of every entry have finished.
+
+        Parameters
+        ----------
+        task : NXTask
+            Another task that has not finished.
+        earlier : bool, optional
+            True if the other task was added first, by default True
+        """
+        if not (self.tasks and task.tasks):
+            return False
+        elif self.directory != task.directory:
+            return False
+        elif (self.entries is not None and task.entries is not None and
+                not self.entries & task.entries):
+            return False
+        elif earlier:
+            return bool(task.tasks & (self.prerequisites | self.tasks))
+        else:
+            return (self.scan_task and not task.scan_task and
+                    bool(task.tasks & self.prerequisites))
+
     def executable_command(self, cpu, cpu_log):
         """Wrap command according to the server type."""
         if self.server.template:
@@ -244,8 +485,11 @@ class NXTask:
         with open(cpu_log, 'a') as f:
             f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ' ' +
                     self.command + '\n')
+        env = dict(os.environ)
+        if self.granted:
+            env['NX_CORES'] = str(self.granted)
         process = subprocess.run(self.executable_command(cpu, cpu_log),
-                                 shell=True,
+                                 shell=True, env=env,
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
         if process.stdout:
@@ -258,6 +502,105 @@ class NXTask:
             self.script.unlink()
 
 
+class NXScheduler:
+    """Dispatch tasks once the tasks they depend on have finished.
+
+    The dependencies between the reduction tasks are defined by
+    `NXDatabase.task_dependencies`. A task that does not depend on any
+    unfinished task is dispatched immediately, so independent stages of
+    different entries and scans run concurrently. A command that is
+    identical to one still waiting is ignored.
+
+    If the capacity of the node is given, tasks are only dispatched when
+    the cores and memory they require are not used by running tasks.
+    Smaller tasks may then be dispatched before larger tasks that were
+    added earlier. The number of cores granted to each task is passed
+    to it when it is executed.
+    """
+
+    def __init__(self, dispatch, cores=None, memory=None):
+        """Create a scheduler that passes ready tasks to a function.
+
+        Parameters
+        ----------
+        dispatch : function
+            Function called with each NXTask that is ready to run. It is
+            called while the scheduler is locked, so it should not block.
+        cores : int, optional
+            Number of cores available to the tasks, by default None,
+            which does not limit the tasks.
+        memory : float, optional
+            Memory available to the tasks in GB, by default None, which
+            does not limit the tasks.
+        """
+        self.dispatch = dispatch
+        self.cores = cores
+        self.memory = memory
+        self.waiting = []
+        self.running = []
+        self.condition = Condition()
+
+    def __repr__(self):
+        return (f"NXScheduler(waiting={len(self.waiting)}, "
+                f"running={len(self.running)})")
+
+    def add(self, task):
+        """Add a task, dispatching it if it is ready to run."""
+        with self.condition:
+            if any(t.command == task.command for t in self.waiting):
+                return
+            self.waiting.append(task)
+            self.release()
+
+    def finish(self, task):
+        """Record that a task has finished and release its dependents."""
+        with self.condition:
+            if task in self.running:
+                self.running.remove(task)
+            self.release()
+            self.condition.notify_all()
+
+    def release(self):
+        """Dispatch the waiting tasks that no longer need to wait."""
+        for task in list(self.waiting):
+            i = self.waiting.index(task)
+            if any(task.depends_on(t) for t in
+                   self.running + self.waiting[:i]):
+                continue
+            elif any(task.depends_on(t, earlier=False)
+                     for t in self.waiting[i+1:]):
+                continue
+            elif not self.fits(task):
+                continue
+            if self.cores:
+                task.granted = min(task.cores, self.cores)
+            self.waiting.remove(task)
+            self.running.append(task)
+            self.dispatch(task)
+
+    def fits(self, task):
+        """True if the resources required by a task are available.
+
+        Tasks that require more than the total capacity are limited to
+        it, so they run when no other task is running.
+        """
+        if self.cores:
+            used = sum(t.granted or 0 for t in self.running)
+            if used + min(task.cores, self.cores) > self.cores:
+                return False
+        if self.memory and task.memory:
+            used = sum(t.memory for t in self.running)
+            if used and used + min(task.memory, self.memory) > self.memory:
+                return False
+        return True
+
+    def join(self):
+        """Wait until all the tasks have finished."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.waiting and not self.running)
+
+
 class NXServer(NXDaemon):
 
     def __init__(self, directory=None, server_type=None):
@@ -265,6 +608,7 @@ class NXServer(NXDaemon):
         self.initialize(directory, server_type)
         self.worker_queue = None
         self.workers = []
+        self.scheduler = None
         self._task_queue = None
         self._controller = None
         if self.server_type != 'direct':
@@ -330,6 +674,10 @@ class NXServer(NXDaemon):
                 cpu_count = psutil.cpu_count()
             self.cpus = ['cpu'+str(cpu) for cpu in range(1, cpu_count+1)]
         self.concurrent = self.settings.get('server', 'concurrent')
+        if self.settings.has_option('server', 'memory'):
+            self.memory = self.settings.get('server', 'memory')
+        else:
+            self.memory = None
         self.run_command = self.settings.get('server', 'run_command')
         self.template = self.settings.get('server', 'template')
         self.server_log = self.directory / 'nxserver.log'
@@ -353,6 +701,14 @@ class NXServer(NXDaemon):
             self._controller = NXController(self._task_queue, self)
         return self._controller
 
+    @property
+    def node_memory(self):
+        """Total memory of the node in GB, if worker memory is limited."""
+        if self.memory:
+            return psutil.virtual_memory().total / 1e9
+        else:
+            return None
+
     def read_nodes(self):
         """Read available nodes"""
         if 'nodes' in self.settings.sections():
@@ -397,21 +753,34 @@ class NXServer(NXDaemon):
         Create worker processes to process commands from the task queue
 
         Create a worker for each cpu, read commands from the server
-        queue, and add an NXTask for each command to a Queue.
+        queue, and add an NXTask for each command to a Queue, once the
+        tasks it depends on have finished. When the server queue is
+        empty, the server waits until it is saved by another process,
+        checking it at least every ten seconds in case the change is not
+        reported.
         """
         self.log(f'Starting server (pid={os.getpid()})')
         self.worker_queue = Queue()
-        self.workers = [NXWorker(cpu, self.worker_queue, self.server_log)
+        if self.server_type == 'multinode':
+            self.scheduler = NXScheduler(self.worker_queue.put)
+        else:
+            self.scheduler = NXScheduler(self.worker_queue.put,
+                                         cores=len(self.cpus),
+                                         memory=self.node_memory)
+        self.workers = [NXWorker(cpu, self.worker_queue, self.server_log,
+                                 scheduler=self.scheduler)
                         for cpu in self.cpus]
         for worker in self.workers:
             worker.start()
         while True:
-            time.sleep(10)
             command = self.read_task()
             if command == 'stop':
                 break
             elif command:
-                self.worker_queue.put(NXTask(command, self))
+                self.scheduler.add(NXTask(command, self))
+            else:
+                self.task_queue.wait(timeout=10)
+        self.scheduler.join()
         for worker in self.workers:
             self.worker_queue.put(None)
         self.worker_queue.join()
@@ -20,7 +20,8 @@ class NXSettings(ConfigParser):
         super().__init__(allow_no_value=True)
         self.defaults = {
             'server': {'type': 'multicore', 'cores': 4, 'concurrent': True,
-                       'run_command': None, 'template': None, 'cctw': 'cctw'},
+                       'memory': None, 'run_command': None, 'template': None,
+                       'cctw': 'cctw', 'mask_storage': None},
             'instrument': {'source': None, 'instrument': None,
                            'raw_home': None, 'raw_path': None,
                            'analysis_home': None, 'analysis_path': None,
@@ -10,6 +10,7 @@ import tempfile
 from pathlib import Path
 
 import numpy as np
+import psutil
 from nexusformat.nexus import nxopen, nxsetconfig
 
 from .nxutils import NXExecutor, as_completed
@@ -129,6 +130,163 @@ def symmetrize_data(symm_function, data_type, data_file, data_path):
     return data_type, root.nxfilename
 
 
+def flip(axis=None):
+    """Return the axis mapping of `np.flip` as (source axes, reversals)."""
+    return (0, 1, 2), tuple(axis is None or axis == i for i in range(3))
+
+
+def rot90(k, axes):
+    """Return the axis mapping of `np.rot90` as (source axes, reversals)."""
+    p, q = axes
+    source, reversals = [0, 1, 2], [False, False, False]
+    if k == 2:
+        reversals[p] = reversals[q] = True
+    else:
+        source[p], source[q] = q, p
+        reversals[p if k == 1 else q] = True
+    return tuple(source), tuple(reversals)
+
+
+def transpose(axes):
+    """Return the axis mapping of `np.transpose` as (source axes, reversals)."""
+    return tuple(axes), (False, False, False)
+
+
+# Each symmetry function adds a sequence of flips, rotations or transposes
+# of the accumulated array to itself. These are stored as axis mappings, so
+# that the result can be evaluated one slab at a time.
+symmetry_operations = {
+    triclinic: [flip()],
+    monoclinic: [rot90(2, (0, 2)), flip(1)],
+    orthorhombic: [flip(0), flip(1), flip(2)],
+    tetragonal1: [rot90(1, (1, 2)), rot90(2, (1, 2)), flip(0)],
+    tetragonal2: [rot90(1, (1, 2)), rot90(2, (1, 2)), rot90(2, (0, 1)),
+                  flip(0)],
+    hexagonal: [rot90(2, (1, 2)), flip(0)],
+    cubic1: [transpose((1, 2, 0)), transpose((2, 0, 1))],
+    cubic2: [transpose((1, 2, 0)), transpose((2, 0, 1)),
+             transpose((0, 2, 1)), flip(0), flip(1), flip(2)]}
+
+
+def read_slab(data_root, data_type, data_path, entries, region):
+    """Read the unsymmetrized signal or weights within a slab.
+
+    Parameters
+    ----------
+    data_root : NXroot
+        Root of the file containing the data.
+    data_type : {'signal', 'weights'}
+        Type of data to be read.
+    data_path : str
+        Path to the data field, or the name of the data group in each
+        entry if `entries` is True.
+    entries : bool
+        True if the data are summed over all the numbered entries.
+    region : tuple of int
+        Axis, start and stop indices of the slab.
+    """
+    axis, start, stop = region
+    idx = [slice(None)] * 3
+    idx[axis] = slice(start, stop)
+    idx = tuple(idx)
+    if entries:
+        data = None
+        for i, entry in enumerate([e for e in data_root if e[-1].isdigit()]):
+            group = data_root[entry][data_path]
+            if data_type == 'signal':
+                slab = group.nxsignal[idx].nxvalue
+            elif group.nxweights:
+                slab = group.nxweights[idx].nxvalue
+            elif i == 0:
+                signal = group.nxsignal[idx].nxvalue
+                slab = np.zeros(signal.shape, dtype=signal.dtype)
+                slab[np.where(signal > 0)] = 1
+            else:
+                continue
+            if data is None:
+                data = np.array(slab)
+            else:
+                data += slab
+    elif data_type == 'signal':
+        data = data_root[data_path][idx].nxvalue
+    else:
+        signal = data_root[data_path][idx].nxvalue
+        data = np.zeros(signal.shape, signal.dtype)
+        data[np.where(signal > 0)] = 1
+    return np.nan_to_num(data)
+
+
+def symmetrize_slab(operations, data_type, data_root, data_path, entries,
+                    shape, start, stop):
+    """Return the symmetrized data within a slab of the first axis.
+
+    The symmetry operations are applied in the same order as the in-memory
+    symmetry functions, so the sums are identical. The slab of each
+    intermediate sum is calculated recursively from the slabs related by
+    the subsequent operations, so only these slabs are read from the file.
+    """
+    cache = {}
+
+    def evaluate(k, region):
+        if (k, region) not in cache:
+            if k == 0:
+                cache[(k, region)] = read_slab(data_root, data_type,
+                                               data_path, entries, region)
+            else:
+                source, reversals = operations[k-1]
+                axis, lo, hi = region
+                n = shape[source[axis]]
+                if reversals[axis]:
+                    source_region = (source[axis], n-hi, n-lo)
+                else:
+                    source_region = (source[axis], lo, hi)
+                slab = np.transpose(evaluate(k-1, source_region), source)
+                slab = np.flip(slab, [i for i in range(3) if reversals[i]])
+                cache[(k, region)] = evaluate(k-1, region) + slab
+        return cache[(k, region)]
+
+    return evaluate(len(operations), (0, start, stop))
+
+
+def symmetrize_block(operations, data_file, data_path, entries, start,
+                     stop):
+    """Return the symmetrized signal divided by the symmetrized weights.
+
+    Parameters
+    ----------
+    operations : list of tuples
+        Axis mappings of the symmetry operations.
+    data_file : str
+        Name of the file containing the data.
+    data_path : str
+        Path to the data field or group.
+    entries : bool
+        True if the data are summed over all the numbered entries.
+    start, stop : int
+        Range of the block along the first axis.
+
+    Returns
+    -------
+    tuple of (int, ndarray)
+        Start of the block and the symmetrized data.
+    """
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    with nxopen(data_file, 'r') as data_root:
+        if entries:
+            data_path = Path(data_path).name
+            entry = [e for e in data_root if e[-1].isdigit()][0]
+            shape = data_root[entry][data_path].nxsignal.shape
+        else:
+            shape = data_root[data_path].shape
+        signal = symmetrize_slab(operations, 'signal', data_root, data_path,
+                                 entries, shape, start, stop)
+        weights = symmetrize_slab(operations, 'weights', data_root,
+                                  data_path, entries, shape, start, stop)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(weights > 0, signal / weights, 0.0)
+    return start, result
+
+
 laue_functions = {'-1': triclinic,
                   '2/m': monoclinic,
                   'mmm': orthorhombic,
@@ -152,7 +310,40 @@ class NXSymmetry:
         self.data_file = data.nxfilename
         self.data_path = data.nxpath
 
-    def symmetrize(self, entries=False):
+    def symmetrize(self, entries=False, output=None, block_size=None,
+                   memory=None, max_workers=2):
+        """Symmetrize the data using the Laue group.
+
+        Parameters
+        ----------
+        entries : bool, optional
+            True if the data are summed over all the numbered entries, by
+            default False.
+        output : NXfield, optional
+            Field, with the same shape as the data, in which to store the
+            result. If this is given, the data are symmetrized in blocks
+            along the first axis, so the whole array is never held in
+            memory. By default, the result is returned as an array.
+        block_size : int, optional
+            Number of planes in each block, by default calculated from the
+            memory budget.
+        memory : float, optional
+            Memory budget of each worker in bytes, used to calculate the
+            block size. By default, this is half of the available memory
+            divided by the number of workers.
+        max_workers : int, optional
+            Number of processes, by default 2.
+
+        Returns
+        -------
+        ndarray or NXfield
+            The symmetrized data.
+        """
+        if output is not None:
+            return self.symmetrize_blocks(output, entries=entries,
+                                          block_size=block_size,
+                                          memory=memory,
+                                          max_workers=max_workers)
         if entries:
             symmetrize = symmetrize_entries
         else:
@@ -174,3 +365,43 @@ class NXSymmetry:
         with np.errstate(divide='ignore', invalid='ignore'):
             result = np.where(weights > 0, signal / weights, 0.0)
         return result
+
+    def symmetrize_blocks(self, output, entries=False, block_size=None,
+                          memory=None, max_workers=2):
+        """Symmetrize the data in blocks, writing them to the output field.
+
+        Each block is a slab along the first axis. Every symmetry operation
+        maps it to one slab along the same or another axis, so the peak
+        memory is a small multiple of the slab size, rather than of the
+        whole array. If the block size is not given, it is chosen so that
+        the slabs held by each worker fit within its memory budget, which
+        is independent of the nexusformat memory limit.
+        """
+        operations = symmetry_operations[self.symm_function]
+        shape = output.shape
+        if block_size is None:
+            if memory is None:
+                memory = (psutil.virtual_memory().available
+                          / (2 * max(max_workers, 1)))
+            plane_size = np.prod(shape[1:]) * 8
+            slab_count = 6 * (len(operations) + 1)
+            block_size = int(memory / (plane_size * slab_count))
+        block_size = min(max(block_size, 1), shape[0])
+        blocks = [(operations, self.data_file, self.data_path, entries,
+                   start, min(start+block_size, shape[0]))
+                  for start in range(0, shape[0], block_size)]
+        if max_workers > 1:
+            with NXExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(symmetrize_block, *block)
+                           for block in blocks]
+                for future in as_completed(futures):
+                    start, result = future.result()
+                    with output.nxfile:
+                        output[start:start+result.shape[0]] = result
+                    futures.remove(future)
+        else:
+            for block in blocks:
+                start, result = symmetrize_block(*block)
+                with output.nxfile:
+                    output[start:start+result.shape[0]] = result
+        return output
@@ -6,12 +6,19 @@
 # The full license is in the file LICENSE.pdf, distributed with this software.
 # -----------------------------------------------------------------------------
 
+import logging
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed  # noqa: F401
-from multiprocessing import get_context, resource_tracker
-
+import threading
+import timeit
+from concurrent.futures import (Future, ProcessPoolExecutor,  # noqa: F401
+                                as_completed)
+from multiprocessing import get_context, resource_tracker, util
+from multiprocessing.shared_memory import SharedMemory
+
+import h5py as h5
 import numpy as np
+import psutil
 
 if sys.version_info < (3, 10):
     from importlib_resources import files as package_files
@@ -22,9 +29,284 @@ from nexusformat.nexus import (NeXusError, NXdata, NXentry, NXfield, NXlog,
                                NXroot, nxopen, nxsetconfig)
 from skimage.feature import peak_local_max
 
+logger = logging.getLogger(__name__)
+
+# Values published to each NXExecutor worker process by init_worker
+_worker_state = {}
+
+
+def init_worker(data_file=None, data_path=None, shared=None):
+    """Initialize a worker process started by NXExecutor.
+
+    This is run once in each worker process. Arrays in shared memory are
+    attached as read-only NumPy arrays and the data file is kept open,
+    so that tasks only need to be passed the range of frames to process.
+    The file is closed when the worker exits. If it cannot be opened, a
+    warning is logged and tasks open the file themselves.
+
+    Parameters
+    ----------
+    data_file : str, optional
+        File path to the raw data file
+    data_path : str, optional
+        Internal path to the raw data
+    shared : dict, optional
+        The `values` attribute of an NXSharedData instance.
+    """
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    _worker_state.clear()
+    _worker_state['memory'] = []
+    _worker_state['values'] = {}
+    for name, (value, spec) in (shared or {}).items():
+        if spec is not None:
+            shm_name, shape, dtype = spec
+            shm = _attach_shared_memory(shm_name)
+            value = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            value.flags.writeable = False
+            _worker_state['memory'].append(shm)
+        _worker_state['values'][name] = value
+    if data_file is not None:
+        try:
+            data_root = h5.File(data_file, 'r')
+            util.Finalize(None, data_root.close, exitpriority=0)
+            _worker_state['data'] = (str(data_file), str(data_path),
+                                     data_root[data_path])
+        except Exception:
+            logger.warning(f"Unable to open '{data_path}' in '{data_file}' "
+                           "in worker process", exc_info=True)
+
+
+def _attach_shared_memory(name):
+    """Attach to shared memory without registering it for cleanup.
+
+    The block is owned, and unlinked, by the parent process.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def shared_value(name, value=None):
+    """Return a value published to the worker if none is given.
+
+    Parameters
+    ----------
+    name : str
+        Name of the value in the dictionary passed to NXExecutor.
+    value : object, optional
+        Value passed explicitly to the task, which takes precedence.
+    """
+    if value is None:
+        value = _worker_state.get('values', {}).get(name)
+    return value
+
+
+def read_frames(data_file, data_path, j, k):
+    """Read a slab of frames, using the worker's open file if possible.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    j : int
+        Index of first frame
+    k : int
+        Index of last frame (exclusive)
+
+    Returns
+    -------
+    ndarray
+        The frames from j to k.
+    """
+    if 'data' in _worker_state:
+        worker_file, worker_path, data = _worker_state['data']
+        if (worker_file, worker_path) == (str(data_file), str(data_path)):
+            return data[j:k]
+    nxsetconfig(lock=3600, lockexpiry=28800)
+    with nxopen(data_file, 'r') as data_root:
+        return data_root[data_path][j:k].nxvalue
+
+
+def open_growing_file(data_file):
+    """Open a raw data file that may still be written by the detector.
+
+    The file is opened for single-writer/multiple-reader (SWMR) access
+    if its format allows it, so that frames are read consistently while
+    they are being written. Otherwise, it is opened normally, and must
+    be reopened to see new frames.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+
+    Returns
+    -------
+    h5py.File
+        The open file, which should be closed after use.
+    """
+    try:
+        return h5.File(data_file, 'r', swmr=True)
+    except (OSError, ValueError):
+        return h5.File(data_file, 'r')
+
+
+def default_process_count():
+    """Return the number of processes used by default in concurrent tasks.
+
+    This is half the number of CPUs on nodes with more than eight, and
+    four otherwise.
+    """
+    pc = os.cpu_count()
+    if pc > 8:
+        return pc // 2
+    else:
+        return 4
+
+
+def plan_chunks(shape, dtype, chunks=None, memory=None, workers=1,
+                minimum=1, maximum=None, overlap=0, copies=8, multiple=None):
+    """Return the number of frames to be processed in each chunk.
+
+    The number of frames is chosen so that each worker's slab, including
+    overlapping frames and working copies, fits within its memory
+    budget. If possible, it is a multiple of the number of frames in
+    each HDF5 chunk, so that no stored chunk is split between slabs and
+    decompressed more than once. When there are multiple workers, the
+    frames are divided into at least four chunks per worker to balance
+    the load. If a multiple is specified, the number of frames is
+    rounded down to a multiple of it, so that the chunk boundaries
+    coincide with those of a fixed grid.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the 3D data, with frames along the first axis
+    dtype : dtype
+        Data type of the stored data
+    chunks : tuple of int, optional
+        Shape of the HDF5 chunks, by default None
+    memory : float, optional
+        Memory budget of each worker in bytes. By default, this is half
+        of the available memory divided by the number of workers.
+    workers : int, optional
+        Number of workers processing chunks concurrently, by default 1
+    minimum : int, optional
+        Minimum number of frames in a chunk, by default 1
+    maximum : int, optional
+        Maximum number of frames in a chunk, by default None
+    overlap : int, optional
+        Number of extra frames read on either side of each chunk, by
+        default 0
+    copies : float, optional
+        Size of the working arrays required for each frame in units of
+        the stored frame size, by default 8
+    multiple : int, optional
+        Number of frames that each chunk must be a multiple of, by
+        default None
+
+    Returns
+    -------
+    int
+        Number of frames in each chunk.
+    """
+    nframes = shape[0]
+    workers = max(int(workers), 1)
+    frame_size = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+    if memory is None:
+        memory = psutil.virtual_memory().available / (2 * workers)
+    size = int(memory // (copies * max(frame_size, 1))) - 2 * overlap
+    if workers > 1:
+        size = min(size, -(-nframes // (4 * workers)))
+    if maximum is not None:
+        size = min(size, maximum)
+    size = min(max(size, minimum), nframes)
+    if chunks and chunks[0] > 1:
+        if size >= chunks[0]:
+            size -= size % chunks[0]
+        else:
+            size = min(chunks[0], nframes)
+    if multiple:
+        size = max(size - size % multiple, multiple)
+    return max(size, 1)
+
+
+def chunk_ranges(first, last, size):
+    """Return the limits of each chunk of frames from first to last.
+
+    Chunk boundaries after the first are multiples of the chunk size, so
+    that they are aligned with the HDF5 chunks if the chunk size is
+    planned by `plan_chunks`.
+
+    Parameters
+    ----------
+    first : int
+        Index of the first frame
+    last : int
+        Index of the last frame (exclusive)
+    size : int
+        Number of frames in each chunk
 
-def peak_search(data_file, data_path, i, j, k, threshold, mask=None,
-                min_pixels=10):
+    Returns
+    -------
+    list of tuple of int
+        First and last (exclusive) frames of each chunk.
+    """
+    ranges = []
+    i = first
+    while i < last:
+        j = min((i // size + 1) * size, last)
+        ranges.append((i, j))
+        i = j
+    return ranges
+
+
+def unprocessed_ranges(done, first, last, size):
+    """Return the limits of chunks containing frames not yet processed.
+
+    Parameters
+    ----------
+    done : array-like of bool
+        True for each frame that has already been processed. Frames
+        beyond the end of the array are assumed not to be processed.
+    first : int
+        Index of the first frame
+    last : int
+        Index of the last frame (exclusive)
+    size : int
+        Number of frames in each chunk
+
+    Returns
+    -------
+    list of tuple of int
+        First and last (exclusive) frames of each chunk, which are
+        aligned as in `chunk_ranges`.
+    """
+    processed = np.zeros(last, dtype=bool)
+    done = np.asarray(done, dtype=bool)[:last]
+    processed[:done.size] = done
+    frames = np.flatnonzero(~processed[first:last]) + first
+    if frames.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(frames) > 1)
+    starts = np.concatenate(([frames[0]], frames[breaks+1]))
+    stops = np.concatenate((frames[breaks] + 1, [frames[-1] + 1]))
+    ranges = []
+    for start, stop in zip(starts, stops):
+        ranges.extend(chunk_ranges(int(start), int(stop), size))
+    return ranges
+
+
+def peak_search(data_file, data_path, i, j, k, threshold=None, mask=None,
+                min_pixels=None):
     """Identify peaks in the slab of raw data
 
     Parameters
@@ -39,6 +321,37 @@ def peak_search(data_file, data_path, i, j, k, threshold, mask=None,
         Index of first z-value of processed slab
     k : int
         Index of last z-value of processed slab
+    threshold : float, optional
+        Peak threshold, by default the value published to the worker
+    mask : array-like, optional
+        Pixel mask for detector, by default the published 'pixel_mask'
+    min_pixels : int, optional
+        Minimum pixel separation of peaks, default=10
+
+    Returns
+    -------
+    list of NXBlobs
+        Peak locations and intensities stored in NXBlob instances
+    """
+    threshold = shared_value('threshold', threshold)
+    mask = shared_value('pixel_mask', mask)
+    min_pixels = shared_value('min_pixels', min_pixels) or 10
+    data = read_frames(data_file, data_path, j, k)
+
+    saved_blobs = peak_search_slab(data, threshold, mask=mask,
+                                   min_pixels=min_pixels)
+    for blob in saved_blobs:
+        blob.z += j
+    return i, saved_blobs
+
+
+def peak_search_slab(data, threshold, mask=None, min_pixels=10):
+    """Identify peaks in a slab of raw data that has already been read.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D slab of raw data
     threshold : float
         Peak threshold
     mask : array-like
@@ -49,40 +362,167 @@ def peak_search(data_file, data_path, i, j, k, threshold, mask=None,
     Returns
     -------
     list of NXBlobs
-        Peak locations and intensities stored in NXBlob instances
+        Peak locations and intensities, with z-values relative to the
+        first frame of the slab
     """
-    nxsetconfig(lock=3600, lockexpiry=28800)
-
-    with nxopen(data_file, "r") as data_root:
-        data = data_root[data_path][j:k].nxvalue.clip(0)
-
+    data = data.clip(0)
     if mask is not None:
         data = np.where(mask, 0, data)
 
-    nframes = data.shape[0]
-    saved_blobs = []
-    last_blobs = []
-    for z in range(nframes):
-        blobs = [
-            NXBlob(x, y, z, data[z, int(y), int(x)], min_pixels=min_pixels)
-            for y, x in peak_local_max(
-                data[z], min_distance=min_pixels, threshold_abs=threshold
-            )
-        ]
-        for lb in last_blobs:
-            found = False
-            for b in blobs:
-                if lb == b:
-                    found = True
-                    b.update(lb)
-            if not found:
-                lb.refine(data)
-                if lb.is_valid():
-                    saved_blobs.append(lb)
+    saved_blobs = [np.empty((0, 4))]
+    last_blobs = np.empty((0, 4))
+    for z in range(data.shape[0]):
+        yx = peak_local_max(data[z], min_distance=min_pixels,
+                            threshold_abs=threshold)
+        blobs = np.empty((len(yx), 4))
+        blobs[:, 0] = yx[:, 1]
+        blobs[:, 1] = yx[:, 0]
+        blobs[:, 2] = z
+        blobs[:, 3] = data[z, yx[:, 0], yx[:, 1]]
+        found = link_blobs(last_blobs, blobs)
+        saved_blobs.append(last_blobs[~found])
         last_blobs = blobs
-    for blob in saved_blobs:
-        blob.z += j
-    return i, saved_blobs
+
+    saved_blobs = np.concatenate(saved_blobs)
+    x, y, z, sigx, sigy, sigz, intensity = refine_blobs(
+        data, saved_blobs[:, 0], saved_blobs[:, 1], saved_blobs[:, 2],
+        min_pixels=min_pixels)
+    valid = (sigx >= 0.5) & (sigy >= 0.5)
+    return [NXBlob(*values, min_pixels=min_pixels)
+            for values in zip(x[valid], y[valid], z[valid],
+                              saved_blobs[valid, 3], intensity[valid],
+                              sigx[valid], sigy[valid], sigz[valid])]
+
+
+def link_blobs(last_blobs, blobs, radius=10):
+    """Link the blobs of a frame to those of the previous frame.
+
+    Each blob in the previous frame is compared to the blobs in the
+    current frame, in order, and a match is declared if they are within
+    the given radius. If a matched blob in the previous frame has a
+    larger maximum value, the current blob inherits its position and
+    maximum value, so that subsequent comparisons use the updated
+    position. Candidates are located using a grid hash with a cell size
+    equal to the radius, so the cost is linear in the number of blobs.
+
+    Parameters
+    ----------
+    last_blobs : ndarray, shape (m, 4)
+        x, y, z and maximum values of the blobs in the previous frame
+    blobs : ndarray, shape (n, 4)
+        x, y, z and maximum values of the blobs in the current frame.
+        These are updated in place.
+    radius : float, optional
+        Radius within which blobs are considered to be the same peak,
+        by default 10
+
+    Returns
+    -------
+    ndarray of bool, shape (m,)
+        True for each blob in the previous frame with a match in the
+        current frame.
+    """
+    found = np.zeros(len(last_blobs), dtype=bool)
+    if len(last_blobs) == 0 or len(blobs) == 0:
+        return found
+    radius_2 = radius**2
+    cells = {}
+    cell_index = {}
+    for n, cell in enumerate(
+            map(tuple, np.floor(blobs[:, :3] / radius).astype(int))):
+        cells.setdefault(cell, []).append(n)
+        cell_index[n] = cell
+    offsets = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1)
+               for k in (-1, 0, 1)]
+    last_cells = np.floor(last_blobs[:, :3] / radius).astype(int)
+    for m, (x, y, z, max_value) in enumerate(last_blobs):
+        cx, cy, cz = last_cells[m]
+        matches = []
+        for i, j, k in offsets:
+            for n in cells.get((cx+i, cy+j, cz+k), ()):
+                b = blobs[n]
+                if (x - b[0])**2 + (y - b[1])**2 + (z - b[2])**2 < radius_2:
+                    matches.append(n)
+        if matches:
+            found[m] = True
+        for n in matches:
+            if max_value > blobs[n, 3]:
+                blobs[n] = x, y, z, max_value
+                cell = tuple(last_cells[m])
+                if cell != cell_index[n]:
+                    cells[cell_index[n]].remove(n)
+                    cells.setdefault(cell, []).append(n)
+                    cell_index[n] = cell
+    return found
+
+
+def refine_blobs(data, x, y, z, min_pixels=10, batch_size=256):
+    """Calculate the centroids, widths and intensities of a set of peaks.
+
+    Each peak is refined within a box extending min_pixels on either
+    side of its initial position, truncated at the edges of the slab.
+    The centroids and widths are the first and second moments of the
+    projections of the box onto each axis. The peaks are processed in
+    batches to limit the size of the temporary arrays. Integer data
+    are accumulated as 64-bit integers and floating-point data as
+    64-bit floats.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D slab containing the peaks
+    x, y, z : array-like
+        Initial positions of the peaks in slab coordinates
+    min_pixels : int, optional
+        Half-width of the box used to refine each peak, by default 10
+    batch_size : int, optional
+        Number of peaks refined at once, by default 256
+
+    Returns
+    -------
+    tuple of ndarrays
+        x, y, z, sigx, sigy, sigz and intensity of each peak
+    """
+    centers = np.stack([np.asarray(z, dtype=float).astype(int),
+                        np.asarray(y, dtype=float).astype(int),
+                        np.asarray(x, dtype=float).astype(int)], axis=1)
+    npeaks = centers.shape[0]
+    moments = np.zeros((3, 2, npeaks))
+    intensity = np.zeros(npeaks)
+    offsets = np.arange(-min_pixels, min_pixels)
+    if np.issubdtype(data.dtype, np.integer):
+        dtype = np.int64
+    else:
+        dtype = np.float64
+    for start in range(0, npeaks, batch_size):
+        batch = centers[start:start+batch_size]
+        coords, indices, weights = [], [], []
+        for axis in range(3):
+            coord = batch[:, axis, np.newaxis] + offsets
+            valid = (coord >= 0) & (coord < data.shape[axis])
+            coords.append(coord)
+            indices.append(coord.clip(0, data.shape[axis]-1))
+            weights.append(valid)
+        slab = data[indices[0][:, :, np.newaxis, np.newaxis],
+                    indices[1][:, np.newaxis, :, np.newaxis],
+                    indices[2][:, np.newaxis, np.newaxis, :]].astype(dtype)
+        slab *= (weights[0][:, :, np.newaxis, np.newaxis]
+                 & weights[1][:, np.newaxis, :, np.newaxis]
+                 & weights[2][:, np.newaxis, np.newaxis, :])
+        batch_slice = np.s_[start:start+len(batch)]
+        intensity[batch_slice] = slab.sum((1, 2, 3))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for axis, summed_axes in enumerate([(2, 3), (1, 3), (1, 2)]):
+                profile = slab.sum(summed_axes)
+                profile = profile / profile.sum(1, keepdims=True)
+                center = (profile * coords[axis]).sum(1)
+                variance = np.abs(
+                    (profile * (coords[axis] - center[:, np.newaxis])**2
+                     ).sum(1))
+                moments[axis, 0, batch_slice] = center
+                moments[axis, 1, batch_slice] = np.sqrt(variance)
+    (z, sigz), (y, sigy), (x, sigx) = moments
+    return x, y, z, sigx, sigy, sigz, intensity
 
 
 class NXBlob:
@@ -128,21 +568,9 @@ class NXBlob:
             self.max_value = other.max_value
 
     def refine(self, data):
-        def peak_range():
-            idx = []
-            for i in range(3):
-                idx.append(np.s_[max(0, self.xyz[i] - self.min_pixels):
-                           min(self.xyz[i] + self.min_pixels, data.shape[i])])
-            return tuple(idx)
-
-        slab = NXdata(data)[peak_range()]
-        slabx = slab.sum((0, 1))
-        self.x, self.sigx = slabx.mean().nxvalue, slabx.std().nxvalue
-        slaby = slab.sum((0, 2))
-        self.y, self.sigy = slaby.mean().nxvalue, slaby.std().nxvalue
-        slabz = slab.sum((1, 2))
-        self.z, self.sigz = slabz.mean().nxvalue, slabz.std().nxvalue
-        self.intensity = slab.sum()
+        (self.x, self.y, self.z, self.sigx, self.sigy, self.sigz,
+         self.intensity) = [value[0] for value in refine_blobs(
+             data, [self.x], [self.y], [self.z], min_pixels=self.min_pixels)]
 
     def is_valid(self):
         if self.sigx < 0.5 or self.sigy < 0.5:
@@ -172,77 +600,73 @@ def fill_gaps(mask, mask_gaps):
     Returns
     -------
     array-like
-        3D mask with the gaps filled in.
+        3D mask with the gaps filled in, with the same dtype as the
+        input mask.
     """
 
     def consecutive(arr):
         return np.split(arr, np.where(np.diff(arr) != 1)[0]+1)
 
-    mask = mask.astype(float)
+    mask = np.array(mask)
     for i in range(2):
         gaps = consecutive(np.where(mask_gaps.sum(i) == mask_gaps.shape[i])[0])
-        for gap in gaps:
+        for gap in [gap for gap in gaps if gap.size > 0]:
             if i == 0:
-                mask[:, :, gap[0]:gap[-1]+1] = np.tile(np.expand_dims(
-                    np.maximum(mask[:, :, gap[0]-1],
-                               mask[:, :, gap[-1]+1]), 2),
-                    (1, 1, len(gap)))
+                mask[:, :, gap[0]:gap[-1]+1] = np.maximum(
+                    mask[:, :, gap[0]-1], mask[:, :, gap[-1]+1])[:, :, None]
             else:
-                mask[:, gap[0]:gap[-1]+1, :] = np.tile(np.expand_dims(
-                    np.maximum(mask[:, gap[0]-1, :],
-                               mask[:, gap[-1]+1, :]), 1),
-                    (1, len(gap), 1))
+                mask[:, gap[0]:gap[-1]+1, :] = np.maximum(
+                    mask[:, gap[0]-1, :], mask[:, gap[-1]+1, :])[:, None, :]
     return mask
 
 
-def local_sum(X, K):
-    """Computes the local sum inside the box of size K."""
-    G = X
-    d = len(X.shape)
-    for i in range(d):
-        zeros_shape = list(G.shape)
-        zeros_shape[i] = K.shape[i]
-        G_1 = np.concatenate([G, np.zeros(zeros_shape)], axis=i)
-        G_2 = np.concatenate([np.zeros(zeros_shape), G], axis=i)
-        G = np.cumsum(G_1-G_2, axis=i)
-    G = G[tuple(slice(None, -1, None) for _ in range(d))]
-    return G
+def box_sum(frame, size, dtype=np.int64):
+    """Sum the values within a square box centered on each pixel.
 
-
-def local_sum_same(X, K, padding):
-    """Computes the sum inside the box of size K.
+    The frame is extended beyond its edges by repeating the edge values.
+    The sums are computed separably along each axis from cumulative
+    sums, so the cost does not depend on the size of the box.
 
     Parameters
     ----------
-    X : array-like
-        Padded array
-    K : array-like
-        Convolution kernel
-    padding : tuple
-        Length padded in each dimension
+    frame : array-like
+        2D array to be summed.
+    size : int
+        Length of each side of the box. If it is even, the box extends
+        one pixel further before each pixel than after it.
+    dtype : dtype, optional
+        Type used to accumulate the sums, by default np.int64. This must
+        be able to hold the sum over each row of the padded frame.
 
     Returns
     -------
-    array-like
-        Array of the original shape (i.e., X without padding)
+    ndarray
+        Sums with the same shape as the frame.
     """
-    d = len(X.shape)
-    G = local_sum(X, K)
-    shapeK = K.shape
-    shapeG = G.shape
-    left = [(shapeK[i] - 1)//2 for i in range(d)]
-    initial = [left[i] + padding[i] for i in range(d)]
-    right = [shapeK[i] - 1 - left[i] for i in range(d)]
-    shift_from_end = [- right[i] - padding[i] for i in range(d)]
-    final = [shapeG[i] + shift_from_end[i] for i in range(d)]
-    G = G[tuple(slice(initial[i], final[i], None) for i in range(d))]
-    return G
-
-
-def mask_volume(data_file, data_path, mask_file, mask_path, i, j, k,
-                pixel_mask, threshold_1=2, horiz_size_1=11,
-                threshold_2=0.8, horiz_size_2=51):
-    """Generate a 3D mask around Bragg peaks.
+    after = (size - 1) // 2
+    before = size - 1 - after
+    total = np.pad(frame, ((before, after), (before, after)), mode='edge')
+    for axis in range(2):
+        shape = list(total.shape)
+        shape[axis] += 1
+        cumulative = np.zeros(shape, dtype=dtype)
+        np.cumsum(total, axis=axis, dtype=dtype,
+                  out=cumulative[(slice(None),)*axis + (slice(1, None),)])
+        upper = (slice(None),)*axis + (slice(size, None),)
+        lower = (slice(None),)*axis + (slice(None, -size),)
+        total = cumulative[upper] - cumulative[lower]
+    return total
+
+
+def mask_volume(data_file, data_path, i, j, pixel_mask=None, threshold_1=2,
+                horiz_size_1=11, threshold_2=0.8, horiz_size_2=51):
+    """Generate a 3D mask around Bragg peaks from a slab of frames.
+
+    Only the frames from i to j are read, so the frames at either edge
+    of the slab cannot be masked until the neighbouring slabs have been
+    processed. The edge frames are returned, with their differences
+    from the adjacent frames within the slab, so that they can be
+    completed by NXMaskWriter.
 
     Parameters
     ----------
@@ -250,82 +674,185 @@ def mask_volume(data_file, data_path, mask_file, mask_path, i, j, k,
         File path to the raw data file
     data_path : str
         Internal path to the raw data
-    mask_file : str
-        File path to the mask file
-    mask_path : str
-        Internal path to the mask array
     i : int
-        Index of first z-value of output mask
+        Index of first frame of the slab
     j : int
-        Index of first z-value of processed slab
-    k : int
-        Index of last z-value of processed slab
-    pixel_mask : array-like
+        Index of last frame of the slab (exclusive)
+    pixel_mask : array-like, optional
         2D detector mask. This has to be the same shape as the last two
         dimensions of the 3D slab. Values of 1 represent masked pixels.
+        By default, the 'pixel_mask' published to the worker is used.
+    threshold_1 : int, optional
+        Threshold for performing the smaller convolution, by default 2
     horiz_size_1 : int, optional
         Size of smaller convolution rectangles, by default 11
+    threshold_2 : float, optional
+        Threshold for performing the larger convolution, by default 0.8
+    horiz_size_2 : int, optional
+        Size of larger convolution rectangles, by default 51
+
+    Returns
+    -------
+    tuple of (i, j, mask_slab, edges)
+        The mask slab contains frames i+1 to j-1. The edges contain the
+        first and last raw frames and the difference masks between them
+        and their neighbours within the slab, which are None if the slab
+        only contains one frame.
+    """
+    pixel_mask = shared_value('pixel_mask', pixel_mask)
+    volume = read_frames(data_file, data_path, i, j)
+    if volume.shape[0] > 1:
+        mask = difference_mask(volume, pixel_mask, threshold_1=threshold_1,
+                               horiz_size_1=horiz_size_1,
+                               threshold_2=threshold_2,
+                               horiz_size_2=horiz_size_2)
+        mask_slab = np.maximum(mask[0:-1], mask[1:])
+        edges = (volume[0], volume[-1], mask[0], mask[-1])
+    else:
+        mask_slab = np.zeros((0,) + volume.shape[1:], dtype=np.int8)
+        edges = (volume[0], volume[-1], None, None)
+    return i, j, mask_slab, edges
+
+
+def difference_mask(volume, pixel_mask, threshold_1=2, horiz_size_1=11,
+                    threshold_2=0.8, horiz_size_2=51):
+    """Mask the regions that change between successive frames.
+
+    Parameters
+    ----------
+    volume : ndarray
+        3D slab of raw data
+    pixel_mask : array-like
+        2D detector mask. Values of 1 represent masked pixels.
     threshold_1 : int, optional
         Threshold for performing the smaller convolution, by default 2
+    horiz_size_1 : int, optional
+        Size of smaller convolution rectangles, by default 11
+    threshold_2 : float, optional
+        Threshold for performing the larger convolution, by default 0.8
     horiz_size_2 : int, optional
         Size of larger convolution rectangles, by default 51
+
+    Returns
+    -------
+    ndarray
+        Mask of the difference between each pair of frames, with one
+        fewer frame than the slab and values of 0 or 1
+    """
+    horiz_size_1, horiz_size_2 = int(horiz_size_1), int(horiz_size_2)
+    sum1, sum2 = horiz_size_1**2, horiz_size_2**2
+    if np.issubdtype(volume.dtype, np.integer):
+        accumulator = np.int64
+    else:
+        accumulator = np.float64
+    nframes = volume.shape[0] - 1
+    mask_1 = np.empty((nframes,) + volume.shape[1:], dtype=bool)
+    for f in range(nframes):
+        smoothed = box_sum(volume[f+1] - volume[f], horiz_size_1,
+                           accumulator) / sum1
+        mask_1[f] = (smoothed != 0) & ~(np.abs(smoothed) < threshold_1)
+
+    mask_1 = fill_gaps(mask_1, pixel_mask)
+
+    count_type = np.min_scalar_type(
+        (max(volume.shape[1:]) + horiz_size_2) * horiz_size_2)
+    mask_2 = np.empty(mask_1.shape, dtype=np.int8)
+    for f in range(nframes):
+        smoothed = box_sum(mask_1[f], horiz_size_2, count_type) / sum2
+        mask_2[f] = smoothed > threshold_2
+        # Boxes exactly at a threshold of one are also fully masked
+        if threshold_2 >= 1:
+            mask_2[f] |= smoothed == threshold_2
+    return mask_2
+
+
+def mask_volume_slab(volume, pixel_mask, threshold_1=2, horiz_size_1=11,
+                     threshold_2=0.8, horiz_size_2=51):
+    """Generate a 3D mask around Bragg peaks from a slab of raw data.
+
+    The returned mask has two fewer frames than the input slab, since
+    the first and last frames are only used to compute frame
+    differences. It should be stored in frames j+1 to k-1 of the mask,
+    where j and k are the limits of the slab in the raw data.
+
+    Parameters
+    ----------
+    volume : ndarray
+        3D slab of raw data
+    pixel_mask : array-like
+        2D detector mask. Values of 1 represent masked pixels.
+    threshold_1 : int, optional
+        Threshold for performing the smaller convolution, by default 2
+    horiz_size_1 : int, optional
+        Size of smaller convolution rectangles, by default 11
     threshold_2 : float, optional
         Threshold for performing the larger convolution, by default 0.8
-    queue : Queue, optional
-        Queue used in multiprocessing, by default None
+    horiz_size_2 : int, optional
+        Size of larger convolution rectangles, by default 51
+
+    Returns
+    -------
+    ndarray
+        3D mask of the slab, with values of 0 or 1
     """
+    mask = difference_mask(volume, pixel_mask, threshold_1=threshold_1,
+                           horiz_size_1=horiz_size_1,
+                           threshold_2=threshold_2,
+                           horiz_size_2=horiz_size_2)
+    return np.maximum(mask[0:-1], mask[1:])
 
-    nxsetconfig(lock=3600, lockexpiry=28800)
-    with nxopen(data_file, 'r') as data_root:
-        volume = data_root[data_path][j:k].nxvalue
 
-    horiz_size_1, horiz_size_2 = int(horiz_size_1), int(horiz_size_2)
-    sum1, sum2 = horiz_size_1**2, horiz_size_2**2
-    horiz_kern_1 = np.ones((1, horiz_size_1, horiz_size_1))
-    horiz_kern_2 = np.ones((1, horiz_size_2, horiz_size_2))
-
-    diff_volume = volume[1:] - volume[:-1]
-
-    padded_length = [0, horiz_size_1, horiz_size_1]
-    vol_smoothed = local_sum_same(
-        np.pad(
-            diff_volume,
-            pad_width=((0, 0),
-                       (horiz_size_1, horiz_size_1),
-                       (horiz_size_1, horiz_size_1)),
-            mode='edge'),
-        horiz_kern_1, padded_length)
-    vol_smoothed /= sum1
-
-    vol_smoothed[np.abs(vol_smoothed) < threshold_1] = 0
-
-    vol_smoothed[vol_smoothed < 0] = 1
-    vol_smoothed[vol_smoothed > 0] = 1
-
-    vol_smoothed = fill_gaps(vol_smoothed, pixel_mask)
-
-    padded_length = [0, horiz_size_2, horiz_size_2]
-    vol_smoothed = local_sum_same(
-        np.pad(
-            vol_smoothed,
-            pad_width=((0, 0),
-                       (horiz_size_2, horiz_size_2),
-                       (horiz_size_2, horiz_size_2)),
-            mode='edge'),
-        horiz_kern_2, padded_length)
-    vol_smoothed /= sum2
-    vol_smoothed[vol_smoothed < threshold_2] = 0
-    vol_smoothed[vol_smoothed > threshold_2] = 1
+def dense_mask(mask):
+    """Return a 3D mask that can be sliced as a dense array of frames.
+
+    Masks stored with a 'packing' attribute of 'bits' contain eight
+    pixels in each byte along the last axis, and are wrapped by
+    NXPackedMask, so that they are read and written as int8 frames.
+
+    Parameters
+    ----------
+    mask : NXfield or h5py.Dataset
+        Stored 3D mask
+
+    Returns
+    -------
+    NXfield, h5py.Dataset or NXPackedMask
+        The stored mask or a dense view of it.
+    """
+    if mask.attrs.get('packing') == 'bits':
+        return NXPackedMask(mask)
+    else:
+        return mask
+
+
+def read_mask(mask_file, mask_path, i, j):
+    """Read frames from a 3D mask as a dense int8 array.
+
+    Parameters
+    ----------
+    mask_file : str
+        File path to the mask file
+    mask_path : str
+        Internal path to the mask array
+    i : int
+        Index of first frame
+    j : int
+        Index of last frame (exclusive)
+
+    Returns
+    -------
+    ndarray
+        The mask frames from i to j.
+    """
     nxsetconfig(lock=3600, lockexpiry=28800)
-    with nxopen(mask_file, 'rw') as mask_root:
-        mask_root[mask_path][j+1:k-1] = (
-            np.maximum(vol_smoothed[0:-1], vol_smoothed[1:]))
-    return i
+    with nxopen(mask_file, 'r') as mask_root:
+        return np.asarray(dense_mask(mask_root[mask_path])[i:j],
+                          dtype=np.int8)
 
 
 def find_maximum_chunk(data_file, data_path, i, j, k,
-                       pixel_mask, transmission_mask,
-                       sub_idx, n_keep, scale):
+                       pixel_mask=None, transmission_mask=None,
+                       sub_idx=None, n_keep=None, scale=None):
     """Process a single chunk of frames for find_maximum.
 
     Parameters
@@ -355,10 +882,46 @@ def find_maximum_chunk(data_file, data_path, i, j, k,
     Returns
     -------
     tuple of (i, local_vsum, local_fsum, local_psum, local_maximum)
+
+    Notes
+    -----
+    The masks and trimming parameters default to the values published
+    to the worker by NXExecutor.
     """
-    nxsetconfig(lock=3600, lockexpiry=28800)
-    with nxopen(data_file, 'r') as data_root:
-        v_raw = data_root[data_path][j:k].nxvalue.clip(0)
+    pixel_mask = shared_value('pixel_mask', pixel_mask)
+    transmission_mask = shared_value('transmission_mask', transmission_mask)
+    sub_idx = shared_value('sub_idx', sub_idx)
+    n_keep = shared_value('n_keep', n_keep)
+    scale = shared_value('scale', scale)
+    v_raw = read_frames(data_file, data_path, j, k)
+    return (i,) + find_maximum_slab(v_raw, pixel_mask, transmission_mask,
+                                    sub_idx, n_keep, scale)
+
+
+def find_maximum_slab(v_raw, pixel_mask, transmission_mask,
+                      sub_idx, n_keep, scale):
+    """Compute the find_maximum statistics of a slab of raw data.
+
+    Parameters
+    ----------
+    v_raw : ndarray
+        3D slab of raw data
+    pixel_mask : ndarray, shape (ny, nx)
+        Detector pixel mask including constantly-firing pixels.
+    transmission_mask : ndarray, shape (ny, nx)
+        Annulus mask derived from qmin/qmax.
+    sub_idx : ndarray
+        Subsampled flat indices into the annulus for the trimmed sum.
+    n_keep : int
+        Number of annulus pixels to retain after trimming.
+    scale : float
+        Rescaling factor for the trimmed sum.
+
+    Returns
+    -------
+    tuple of (local_vsum, local_fsum, local_psum, local_maximum)
+    """
+    v_raw = v_raw.clip(0)
     local_vsum = v_raw.sum(0, dtype=np.float64)
     vflat = v_raw.reshape(v_raw.shape[0], -1)
     sub_vals = vflat[:, sub_idx]
@@ -370,7 +933,338 @@ def find_maximum_chunk(data_file, data_path, i, j, k,
     v.mask = pixel_mask | transmission_mask
     local_maximum = float(v.max()) if v.count() > 0 else 0.0
     del v, v_raw, vflat, sub_vals, trimmed
-    return i, local_vsum, local_fsum, local_psum, local_maximum
+    return local_vsum, local_fsum, local_psum, local_maximum
+
+
+def reduce_chunk(data_file, data_path, i, j, k, max_range, peak_ranges,
+                 mask_ranges, pixel_mask=None, transmission_mask=None,
+                 sub_idx=None, n_keep=None, scale=None, threshold=None,
+                 min_pixels=None, mask_parameters=None):
+    """Perform nxmax, nxfind and nxprepare on a single read of a chunk.
+
+    The frames from j to k are read once and each stage is applied to
+    the subset of frames that it would have read on its own, so the
+    results are identical to those of find_maximum_chunk, peak_search
+    and mask_volume.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first frame of the chunk, returned for tracking
+    j : int
+        Index of first frame to be read, including overlaps
+    k : int
+        Index of last frame to be read, including overlaps
+    max_range : tuple of int or None
+        Frame limits used to compute the maximum statistics
+    peak_ranges : list of tuple of int
+        First and last frames read for each peak search, followed by
+        the limits of the frames of the peaks that are retained
+    mask_ranges : list of tuple of int
+        Frame limits of each slab used to compute the 3D mask
+    pixel_mask : ndarray, shape (ny, nx)
+        Detector pixel mask including constantly-firing pixels.
+    transmission_mask : ndarray, shape (ny, nx)
+        Annulus mask derived from qmin/qmax.
+    sub_idx : ndarray
+        Subsampled flat indices into the annulus for the trimmed sum.
+    n_keep : int
+        Number of annulus pixels to retain after trimming.
+    scale : float
+        Rescaling factor for the trimmed sum.
+    threshold : float
+        Peak threshold
+    min_pixels : int
+        Minimum pixel separation of peaks
+    mask_parameters : dict
+        Values of 'mask_t1', 'mask_h1', 'mask_t2' and 'mask_h2'
+
+    Returns
+    -------
+    tuple of (i, maximum_result, blobs, mask_slabs)
+        The maximum result is the output of find_maximum_slab, or None
+        if max_range is None. The mask slabs are a list of tuples
+        containing the first and last frames of each slab and the slab
+        itself.
+
+    Notes
+    -----
+    The masks and parameters default to the values published to the
+    worker by NXExecutor.
+    """
+    pixel_mask = shared_value('pixel_mask', pixel_mask)
+    transmission_mask = shared_value('transmission_mask', transmission_mask)
+    sub_idx = shared_value('sub_idx', sub_idx)
+    n_keep = shared_value('n_keep', n_keep)
+    scale = shared_value('scale', scale)
+    threshold = shared_value('threshold', threshold)
+    min_pixels = shared_value('min_pixels', min_pixels)
+    mask_parameters = shared_value('mask_parameters', mask_parameters)
+    data = read_frames(data_file, data_path, j, k)
+
+    if max_range is not None:
+        mj, mk = max_range
+        maximum_result = find_maximum_slab(data[mj-j:mk-j], pixel_mask,
+                                           transmission_mask, sub_idx,
+                                           n_keep, scale)
+    else:
+        maximum_result = None
+
+    blobs = []
+    for pj, pk, start, stop in peak_ranges:
+        slab_blobs = peak_search_slab(data[pj-j:pk-j], threshold,
+                                      mask=pixel_mask, min_pixels=min_pixels)
+        for blob in slab_blobs:
+            blob.z += pj
+        blobs += [b for b in slab_blobs if b.z >= start and b.z < stop]
+
+    mask_slabs = []
+    for mj, mk in mask_ranges:
+        mask_slab = mask_volume_slab(
+            data[mj-j:mk-j], pixel_mask,
+            threshold_1=mask_parameters['mask_t1'],
+            horiz_size_1=mask_parameters['mask_h1'],
+            threshold_2=mask_parameters['mask_t2'],
+            horiz_size_2=mask_parameters['mask_h2'])
+        mask_slabs.append((mj+1, mk-1, mask_slab))
+    return i, maximum_result, blobs, mask_slabs
+
+
+def transform_chunk(data_file, data_path, i, j, geometry, monitor_weight,
+                    pixel_mask=None, polarization=None, mask_file=None,
+                    mask_path=None):
+    """Transform a chunk of frames to the HKL grid.
+
+    This is a NumPy implementation of the CCTW transform. Each valid
+    detector pixel is mapped to its nearest HKL grid point and the
+    counts and weights are summed into the output grid. The weight of
+    each pixel is the product of the frame monitor weight and the pixel
+    polarization factor, so that the normalized intensity is the ratio
+    of the summed counts to the summed weights. Pixels with zero weight
+    or masked by the detector or 3D masks are ignored.
+
+    Parameters
+    ----------
+    data_file : str
+        File path to the raw data file
+    data_path : str
+        Internal path to the raw data
+    i : int
+        Index of first frame of the chunk
+    j : int
+        Index of last frame of the chunk (exclusive)
+    geometry : dict
+        Transform geometry returned by NXRefine.transform_geometry for
+        frames i to j. If it contains a 'pixel_file' generated by
+        NXRefine.pixel_geometry, the cached scattering directions are
+        used when the sample is at the center of the goniometer, unless
+        the file has since been removed.
+    monitor_weight : ndarray
+        Monitor weights of frames i to j
+    pixel_mask : ndarray, optional
+        2D detector mask. Values of 1 represent masked pixels. By
+        default, the 'pixel_mask' published to the worker is used.
+    polarization : ndarray, optional
+        2D polarization correction of each pixel. By default, the
+        'polarization' published to the worker is used.
+    mask_file : str, optional
+        File path to the 3D mask file
+    mask_path : str, optional
+        Internal path to the 3D mask
+
+    Returns
+    -------
+    tuple of (i, indices, v, n)
+        Flattened indices of the grid points within the chunk, with the
+        summed counts and weights at each point.
+    """
+    pixel_mask = shared_value('pixel_mask', pixel_mask)
+    polarization = shared_value('polarization', polarization)
+    data = read_frames(data_file, data_path, i, j)
+    if mask_file is not None:
+        data_mask = read_mask(mask_file, mask_path, i, j)
+    else:
+        data_mask = None
+
+    nframes, ny, nx = data.shape
+    if pixel_mask is not None:
+        valid = np.flatnonzero(np.asarray(pixel_mask).ravel() == 0)
+    else:
+        valid = np.arange(ny * nx)
+    wavelength = geometry['wavelength']
+    dvecs = geometry['dvecs']
+    try:
+        directions = np.load(geometry['pixel_file'], mmap_mode='r')[0:3]
+    except (KeyError, TypeError, OSError):
+        directions = None
+    if (directions is not None and directions.shape[1:] == (ny, nx)
+            and np.allclose(dvecs, [-geometry['distance'], 0.0, 0.0])):
+        q = directions.reshape(3, -1)[:, valid] / wavelength
+        q[0] -= 1.0 / wavelength
+    else:
+        y, x = np.divmod(valid, nx)
+        xc, yc = geometry['center']
+        pixels = geometry['pixel_matrix'] @ np.stack(
+            [x - xc, y - yc, np.zeros(valid.size)])
+        q = None
+    if polarization is not None:
+        pixel_weight = np.broadcast_to(
+            np.asarray(polarization, dtype=float), (ny, nx)).ravel()[valid]
+    else:
+        pixel_weight = np.ones(valid.size)
+
+    origin = np.asarray(geometry['grid_origin'])[:, np.newaxis]
+    step = np.asarray(geometry['grid_step'])[:, np.newaxis]
+    nh, nk, nl = geometry['grid_shape']
+    shape = np.array([nh, nk, nl])[:, np.newaxis]
+    indices, counts, weights = [], [], []
+    for f in range(nframes):
+        if monitor_weight[f] == 0:
+            continue
+        if q is None:
+            v3 = pixels - dvecs[f][:, np.newaxis]
+            frame_q = v3 / (np.sqrt((v3**2).sum(0)) * wavelength)
+            frame_q[0] -= 1.0 / wavelength
+        else:
+            frame_q = q
+        hkl = geometry['matrices'][f] @ frame_q
+        idx = np.rint((hkl - origin) * step).astype(np.int64)
+        inside = np.all((idx >= 0) & (idx < shape), axis=0)
+        if data_mask is not None:
+            inside &= data_mask[f].ravel()[valid] == 0
+        idx = idx[:, inside]
+        indices.append((idx[2] * nk + idx[1]) * nh + idx[0])
+        counts.append(data[f].ravel()[valid][inside])
+        weights.append(monitor_weight[f] * pixel_weight[inside])
+
+    if not indices:
+        return i, np.array([], dtype=np.int64), np.array([]), np.array([])
+    indices, inverse = np.unique(np.concatenate(indices),
+                                 return_inverse=True)
+    v = np.bincount(inverse, weights=np.concatenate(counts),
+                    minlength=indices.size)
+    n = np.bincount(inverse, weights=np.concatenate(weights),
+                    minlength=indices.size)
+    return i, indices, v, n
+
+
+def summed_dtype(dtype):
+    """Return the data type used to store the sum of raw data files.
+
+    Integer data with fewer than 32 bits are stored as 32-bit integers.
+    Otherwise, the data type of the raw data is preserved.
+
+    Parameters
+    ----------
+    dtype : dtype
+        Data type of the raw data
+
+    Returns
+    -------
+    dtype
+        Data type of the summed data.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and dtype.itemsize < 4:
+        return np.dtype(dtype.kind + '4')
+    return dtype
+
+
+def copy_file_structure(source_file, target_file, data_path, dtype):
+    """Copy an HDF5 file, except for the values of one dataset.
+
+    The dataset at `data_path` is created with the same shape, chunks,
+    compression filters and attributes as the source, but with a new
+    data type and no stored values. All other groups, datasets and links
+    are copied unchanged.
+
+    Parameters
+    ----------
+    source_file : str
+        File path to the HDF5 file to be copied
+    target_file : str
+        File path to the new HDF5 file
+    data_path : str
+        Internal path to the dataset whose values are not copied
+    dtype : dtype
+        Data type of the new dataset
+    """
+    data_path = '/' + str(data_path).strip('/')
+
+    def copy_group(source, target):
+        for key, value in source.attrs.items():
+            target.attrs[key] = value
+        for name in source:
+            link = source.get(name, getlink=True)
+            if isinstance(link, (h5.SoftLink, h5.ExternalLink)):
+                target[name] = link
+            elif source[name].name == data_path:
+                data = source[name]
+                dcpl = data.id.get_create_plist().copy()
+                if data.chunks is not None:
+                    dcpl.set_chunk(data.chunks)
+                dataset = h5.h5d.create(target.id, name.encode(),
+                                        h5.h5t.py_create(np.dtype(dtype)),
+                                        data.id.get_space(), dcpl=dcpl)
+                for key, value in data.attrs.items():
+                    h5.Dataset(dataset).attrs[key] = value
+            elif isinstance(source[name], h5.Group):
+                copy_group(source[name], target.create_group(name))
+            else:
+                source.copy(source[name], target, name=name)
+
+    with h5.File(source_file, 'r') as source:
+        with h5.File(target_file, 'w') as target:
+            copy_group(source, target)
+
+
+def sum_chunk(data_files, data_paths, i, j, dtype):
+    """Sum a chunk of frames over a set of raw data files.
+
+    The frames are accumulated in 64-bit integers or floats, and the
+    sum is clipped to the range of the output data type, so that large
+    values saturate rather than overflow. If a file contains fewer
+    frames than the first file, only the frames that exist are added.
+
+    Parameters
+    ----------
+    data_files : list of str
+        File paths to the raw data files
+    data_paths : list of str
+        Internal paths to the raw data in each file
+    i : int
+        Index of first frame
+    j : int
+        Index of last frame (exclusive)
+    dtype : dtype
+        Data type of the summed data
+
+    Returns
+    -------
+    tuple of (int, ndarray)
+        Index of the first frame and the summed frames.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        accumulator = np.dtype(dtype.kind + '8')
+    else:
+        accumulator = np.float64
+    total = None
+    for data_file, data_path in zip(data_files, data_paths):
+        with h5.File(data_file, 'r') as data_root:
+            slab = data_root[data_path][i:j]
+        if total is None:
+            total = slab.astype(accumulator)
+        else:
+            total[:slab.shape[0]] += slab
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        np.clip(total, info.min, info.max, out=total)
+    return i, total.astype(dtype)
 
 
 def prime_julia_environment():
@@ -795,23 +1689,459 @@ class SpecParser:
         return nxlog
 
 
+class NXSharedData:
+    """Values to be published once to every worker process.
+
+    NumPy arrays are copied into blocks of shared memory, which are
+    attached by each worker without copying. Other values are pickled
+    once per worker.
+
+    Parameters
+    ----------
+    values : dict
+        Values to be shared, keyed by the names used in `shared_value`.
+    """
+
+    def __init__(self, values):
+        self.values = {}
+        self.blocks = []
+        for name, value in values.items():
+            if isinstance(value, np.ndarray) and value.size > 0:
+                value = np.ascontiguousarray(value)
+                shm = SharedMemory(create=True, size=value.nbytes)
+                np.ndarray(value.shape, dtype=value.dtype,
+                           buffer=shm.buf)[...] = value
+                self.blocks.append(shm)
+                self.values[name] = (None, (shm.name, value.shape,
+                                            value.dtype.str))
+            else:
+                self.values[name] = (value, None)
+
+    def close(self):
+        """Release the shared memory."""
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+
+class NXPackedMask:
+    """Dense view of a bit-packed 3D mask.
+
+    The mask is stored as an array of bytes, each of which contains
+    eight pixels along the last axis. Slices along the first axis are
+    unpacked when read and packed when written.
+
+    Parameters
+    ----------
+    mask : NXfield or h5py.Dataset
+        Packed mask, whose 'width' attribute is the number of pixels
+        along the last axis.
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.width = int(mask.attrs['width'])
+
+    def __repr__(self):
+        return f"NXPackedMask(shape={self.shape})"
+
+    @property
+    def shape(self):
+        return tuple(self.mask.shape[:-1]) + (self.width,)
+
+    def __getitem__(self, idx):
+        packed = np.asarray(self.mask[idx], dtype=np.uint8)
+        return np.unpackbits(packed, axis=-1,
+                             count=self.width).view(np.int8)
+
+    def __setitem__(self, idx, value):
+        self.mask[idx] = np.packbits(np.asarray(value) != 0, axis=-1)
+
+
+class NXMaskWriter:
+    """Write 3D mask slabs, completing the frames at their edges.
+
+    Each frame of the 3D mask combines the masks of its differences from
+    the preceding and following frames. Slabs produced by `mask_volume`
+    do not overlap, so the differences across the boundary between two
+    slabs are computed here, from the edge frames returned by each slab,
+    once both slabs have been received. The slabs may be added in any
+    order and each frame of raw data is only read once.
+
+    Parameters
+    ----------
+    mask : NXfield or h5py.Dataset
+        3D mask, which must be open for writing when slabs are added.
+    pixel_mask : array-like
+        2D detector mask. Values of 1 represent masked pixels.
+    mask_parameters : dict
+        Values of 'mask_t1', 'mask_h1', 'mask_t2' and 'mask_h2'
+    """
+
+    def __init__(self, mask, pixel_mask, mask_parameters):
+        self.mask = mask
+        self.pixel_mask = pixel_mask
+        self.parameters = mask_parameters
+        self.frames = {}
+        self.differences = {}
+
+    def add_frame(self, index, frame):
+        """Add a raw frame adjacent to the range being masked.
+
+        Parameters
+        ----------
+        index : int
+            Index of the frame
+        frame : ndarray
+            2D frame of raw data
+        """
+        self.frames[index] = frame
+        self.join(index)
+        self.join(index+1)
+
+    def add(self, i, j, mask_slab, edges):
+        """Write the interior of a slab and complete its boundaries.
+
+        Parameters
+        ----------
+        i : int
+            Index of first frame of the slab
+        j : int
+            Index of last frame of the slab (exclusive)
+        mask_slab : ndarray
+            3D mask of frames i+1 to j-1
+        edges : tuple
+            Edge frames and difference masks returned by `mask_volume`
+        """
+        if j - i > 2:
+            self.mask[i+1:j-1] = mask_slab
+        first_frame, last_frame, first_mask, last_mask = edges
+        self.frames[i], self.frames[j-1] = first_frame, last_frame
+        if first_mask is not None:
+            self.set_difference(i, 1, first_mask)
+            self.set_difference(j-1, 0, last_mask)
+        self.join(i)
+        self.join(j)
+
+    def join(self, index):
+        """Mask the difference between the frames either side of a boundary.
+
+        Parameters
+        ----------
+        index : int
+            Index of the first frame after the boundary
+        """
+        if index - 1 in self.frames and index in self.frames:
+            mask = difference_mask(
+                np.stack([self.frames[index-1], self.frames[index]]),
+                self.pixel_mask,
+                threshold_1=self.parameters['mask_t1'],
+                horiz_size_1=self.parameters['mask_h1'],
+                threshold_2=self.parameters['mask_t2'],
+                horiz_size_2=self.parameters['mask_h2'])[0]
+            self.set_difference(index-1, 1, mask)
+            self.set_difference(index, 0, mask)
+
+    def set_difference(self, index, side, mask):
+        """Store a difference mask, writing the frame once it is complete.
+
+        Parameters
+        ----------
+        index : int
+            Index of the frame
+        side : int
+            0 for the difference from the preceding frame and 1 for the
+            difference from the following frame
+        mask : ndarray
+            2D difference mask
+        """
+        differences = self.differences.setdefault(index, [None, None])
+        differences[side] = mask
+        if differences[0] is not None and differences[1] is not None:
+            self.mask[index] = np.maximum(*differences)
+            del self.differences[index]
+            self.frames.pop(index, None)
+
+
+class NXMetrics:
+    """Resources used by a data reduction task.
+
+    The wall and CPU times and the bytes read and written are measured
+    from when the object is created. A background thread samples the
+    memory and I/O of this process and all its child processes, such as
+    NXExecutor workers and CCTW, every `interval` seconds until `stop`
+    is called. The CPU time of child processes is included once they
+    have exited.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Time between samples in seconds, by default 1.0
+    """
+
+    def __init__(self, interval=1.0):
+        self.process = psutil.Process()
+        self.start_time = self.last_time = timeit.default_timer()
+        self.start_cpu = self.cpu_time()
+        self.start_io = self.io_counters(self.process)
+        self.children = {}
+        self.peak_rss = 0
+        self.chunk_times = []
+        self.intervals = []
+        self._stop = threading.Event()
+        self.sample()
+        self.start_children = dict(self.children)
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f"NXMetrics(wall_time={self.wall_time():.3g})"
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.sample()
+
+    def stop(self):
+        """Stop sampling resources."""
+        self._stop.set()
+
+    @staticmethod
+    def io_counters(process):
+        """Return the bytes read and written by a process's system calls."""
+        try:
+            io = process.io_counters()
+        except (psutil.Error, AttributeError):
+            return 0, 0
+        return (getattr(io, 'read_chars', io.read_bytes),
+                getattr(io, 'write_chars', io.write_bytes))
+
+    def cpu_time(self):
+        """Return the CPU time of this process and its exited children."""
+        times = self.process.cpu_times()
+        return (times.user + times.system
+                + times.children_user + times.children_system)
+
+    def wall_time(self):
+        """Return the elapsed time in seconds."""
+        return timeit.default_timer() - self.start_time
+
+    def sample(self):
+        """Record the memory and I/O of this process and its children."""
+        try:
+            rss = self.process.memory_info().rss
+            children = self.process.children(recursive=True)
+        except psutil.Error:
+            return
+        for child in children:
+            try:
+                rss += child.memory_info().rss
+                self.children[child.pid] = self.io_counters(child)
+            except psutil.Error:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def mark(self):
+        """Start timing the next chunk."""
+        self.last_time = timeit.default_timer()
+
+    def update(self):
+        """Record the time taken since the last chunk was completed."""
+        now = timeit.default_timer()
+        self.intervals.append(now - self.last_time)
+        self.last_time = now
+
+    def add_chunk_time(self, elapsed):
+        """Record the time taken by a worker to process a chunk."""
+        self.chunk_times.append(elapsed)
+
+    def summary(self, workers=1):
+        """Return the metrics of the task.
+
+        The chunk times are those measured by the workers if any were
+        reported, and otherwise the intervals between calls to `update`.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of workers used to process the chunks, by default 1
+
+        Returns
+        -------
+        dict
+            Tuples of the value and units of each metric, keyed by name.
+        """
+        self.sample()
+        read, written = self.io_counters(self.process)
+        read -= self.start_io[0]
+        written -= self.start_io[1]
+        for pid, (child_read, child_written) in self.children.items():
+            start_read, start_written = self.start_children.get(pid, (0, 0))
+            read += child_read - start_read
+            written += child_written - start_written
+        chunk_times = self.chunk_times or self.intervals
+        metrics = {'wall_time': (self.wall_time(), 's'),
+                   'cpu_time': (self.cpu_time() - self.start_cpu, 's'),
+                   'peak_rss': (self.peak_rss, 'B'),
+                   'bytes_read': (read, 'B'),
+                   'bytes_written': (written, 'B'),
+                   'chunks': (len(chunk_times), None),
+                   'workers': (workers if self.chunk_times else 1, None)}
+        if chunk_times:
+            p50, p90, p99 = np.percentile(chunk_times, [50, 90, 99]).tolist()
+            metrics['chunk_time_p50'] = (p50, 's')
+            metrics['chunk_time_p90'] = (p90, 's')
+            metrics['chunk_time_p99'] = (p99, 's')
+            metrics['chunk_time_max'] = (max(chunk_times), 's')
+        return metrics
+
+
+def timed_call(fn, *args, **kwargs):
+    """Call a function, returning the time it took and its result."""
+    tic = timeit.default_timer()
+    result = fn(*args, **kwargs)
+    return timeit.default_timer() - tic, result
+
+
+def read_metrics(filename):
+    """Read the task metrics recorded in a wrapper file.
+
+    Parameters
+    ----------
+    filename : str
+        File path to the wrapper file
+
+    Returns
+    -------
+    list of dict
+        The metrics of each NXprocess group, with the file name, the
+        path to the entry or subentry, the name of the process and the
+        version of nxrefine that recorded it.
+    """
+    records = []
+    with nxopen(filename, 'r') as root:
+        groups = []
+        for entry in root.NXentry:
+            groups.append(entry)
+            groups.extend(entry.NXsubentry)
+        for group in groups:
+            if 'nxworkflow' in group:
+                workflow = group['nxworkflow']
+            else:
+                workflow = group
+            for process in workflow.NXprocess:
+                if 'metrics' not in process:
+                    continue
+                if 'version' in process:
+                    version = str(process['version'].nxvalue)
+                else:
+                    version = ''
+                record = {'file': str(filename), 'entry': group.nxpath,
+                          'task': process.nxname, 'version': version}
+                for name, field in process['metrics'].items():
+                    record[name] = np.asarray(field.nxvalue).item()
+                records.append(record)
+    return records
+
+
+class TimedFuture(Future):
+    """Future returning the result of a task timed by `timed_call`.
+
+    Cancelling this future cancels the task submitted to the executor,
+    and it is only cancelled if the task is.
+
+    Parameters
+    ----------
+    inner : Future
+        Future of the `timed_call` task submitted to the executor
+    """
+
+    def __init__(self, inner):
+        super().__init__()
+        self.inner = inner
+
+    def cancel(self):
+        """Cancel the task if it has not started running."""
+        return self.inner.cancel()
+
+    def set_cancelled(self):
+        """Mark the future as cancelled and notify any waiters."""
+        super().cancel()
+        self.set_running_or_notify_cancel()
+
+
 class NXExecutor(ProcessPoolExecutor):
-    """ProcessPoolExecutor class using 'spawn' for new processes."""
+    """ProcessPoolExecutor class using 'spawn' for new processes.
 
-    def __init__(self, max_workers=None, mp_context='spawn'):
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of worker processes
+    mp_context : str, optional
+        Multiprocessing start method, by default 'spawn'
+    data_file : str, optional
+        File path to the raw data file, which is kept open by each worker
+    data_path : str, optional
+        Internal path to the raw data
+    shared : dict, optional
+        Values, such as detector masks, that are published once to each
+        worker, and retrieved by tasks using `shared_value`.
+    timer : callable, optional
+        Function called with the time taken by the worker to complete
+        each submitted task.
+    """
+
+    def __init__(self, max_workers=None, mp_context='spawn', data_file=None,
+                 data_path=None, shared=None, timer=None):
         os.environ.setdefault('PYTHONWARNINGS',
                               'ignore:resource_tracker:UserWarning')
         if mp_context:
             mp_context = get_context(mp_context)
         else:
             mp_context = None
-        super().__init__(max_workers=max_workers, mp_context=mp_context)
+        self.shared = NXSharedData(shared) if shared else None
+        if data_file is not None or self.shared is not None:
+            initializer = init_worker
+            initargs = (data_file, data_path,
+                        self.shared.values if self.shared else None)
+        else:
+            initializer, initargs = None, ()
+        super().__init__(max_workers=max_workers, mp_context=mp_context,
+                         initializer=initializer, initargs=initargs)
+        self.timer = timer
 
     def __repr__(self):
         return f"NXExecutor(max_workers={self._max_workers})"
 
+    def submit(self, fn, /, *args, **kwargs):
+        """Submit a task, timing it in the worker if there is a timer."""
+        if self.timer is None:
+            return super().submit(fn, *args, **kwargs)
+        future = TimedFuture(super().submit(timed_call, fn, *args,
+                                            **kwargs))
+
+        def done(timed_future):
+            if timed_future.cancelled():
+                future.set_cancelled()
+                return
+            error = timed_future.exception()
+            if error is not None:
+                future.set_exception(error)
+                return
+            elapsed, result = timed_future.result()
+            try:
+                self.timer(elapsed)
+            finally:
+                future.set_result(result)
+
+        future.inner.add_done_callback(done)
+        return future
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.shutdown(wait=True)
+        if self.shared is not None:
+            self.shared.close()
         if self._mp_context.get_start_method(allow_none=False) != 'fork':
             resource_tracker._resource_tracker._stop()
         return False
@@ -30,6 +30,8 @@ def main():
                         help='maximum scattering Q (Å⁻¹); auto if omitted')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing maximum')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='resume from frames processed previously')
     parser.add_argument('-q', '--queue', action='store_true',
                         help='add to server task queue')
 
@@ -44,7 +46,7 @@ def main():
         reduce = NXReduce(entry, args.subentry, args.directory, maxcount=True,
                           first=args.first, last=args.last,
                           qmin=args.qmin, qmax=args.qmax,
-                          overwrite=args.overwrite)
+                          overwrite=args.overwrite, resume=args.resume)
         if args.queue:
             reduce.queue('nxmax', args)
         else:
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -----------------------------------------------------------------------------
+# Copyright (c) 2026, Argonne National Laboratory.
+#
+# Distributed under the terms of an Open Source License.
+#
+# The full license is in the file LICENSE.pdf, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import argparse
+import csv
+from pathlib import Path
+
+import numpy as np
+
+from nxrefine.nxutils import read_metrics
+
+
+def values(records, name):
+    """Return the values of a metric in the records that contain it."""
+    return [record[name] for record in records if name in record]
+
+
+def summarize(records, by_version=False):
+    """Total the metrics of each task, optionally by nxrefine version."""
+    groups = {}
+    for record in records:
+        key = (record['task'], record['version'] if by_version else '')
+        groups.setdefault(key, []).append(record)
+    rows = []
+    for (task, version), group in sorted(groups.items()):
+        chunk_times = values(group, 'chunk_time_p90')
+        rows.append({
+            'task': task, 'version': version, 'runs': len(group),
+            'wall_hours': sum(values(group, 'wall_time')) / 3600,
+            'cpu_hours': sum(values(group, 'cpu_time')) / 3600,
+            'mean_wall': np.mean(values(group, 'wall_time')),
+            'peak_rss_gb': max(values(group, 'peak_rss'), default=0) / 1e9,
+            'read_gb': sum(values(group, 'bytes_read')) / 1e9,
+            'written_gb': sum(values(group, 'bytes_written')) / 1e9,
+            'chunk_p90': np.median(chunk_times) if chunk_times else np.nan})
+    return rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Summarize the resources used by each reduction task")
+    parser.add_argument('-d', '--directory', required=True,
+                        help='sample or label directory to be searched '
+                             'for wrapper files')
+    parser.add_argument('-v', '--versions', action='store_true',
+                        help='summarize each version of nxrefine separately')
+    parser.add_argument('-o', '--output',
+                        help='CSV file to contain the metrics of every task')
+
+    args = parser.parse_args()
+
+    records = []
+    for wrapper_file in sorted(Path(args.directory).rglob('*.nxs')):
+        if wrapper_file.stem.endswith('_scans'):
+            continue
+        try:
+            records.extend(read_metrics(wrapper_file))
+        except Exception as error:
+            print(f"Skipping '{wrapper_file}': {error}")
+
+    if not records:
+        print('No task metrics found')
+        return
+
+    if args.output:
+        fields = []
+        for record in records:
+            fields.extend(k for k in record if k not in fields)
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+
+    rows = summarize(records, by_version=args.versions)
+    for row in rows:
+        row['version'] = row['version'].replace('nxrefine v', '')
+    width = max([7] + [len(row['version']) for row in rows])
+    print(f"{'Task':<20} {'Version':<{width}} {'Runs':>5} {'Wall (h)':>9} "
+          f"{'CPU (h)':>9} {'Mean (s)':>9} {'RSS (GB)':>9} "
+          f"{'Read (GB)':>10} {'Write (GB)':>10} {'Chunk p90 (s)':>13}")
+    for row in rows:
+        print(f"{row['task']:<20} {row['version']:<{width}} {row['runs']:>5} "
+              f"{row['wall_hours']:>9.3f} {row['cpu_hours']:>9.3f} "
+              f"{row['mean_wall']:>9.1f} {row['peak_rss_gb']:>9.2f} "
+              f"{row['read_gb']:>10.2f} {row['written_gb']:>10.2f} "
+              f"{row['chunk_p90']:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
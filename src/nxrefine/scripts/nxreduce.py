@@ -49,6 +49,12 @@ def main():
                         help='perform CCTW transforms with 3D mask')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing maximum')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='reduce frames while the scan is collected')
+    parser.add_argument('-i', '--interval', type=float,
+                        help='time between polls when following the scan')
+    parser.add_argument('-T', '--timeout', type=float,
+                        help='time without new frames before finishing')
     parser.add_argument('-q', '--queue', action='store_true',
                         help='add to server task queue')
 
@@ -72,7 +78,13 @@ def main():
             reduce.queue('nxreduce', args)
         else:
             reduce.combine = reduce.pdf = False
-            reduce.nxreduce()
+            if args.follow:
+                options = {k: v for k, v in (('interval', args.interval),
+                                             ('timeout', args.timeout))
+                           if v is not None}
+                reduce.follow(**options)
+            else:
+                reduce.nxreduce()
     if (args.combine or args.pdf) and not args.queue:
         reduce = NXMultiReduce(directory=args.directory,
                                subentry=args.subentry, combine=args.combine,
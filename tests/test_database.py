@@ -7,10 +7,12 @@ import tempfile
 import unittest.mock as mock
 
 import pytest
-from nexusformat.nexus import (NXcollection, NXentry, NXprocess, NXsubentry,
-                               nxopen)
+from nexusformat.nexus import (NeXusError, NXcollection, NXentry, NXprocess,
+                               NXsubentry, nxopen)
+from sqlalchemy import inspect, text
 
-from nxrefine.nxdatabase import DONE, NOT_STARTED, File, NXDatabase, Task
+from nxrefine.nxdatabase import (DONE, IN_PROGRESS, NOT_STARTED, QUEUED, File,
+                                 NXDatabase, Task)
 from nxrefine.nxreduce import NXReduce
 from nxrefine.nxsettings import NXSettings
 
@@ -380,3 +382,84 @@ class TestRecordTimingFields:
         self.reduce.record('nxmax')
         proc = self._get_proc('nxmax')
         assert 'queue_time' not in proc
+
+
+# ---------------------------------------------------------------------------
+# Tests for queue_tasks
+# ---------------------------------------------------------------------------
+
+class TestQueueTasks:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        _, self.wrapper, tasks_dir = make_directory_structure(tmp_path)
+        make_wrapper(self.wrapper, entries=('f1', 'f2'))
+        self.db = make_db(tasks_dir)
+
+    def test_uses_write_ahead_log(self):
+        with self.db.engine.connect() as connection:
+            mode = connection.execute(text('PRAGMA journal_mode')).scalar()
+        assert mode == 'wal'
+
+    def test_queues_tasks_together(self):
+        queue_time = datetime.datetime(2024, 1, 1, 12, 0, 0)
+        self.db.queue_tasks([(self.wrapper, 'nxmax', 'f1'),
+                             (self.wrapper, 'nxmax', 'f2'),
+                             (self.wrapper, 'nxfind', 'f1', 'sub')],
+                            queue_time=queue_time)
+        f = self.db.query(self.wrapper)
+        assert f.nxmax == QUEUED
+        assert f.nxfind == NOT_STARTED
+        tasks = [(t.name, t.entry, t.subentry, t.status, t.queue_time)
+                 for t in f.tasks]
+        assert tasks == [('nxmax', 'f1', '', QUEUED, queue_time),
+                         ('nxmax', 'f2', '', QUEUED, queue_time),
+                         ('nxfind', 'f1', 'sub', QUEUED, queue_time)]
+        self.db.end_task(self.wrapper, 'nxmax', 'f1')
+        assert self.db.task_status(self.wrapper, 'nxmax') == IN_PROGRESS
+
+    def test_rolls_back_on_error(self):
+        with pytest.raises(NeXusError):
+            self.db.queue_tasks([(self.wrapper, 'nxmax', 'f1'),
+                                 (self.wrapper.parent / 'missing.nxs',
+                                  'nxmax', 'f1')])
+        assert self.db.query(self.wrapper) is None
+        assert self.db.task_status(self.wrapper, 'nxmax') == NOT_STARTED
+
+
+# ---------------------------------------------------------------------------
+# Tests for the latest task queries
+# ---------------------------------------------------------------------------
+
+class TestLatestTasks:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        _, self.wrapper, self.tasks_dir = make_directory_structure(tmp_path)
+        make_wrapper(self.wrapper, entries=('f1', 'f2'))
+        self.db = make_db(self.tasks_dir)
+
+    def test_uses_latest_row(self):
+        for status in [DONE, QUEUED]:
+            self.db.queue_task(self.wrapper, 'nxfind', 'f1', subentry='sub')
+            self.db.queue_task(self.wrapper, 'nxfind', 'f2', subentry='sub')
+            f = self.db.query(self.wrapper)
+            f.tasks.append(Task(name='nxfind', entry='f1', subentry='sub',
+                                status=status))
+            self.db.session.commit()
+        f = self.db.query(self.wrapper)
+        assert self.db.latest_status(f, ['nxfind'], subentry='sub') == {
+            ('nxfind', 'f1'): QUEUED, ('nxfind', 'f2'): QUEUED}
+        assert self.db.latest_status(f, ['nxfind']) == {}
+        self.db.end_task(self.wrapper, 'nxfind', 'f2', subentry='sub')
+        status = self.db.get_subentry_status(self.wrapper, 'sub')
+        assert status['nxfind'] == IN_PROGRESS
+        assert self.db.get_subentries(self.wrapper) == ['sub']
+
+    def test_check_tasks_adds_index(self):
+        with self.db.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_tasks_latest'))
+        db = make_db(self.tasks_dir)
+        indexes = [index['name']
+                   for index in inspect(db.engine).get_indexes('tasks')]
+        assert 'ix_tasks_latest' in indexes
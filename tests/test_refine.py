@@ -0,0 +1,133 @@
+"""Tests for the vectorized NXRefine HKL residuals and their derivatives."""
+
+import numpy as np
+import pytest
+from nexusformat.nexus import NeXusError
+
+from nxrefine.nxrefine import NXRefine
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+GEOMETRY = ['wavelength', 'distance', 'xc', 'yc', 'yaw', 'pitch', 'roll',
+            'chi', 'omega', 'theta', 'phi', 'phi_step', 'xs', 'ys', 'zs']
+ORIENTATION = ['U%d%d' % (i, j) for i in range(3) for j in range(3)]
+
+
+def make_refine(symmetry='triclinic', npks=200):
+    """Return an NXRefine instance with a synthetic set of peaks."""
+    refine = NXRefine()
+    refine.symmetry = symmetry
+    refine.a, refine.b, refine.c = 5.1, 6.2, 7.3
+    refine.alpha, refine.beta, refine.gamma = 88.0, 97.0, 91.0
+    refine.set_symmetry()
+    refine.wavelength = 0.3
+    refine.distance = 650.0
+    refine.pixel_size = 0.172
+    refine.xc, refine.yc = 700.0, 800.0
+    refine.yaw, refine.pitch, refine.roll = 0.3, -0.2, 0.1
+    refine.chi, refine.omega, refine.theta = -2.0, 1.5, 0.5
+    refine.phi, refine.phi_step = -5.0, 0.1
+    refine.xs, refine.ys, refine.zs = 0.01, 0.02, -0.01
+    rng = np.random.default_rng(0)
+    refine.Umat = np.matrix(np.linalg.qr(rng.normal(size=(3, 3)))[0])
+    refine.xp = rng.uniform(0, 1475, npks)
+    refine.yp = rng.uniform(0, 1679, npks)
+    refine.zp = rng.uniform(0, 3600, npks)
+    refine.intensity = np.ones(npks)
+    refine.polar_angle = np.zeros(npks)
+    refine.azimuthal_angle = np.zeros(npks)
+    refine.polar_max = 100.0
+    refine._idx = np.ma.arange(npks)
+    return refine
+
+
+def numerical_jacobian(refine, names, step=1e-6):
+    """Return central-difference derivatives of the HKL residuals."""
+    hkls = np.rint(refine.hkls_array())
+
+    def residuals():
+        return np.sqrt(((np.asarray(refine.Bmat)
+                         @ (refine.hkls_array() - hkls).T)**2).sum(0))
+
+    jacobian = []
+    for name in names:
+        if name.startswith('U'):
+            i, j = int(name[1]), int(name[2])
+            value = refine.Umat[i, j]
+            refine.Umat[i, j] = value + step
+            upper = residuals()
+            refine.Umat[i, j] = value - step
+            lower = residuals()
+            refine.Umat[i, j] = value
+        else:
+            value = getattr(refine, name)
+            setattr(refine, name, value + step)
+            refine.set_symmetry()
+            upper = residuals()
+            setattr(refine, name, value - step)
+            refine.set_symmetry()
+            lower = residuals()
+            setattr(refine, name, value)
+            refine.set_symmetry()
+        jacobian.append((upper - lower) / (2 * step))
+    return np.array(jacobian).T
+
+
+# ---------------------------------------------------------------------------
+# Jacobian tests
+# ---------------------------------------------------------------------------
+
+class TestDiffsJacobian:
+
+    @pytest.mark.parametrize('symmetry,lattice', [
+        ('triclinic', ['a', 'b', 'c', 'alpha', 'beta', 'gamma']),
+        ('monoclinic', ['a', 'b', 'c', 'beta']),
+        ('hexagonal', ['a', 'c']),
+        ('cubic', ['a'])])
+    def test_lattice_derivatives(self, symmetry, lattice):
+        refine = make_refine(symmetry)
+        analytic = refine.diffs_jacobian(lattice)
+        numerical = numerical_jacobian(refine, lattice)
+        np.testing.assert_allclose(analytic, numerical, rtol=1e-4,
+                                   atol=1e-8)
+
+    def test_geometry_derivatives(self):
+        refine = make_refine()
+        analytic = refine.diffs_jacobian(GEOMETRY)
+        numerical = numerical_jacobian(refine, GEOMETRY)
+        np.testing.assert_allclose(analytic, numerical, rtol=1e-4,
+                                   atol=1e-8)
+
+    def test_orientation_derivatives(self):
+        refine = make_refine()
+        analytic = refine.diffs_jacobian(ORIENTATION)
+        numerical = numerical_jacobian(refine, ORIENTATION)
+        np.testing.assert_allclose(analytic, numerical, rtol=1e-4,
+                                   atol=1e-8)
+
+    def test_unknown_parameter(self):
+        refine = make_refine()
+        with pytest.raises(NeXusError):
+            refine.diffs_jacobian(['polar_max'])
+
+
+# ---------------------------------------------------------------------------
+# Vectorized peak calculations
+# ---------------------------------------------------------------------------
+
+def test_vectorized_peaks():
+    refine = make_refine(npks=50)
+    refine.get_Gvecs()
+    hkls = np.array([refine.hkl(i) for i in range(refine.npks)])
+    H, K, L = refine.get_hkls()
+    np.testing.assert_allclose(np.array([H, K, L]).T, hkls)
+    diffs = np.array([refine.diff(i) for i in refine.idx])
+    np.testing.assert_allclose(refine.diffs(), diffs)
+    peaks = refine.get_peaks()
+    assert len(peaks) == refine.npks
+    for i, peak in enumerate(peaks):
+        assert peak[0] == i
+        np.testing.assert_allclose(peak[7:10], hkls[i])
+        np.testing.assert_allclose(peak[10], diffs[i])
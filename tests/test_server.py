@@ -0,0 +1,77 @@
+"""Tests for the server queue and task scheduler."""
+
+import threading
+import time
+
+import pytest
+
+from nxrefine import nxserver
+from nxrefine.nxserver import NXFileQueue, NXScheduler, NXTask
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_queue_wait(tmp_path, monkeypatch, inotify):
+    if not inotify:
+        monkeypatch.setattr(nxserver, 'inotify_watch', lambda path: None)
+    queue = NXFileQueue(tmp_path / 'task_list', autosave=True)
+    assert queue.wait(timeout=0)
+    assert not queue.wait(timeout=0.2)
+    writer = NXFileQueue(tmp_path / 'task_list', autosave=True)
+    thread = threading.Timer(0.2, writer.put, args=('nxreduce -d scan',))
+    thread.start()
+    tic = time.monotonic()
+    assert queue.wait(timeout=10)
+    assert time.monotonic() - tic < 5
+    thread.join()
+    assert queue.get(block=False) == 'nxreduce -d scan'
+
+
+def test_scheduler():
+    dispatched = []
+    scheduler = NXScheduler(dispatched.append)
+    commands = {}
+    for entry in ['f1', 'f2']:
+        for stage in ['--link', '--max --find --prepare', '--refine',
+                      '--transform --regular']:
+            command = f"nxreduce --directory /scan --entries {entry} {stage}"
+            commands[entry, stage.split()[0]] = command
+            scheduler.add(NXTask(command, None))
+        scheduler.add(NXTask("nxreduce --directory /scan --regular --combine",
+                             None))
+    scheduler.add(NXTask("nxmax --directory /other", None))
+
+    def running():
+        return sorted(t.command for t in scheduler.running)
+
+    assert running() == sorted([commands['f1', '--link'],
+                                commands['f2', '--link'],
+                                'nxmax --directory /other'])
+    for entry in ['f1', 'f2']:
+        for stage in ['--link', '--max', '--refine', '--transform']:
+            assert commands[entry, stage] in running()
+            assert not any('--combine' in t for t in running())
+            scheduler.finish([t for t in scheduler.running
+                              if t.command == commands[entry, stage]][0])
+    assert running() == ['nxmax --directory /other',
+                         'nxreduce --directory /scan --regular --combine']
+    assert len([t for t in dispatched if '--combine' in t.command]) == 1
+
+
+def test_scheduler_capacity(monkeypatch):
+    monkeypatch.setattr(nxserver, 'default_process_count', lambda: 4)
+    scheduler = NXScheduler(lambda task: None, cores=8)
+    tasks = [NXTask(f"nxmax --directory /scan --entries {entry}", None)
+             for entry in ['f1', 'f2', 'f3']]
+    tasks.append(NXTask("nxload --directory /other --entries f1", None))
+    for task in tasks:
+        scheduler.add(task)
+    assert scheduler.running == tasks[:2]
+    assert [t.granted for t in tasks] == [4, 4, None, None]
+    scheduler.finish(tasks[0])
+    assert scheduler.running == tasks[1:3]
+    scheduler.finish(tasks[1])
+    assert scheduler.running == tasks[2:]
+    assert tasks[3].granted == 1
+    scheduler = NXScheduler(lambda task: None, cores=2)
+    scheduler.add(NXTask("nxmax --directory /scan --entries f1", None))
+    assert scheduler.running[0].granted == 2
@@ -11,6 +11,7 @@ from nexusformat.nexus.tree import string_dtype
 from nxrefine.nxparent import NXParent
 from nxrefine.nxreduce import NXReduce
 from nxrefine.nxsettings import NXSettings
+from nxrefine.nxutils import NXMetrics, read_metrics
 
 
 # ---------------------------------------------------------------------------
@@ -256,3 +257,47 @@ class TestNXReduceSettings:
         assert p.get_setting('mask_h1') == 15
         assert p.get_setting('mask_t2') == 1.2
         assert p.get_setting('mask_h2') == 61
+
+    # 12. session: parameters and NXprocess groups are written at task end
+    def test_session_defers_writes_to_task_end(self):
+        r = self._make_reduce()
+        with r.session():
+            r.write_parameters(threshold=60000)
+            r.record('nxfind', threshold=60000)
+            assert r.get_parameter('threshold') == 60000
+            assert NXParent(self.parent_file).get_setting('threshold') is None
+            with nxopen(self.wrapper_file) as root:
+                assert 'nxworkflow' not in root['entry']
+            r.record_end('nxfind')
+            assert NXParent(self.parent_file).get_setting('threshold') == 60000
+            with nxopen(self.wrapper_file) as root:
+                assert 'nxfind' in root['entry/nxworkflow']
+
+    # 13. session: writes without a parent are flushed when it closes
+    def test_session_flushes_local_parameters(self):
+        make_wrapper_file(self.wrapper_file, parent_name=None)
+        r = NXReduce(directory=self.scan_dir)
+        with r.session():
+            r.write_parameters(threshold=55555)
+            with nxopen(self.wrapper_file) as root:
+                assert 'nxreduce' not in root['entry']
+        with nxopen(self.wrapper_file) as root:
+            assert root['entry/nxreduce/threshold'].nxvalue == 55555
+
+    # 14. metrics: task resources are recorded in the NXprocess group
+    def test_record_metrics(self):
+        r = self._make_reduce()
+        r.metrics['nxfind'] = NXMetrics()
+        r.start_progress(0, 2)
+        r.update_progress(1)
+        r.update_progress(2)
+        r.record('nxfind', threshold=60000)
+        r.stop_metrics('nxfind')
+        records = read_metrics(self.wrapper_file)
+        assert len(records) == 1
+        assert records[0]['task'] == 'nxfind'
+        assert records[0]['entry'] == '/entry'
+        assert records[0]['chunks'] == 2
+        assert records[0]['workers'] == 1
+        assert records[0]['wall_time'] >= records[0]['chunk_time_max']
+        assert records[0]['peak_rss'] > 0
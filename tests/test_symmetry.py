@@ -0,0 +1,50 @@
+"""Tests for block-wise symmetrization with NXSymmetry."""
+
+import numpy as np
+import pytest
+from nexusformat.nexus import NXdata, NXentry, NXfield, nxload, nxopen
+
+from nxrefine.nxsymmetry import NXSymmetry, laue_functions
+
+
+def make_transforms(path, shape, rng):
+    """Write three entries containing transforms, one without weights."""
+    with nxopen(path, 'w') as root:
+        for entry in ['f1', 'f2', 'f3']:
+            signal = rng.random(shape).astype(np.float32)
+            signal[signal < 0.05] = np.nan
+            signal[signal < 0.2] = 0.0
+            root[entry] = NXentry()
+            root[entry]['transform'] = NXdata(NXfield(signal, name='data'))
+            if entry != 'f3':
+                weights = 3 * rng.random(shape).astype(np.float32)
+                root[entry]['transform'].nxweights = NXfield(
+                    weights, name='data_weights')
+
+
+@pytest.mark.parametrize('laue_group', list(laue_functions))
+def test_symmetrize_blocks(tmp_path, laue_group):
+    if laue_group.startswith('m'):
+        shape = (8, 8, 8)
+    elif laue_group == '2/m':
+        shape = (8, 5, 8)
+    else:
+        shape = (6, 8, 8)
+    make_transforms(tmp_path / 'transform.nxs', shape,
+                    np.random.default_rng(0))
+    root = nxload(tmp_path / 'transform.nxs')
+    symmetry = NXSymmetry(root['f1/transform'], laue_group=laue_group)
+    signal = np.nan_to_num(sum(root[entry]['transform/data'].nxvalue
+                               for entry in ['f1', 'f2', 'f3']))
+    weights = sum(root[entry]['transform/data_weights'].nxvalue
+                  for entry in ['f1', 'f2'])
+    symm_function = laue_functions[laue_group]
+    signal, weights = symm_function(signal), symm_function(weights)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.where(weights > 0, signal / weights, 0.0)
+    with nxopen(tmp_path / 'symm.nxs', 'w') as symm_root:
+        symm_root['data'] = NXfield(shape=shape, dtype=np.float32)
+        symmetry.symmetrize(entries=True, output=symm_root['data'],
+                            block_size=3, max_workers=1)
+    result = nxload(tmp_path / 'symm.nxs')['data'].nxvalue
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,254 @@
+"""Tests for the data reduction utilities in nxrefine.nxutils."""
+
+import time
+
+import h5py as h5
+import numpy as np
+import pytest
+from nexusformat.nexus import NXdata
+
+from nxrefine.nxutils import (NXExecutor, NXMaskWriter, as_completed,
+                              box_sum, chunk_ranges, copy_file_structure,
+                              dense_mask, fill_gaps, mask_volume,
+                              mask_volume_slab, plan_chunks, read_mask,
+                              refine_blobs, sum_chunk, summed_dtype, unprocessed_ranges)
+
+SHAPE = (3650, 1679, 1475)
+FRAME_SIZE = 4 * 1679 * 1475
+
+
+class TestPlanChunks:
+
+    def test_memory_budget(self):
+        size = plan_chunks(SHAPE, np.int32, memory=100 * 8 * FRAME_SIZE)
+        assert size == 100
+
+    def test_overlap(self):
+        size = plan_chunks(SHAPE, np.int32, memory=100 * 8 * FRAME_SIZE,
+                           overlap=5)
+        assert size == 90
+
+    def test_hdf5_alignment(self):
+        size = plan_chunks(SHAPE, np.int32, chunks=(7, 1679, 1475),
+                           memory=100 * 8 * FRAME_SIZE)
+        assert size == 98
+        size = plan_chunks(SHAPE, np.int32, chunks=(200, 1679, 1475),
+                           memory=100 * 8 * FRAME_SIZE)
+        assert size == 200
+
+    def test_limits(self):
+        assert plan_chunks(SHAPE, np.int32, memory=FRAME_SIZE,
+                           minimum=50) == 50
+        assert plan_chunks(SHAPE, np.int32, memory=1e12,
+                           maximum=500) == 500
+        assert plan_chunks(SHAPE, np.int32, memory=1e15) == SHAPE[0]
+
+    def test_workers(self):
+        size = plan_chunks(SHAPE, np.int32, memory=1e12, workers=8)
+        assert size == 115
+
+    def test_multiple(self):
+        size = plan_chunks(SHAPE, np.int32, chunks=(7, 1679, 1475),
+                           memory=130 * 8 * FRAME_SIZE, multiple=50)
+        assert size == 100
+        size = plan_chunks(SHAPE, np.int32, memory=20 * 8 * FRAME_SIZE,
+                           multiple=50)
+        assert size == 50
+
+
+@pytest.mark.parametrize('first,last,size', [(10, 3640, 100), (0, 50, 50),
+                                             (3, 131, 7), (5, 6, 10)])
+def test_chunk_ranges(first, last, size):
+    ranges = chunk_ranges(first, last, size)
+    assert ranges[0][0] == first and ranges[-1][1] == last
+    assert all(j == k for (_, j), (k, _) in zip(ranges[:-1], ranges[1:]))
+    assert all(j % size == 0 for _, j in ranges[:-1])
+    assert all(j - i <= size for i, j in ranges)
+
+
+def test_unprocessed_ranges():
+    done = np.zeros(100, dtype=bool)
+    assert unprocessed_ranges(done, 10, 90, 50) == [(10, 50), (50, 90)]
+    done[10:60] = True
+    assert unprocessed_ranges(done, 10, 90, 50) == [(60, 90)]
+    done[70:75] = True
+    assert unprocessed_ranges(done, 10, 120, 50) == [(60, 70), (75, 100),
+                                                     (100, 120)]
+    done[:] = True
+    assert unprocessed_ranges(done, 10, 90, 50) == []
+
+
+def refine_peak(data, x, y, z, min_pixels=10):
+    """Refine a single peak from the moments of an NXdata slab."""
+    xyz = (int(z), int(y), int(x))
+    slab = NXdata(data)[tuple(
+        np.s_[max(0, xyz[i] - min_pixels):
+              min(xyz[i] + min_pixels, data.shape[i])] for i in range(3))]
+    result = []
+    for axes in [(0, 1), (0, 2), (1, 2)]:
+        profile = slab.sum(axes)
+        result.append((profile.mean().nxvalue, profile.std().nxvalue))
+    (x, sigx), (y, sigy), (z, sigz) = result
+    return x, y, z, sigx, sigy, sigz, slab.sum().nxvalue
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float32])
+def test_refine_blobs(dtype):
+    rng = np.random.default_rng(0)
+    data = rng.poisson(3, (40, 50, 60)).astype(dtype)
+    if dtype == np.float32:
+        data += rng.random(data.shape, dtype=np.float32)
+    z, y, x = rng.integers(3, 37, (3, 20)) * [[1], [1.2], [1.4]] + 0.5
+    for i, j, k in zip(z.astype(int), y.astype(int), x.astype(int)):
+        data[i-1:i+2, j-2:j+3, k-2:k+3] += 1000
+    refined = refine_blobs(data, x, y, z)
+    for i in range(len(x)):
+        expected = refine_peak(data, x[i], y[i], z[i])
+        np.testing.assert_allclose([value[i] for value in refined],
+                                   expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('size', [1, 4, 11])
+def test_box_sum(size):
+    frame = np.random.default_rng(0).integers(-100, 100, (23, 17))
+    before, after = size // 2, (size - 1) // 2
+    padded = np.pad(frame, ((before, after), (before, after)), mode='edge')
+    expected = np.lib.stride_tricks.sliding_window_view(
+        padded, (size, size)).sum(axis=(2, 3))
+    np.testing.assert_array_equal(box_sum(frame, size), expected)
+    mask = frame > 0
+    padded = np.pad(mask, ((before, after), (before, after)), mode='edge')
+    expected = np.lib.stride_tricks.sliding_window_view(
+        padded, (size, size)).sum(axis=(2, 3))
+    total = box_sum(mask, size, np.min_scalar_type(40 * size))
+    np.testing.assert_array_equal(total, expected)
+
+
+def test_fill_gaps():
+    mask = np.zeros((2, 6, 7), dtype=bool)
+    mask[0, 1, 2] = mask[1, 4, 4] = True
+    gaps = np.zeros((6, 7), dtype=np.int8)
+    gaps[:, 3] = 1
+    filled = fill_gaps(mask, gaps)
+    assert filled.dtype == bool and not mask[0, 1, 3]
+    assert filled[0, 1, 3] and filled[1, 4, 3]
+    assert filled.sum() == 4
+    np.testing.assert_array_equal(fill_gaps(mask, np.zeros((6, 7))), mask)
+
+
+@pytest.mark.parametrize('first,size', [(0, 5), (3, 4), (2, 1)])
+def test_mask_writer(tmp_path, first, size):
+    rng = np.random.default_rng(0)
+    data = rng.poisson(2, (20, 16, 18)).astype(np.int32)
+    for z, y, x in rng.integers(2, 14, (12, 3)):
+        data[z:z+2, y-2:y+2, x-2:x+2] += 50
+    data_file = tmp_path / 'data.h5'
+    with h5.File(data_file, 'w') as root:
+        root['data'] = data
+    pixel_mask = np.zeros((16, 18), dtype=np.int8)
+    pixel_mask[:, 7] = 1
+    parameters = {'mask_t1': 2, 'mask_h1': 3, 'mask_t2': 0.5, 'mask_h2': 5}
+    last = 17
+    expected = np.zeros(data.shape, dtype=np.int8)
+    j = first - min(1, first)
+    expected[j+1:last] = mask_volume_slab(
+        data[j:last+1], pixel_mask, *parameters.values())
+    mask = np.zeros(data.shape, dtype=np.int8)
+    writer = NXMaskWriter(mask, pixel_mask, parameters)
+    if first > 0:
+        writer.add_frame(first-1, data[first-1])
+    ranges = chunk_ranges(first, last+1, size)
+    for i in rng.permutation(len(ranges)):
+        writer.add(*mask_volume(data_file, 'data', *ranges[i], pixel_mask,
+                                *parameters.values()))
+    assert expected.any()
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_packed_mask(tmp_path):
+    mask = (np.random.default_rng(0).random((6, 5, 13)) > 0.7)
+    mask = mask.astype(np.int8)
+    mask_file = tmp_path / 'mask.h5'
+    with h5.File(mask_file, 'w') as root:
+        packed = root.create_dataset('entry/mask', shape=(6, 5, 2),
+                                     dtype=np.uint8, compression='gzip')
+        packed.attrs['packing'] = 'bits'
+        packed.attrs['width'] = 13
+        view = dense_mask(packed)
+        assert view.shape == mask.shape
+        view[:4] = mask[:4]
+        view[4] = mask[4]
+        view[5:] = np.ones((5, 13), dtype=np.int8)
+    mask[5] = 1
+    result = read_mask(mask_file, 'entry/mask', 1, 6)
+    assert result.dtype == np.int8
+    np.testing.assert_array_equal(result, mask[1:6])
+
+
+def test_executor_timer():
+    times = []
+    with NXExecutor(max_workers=2, mp_context='fork',
+                    timer=times.append) as executor:
+        futures = [executor.submit(chunk_ranges, 0, n, 3) for n in (5, 9)]
+        results = [future.result() for future in as_completed(futures)]
+        failed = executor.submit(chunk_ranges, 0, 5, 0)
+        with pytest.raises(ZeroDivisionError):
+            failed.result()
+    assert sorted(len(result) for result in results) == [2, 3]
+    assert len(times) == 2 and all(t >= 0 for t in times)
+
+
+def test_executor_timer_cancel():
+    times = []
+    with NXExecutor(max_workers=1, mp_context='fork',
+                    timer=times.append) as executor:
+        futures = [executor.submit(time.sleep, 0.2) for _ in range(4)]
+        assert futures[-1].cancel()
+        assert len(list(as_completed(futures, timeout=30))) == 4
+    assert futures[-1].cancelled() and futures[-1].inner.cancelled()
+    assert len(times) == 3
+
+
+def test_sum_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    data_files, data_paths, frames = [], [], []
+    for scan in range(3):
+        data = rng.integers(60000, 65535, (12, 6, 5), dtype=np.uint16)
+        data_file = tmp_path / f'scan{scan}.h5'
+        with h5.File(data_file, 'w') as root:
+            root['entry/instrument/name'] = 'detector'
+            root.create_dataset('entry/data/data', data=data[:12-scan],
+                                chunks=(1, 6, 5), compression='gzip')
+            root['entry/data'].attrs['signal'] = 'data'
+            root['entry/data/data'].attrs['units'] = 'counts'
+        data_files.append(str(data_file))
+        data_paths.append('/entry/data/data')
+        frames.append(data[:12-scan].astype(np.int64))
+    expected = frames[0].copy()
+    for scan_frames in frames[1:]:
+        expected[:scan_frames.shape[0]] += scan_frames
+    dtype = summed_dtype(np.uint16)
+    assert dtype == np.uint32
+    sum_file = tmp_path / 'sum.h5'
+    copy_file_structure(data_files[0], sum_file, data_paths[0], dtype)
+    with h5.File(sum_file, 'r+') as root:
+        for i, j in chunk_ranges(0, 12, 5):
+            root['entry/data/data'][i:j] = sum_chunk(data_files, data_paths,
+                                                     i, j, dtype)[1]
+    with h5.File(sum_file, 'r') as root:
+        assert root['entry/instrument/name'][()] == b'detector'
+        assert root['entry/data'].attrs['signal'] == 'data'
+        assert root['entry/data/data'].attrs['units'] == 'counts'
+        assert root['entry/data/data'].compression == 'gzip'
+        assert root['entry/data/data'].chunks == (1, 6, 5)
+        assert root['entry/data/data'].dtype == np.uint32
+        np.testing.assert_array_equal(root['entry/data/data'][()], expected)
+
+
+def test_sum_chunk_saturates(tmp_path):
+    data_file = tmp_path / 'scan.h5'
+    with h5.File(data_file, 'w') as root:
+        root['data'] = np.full((2, 3, 3), 2**30, dtype=np.int32)
+    i, total = sum_chunk([data_file] * 3, ['data'] * 3, 0, 2, np.int32)
+    assert total.dtype == np.int32
+    assert np.all(total == np.iinfo(np.int32).max)